@@ -0,0 +1,101 @@
+"""Compares the compiled email blacklist with the per-pattern scan it replaced,
+for growing EMAIL_BLACKLIST sizes.
+
+Run from the directory holding config.yaml, like kyan.py:
+
+    python benchmarks/bench_email_blacklist.py [--emails 2000] [--repeat 5]
+"""
+
+import argparse
+import os
+import random
+import string
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from kyan.blacklist import EmailBlacklist  # noqa: E402
+
+SIZES = (10, 100, 1000, 10000)
+
+
+def per_pattern_scan(email_blacklist, email):
+    """register_email_blacklist_validator's check before the compiled blacklist,
+    for plain string entries"""
+    email = email.strip()
+    for item in email_blacklist:
+        if item in email.lower():
+            return True
+    return False
+
+
+def random_domain(rng):
+    name = "".join(rng.choices(string.ascii_lowercase, k=rng.randint(5, 12)))
+    return "{}.{}".format(name, rng.choice(["com", "net", "org", "io", "xyz"]))
+
+
+def make_emails(rng, blacklist, count):
+    """Mostly clean addresses, like real registrations, with a few blacklisted"""
+    emails = []
+    for _ in range(count):
+        user = "".join(rng.choices(string.ascii_lowercase, k=rng.randint(4, 14)))
+        if rng.random() < 0.1:
+            domain = rng.choice(blacklist).lstrip("@")
+        else:
+            domain = random_domain(rng)
+        emails.append("{}@{}".format(user, domain))
+    return emails
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--emails", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    print(
+        "{:>8} {:>16} {:>16} {:>9}".format(
+            "entries", "scan us/email", "compiled", "speedup"
+        )
+    )
+    for size in SIZES:
+        blacklist = ["@" + random_domain(rng) for _ in range(size)]
+        emails = make_emails(rng, blacklist, args.emails)
+        compiled = EmailBlacklist(blacklist)
+
+        mismatches = [
+            email
+            for email in emails
+            if compiled.is_blacklisted(email) != per_pattern_scan(blacklist, email)
+        ]
+        if mismatches:
+            sys.exit("Results differ for {!r}".format(mismatches[:5]))
+
+        scan = min(
+            timeit.repeat(
+                lambda: [per_pattern_scan(blacklist, email) for email in emails],
+                number=1,
+                repeat=args.repeat,
+            )
+        )
+        automaton = min(
+            timeit.repeat(
+                lambda: [compiled.is_blacklisted(email) for email in emails],
+                number=1,
+                repeat=args.repeat,
+            )
+        )
+        print(
+            "{:>8} {:>16.2f} {:>16.2f} {:>8.1f}x".format(
+                size,
+                scan / len(emails) * 1e6,
+                automaton / len(emails) * 1e6,
+                scan / automaton,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""Compares rendering the search_results.html rows from precomputed TorrentRows
+with the per-row template they replaced, for 75 (a page) and 1000 torrents.
+
+Run from the directory holding config.yaml, like kyan.py. The categories are
+read from the configured database, so it needs to be bootstrapped:
+
+    python benchmarks/bench_listing.py [--repeat 20]
+"""
+
+import argparse
+import os
+import random
+import re
+import sys
+import timeit
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from kyan import create_app, listing, models  # noqa: E402
+from kyan.extensions import db  # noqa: E402
+
+SIZES = (75, 1000)
+
+# The rows of search_results.html before listing.iter_torrent_rows
+PER_ROW_TBODY = """\
+		<tbody>
+			{% set torrents = torrent_query.items %}
+			{% for torrent in torrents %}
+			<tr class="{% if torrent.deleted %}deleted{% elif torrent.hidden %}warning{% elif torrent.remake %}danger{% elif torrent.trusted %}success{% else %}default{% endif %}">
+				{% set cat_id = ((torrent.main_category_id|string) + '_' + (torrent.sub_category_id|string)) or torrent.sub_category.id_as_string %}
+				<td>
+					<a href="{{ url_for('main.home', c=cat_id) }}" title="{{ torrent.main_category.name }} - {{ torrent.sub_category.name }}">
+						<img src="{{ url_for('static', filename='img/icons/%s.png'|format(cat_id)) }}" alt="{{ category_name(cat_id) }}" class="category-icon">
+					</a>
+				</td>
+				<td colspan="2">
+					{% set torrent_id = torrent.id %}
+					{% set com_count = torrent.comment_count %}
+					{% if com_count %}
+					<a href="{{ url_for('torrents.view', torrent_id=torrent_id, _anchor='comments') }}" class="comments" title="{{ '{c} comment{s}'.format(c=com_count, s='s' if com_count > 1 else '') }}">
+						<i class="fa fa-comments-o"></i>{{ com_count -}}
+					</a>
+					{% endif %}
+					<a href="{{ url_for('torrents.view', torrent_id=torrent_id) }}" title="{{ torrent.display_name | escape }}">{{ torrent.display_name | escape }}</a>
+				</td>
+				<td class="text-center">
+					{% if torrent.has_torrent %}
+					<a href="{{ url_for('torrents.download', torrent_id=torrent_id) }}"><i class="fa fa-fw fa-download"></i></a>
+					{% endif %}
+					<a href="{{ torrent.magnet_uri }}"><i class="fa fa-fw fa-magnet"></i></a>
+				</td>
+				<td class="text-center">{{ torrent.filesize | filesizeformat(True) }}</td>
+				<td class="text-center" data-timestamp="{{ torrent.created_utc_timestamp | int }}">{{ torrent.created_time.strftime('%Y-%m-%d %H:%M') }}</td>
+
+				{% if config.GENERAL.ENABLE_SHOW_STATS %}
+				<td class="text-center">{{ torrent.stats.seed_count }}</td>
+				<td class="text-center">{{ torrent.stats.leech_count }}</td>
+				<td class="text-center">{{ torrent.stats.download_count }}</td>
+				{% endif %}
+			</tr>
+			{% endfor %}
+		</tbody>"""
+
+
+def current_tbody(app):
+    source = app.jinja_loader.get_source(app.jinja_env, "search_results.html")[0]
+    return re.search(r"\t\t<tbody>.*?</tbody>", source, re.DOTALL).group(0)
+
+
+def make_torrents(rng, sub_categories, count):
+    """Transient torrents with their categories and stats, like a listing query
+    returns them with everything joined-loaded"""
+    flags = [
+        models.TorrentFlags.NONE,
+        models.TorrentFlags.TRUSTED,
+        models.TorrentFlags.REMAKE,
+        models.TorrentFlags.HIDDEN,
+    ]
+    torrents = []
+    for torrent_id in range(count, 0, -1):
+        sub_category = rng.choice(sub_categories)
+        torrents.append(
+            models.Torrent(
+                id=torrent_id,
+                info_hash=rng.randbytes(20),
+                display_name="[Group] Some Show - {:02d} [1080p] <&>".format(
+                    torrent_id % 100
+                ),
+                filesize=rng.randint(10**6, 10**10),
+                flags=rng.choice(flags),
+                has_torrent=rng.random() < 0.9,
+                comment_count=rng.choice([0, 0, 0, 1, 5]),
+                created_time=datetime(2020, 1, 1) + timedelta(minutes=torrent_id),
+                main_category_id=sub_category.main_category_id,
+                sub_category_id=sub_category.id,
+                main_category=sub_category.main_category,
+                sub_category=sub_category,
+                stats=models.Statistic(
+                    seed_count=rng.randint(0, 500),
+                    leech_count=rng.randint(0, 50),
+                    download_count=rng.randint(0, 10000),
+                ),
+            )
+        )
+    return torrents
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    app = create_app()
+    rng = random.Random(42)
+    with app.test_request_context("/"):
+        sub_categories = models.SubCategory.query.all()
+        if not sub_categories:
+            sys.exit("No categories in the database, run `flask db bootstrap`")
+        for sub_category in sub_categories:
+            sub_category.main_category
+        # Keep the transient torrents out of the session
+        db.session.expunge_all()
+
+        per_row = app.jinja_env.from_string(PER_ROW_TBODY)
+        precomputed = app.jinja_env.from_string(current_tbody(app))
+        context = {}
+        app.update_template_context(context)
+
+        def render_per_row(torrents):
+            return per_row.render(
+                context, torrent_query=SimpleNamespace(items=torrents)
+            )
+
+        def render_precomputed(torrents):
+            return precomputed.render(
+                context, torrent_rows=listing.iter_torrent_rows(torrents)
+            )
+
+        print(
+            "{:>6} {:>14} {:>14} {:>9}".format(
+                "rows", "per-row ms", "precomputed", "speedup"
+            )
+        )
+        for size in SIZES:
+            torrents = make_torrents(rng, sub_categories, size)
+            old_html = render_per_row(torrents)
+            new_html = render_precomputed(torrents)
+            if old_html.split() != new_html.split():
+                sys.exit("Rendered rows differ for {} torrents".format(size))
+
+            old = min(
+                timeit.repeat(
+                    lambda: render_per_row(torrents), number=1, repeat=args.repeat
+                )
+            )
+            new = min(
+                timeit.repeat(
+                    lambda: render_precomputed(torrents), number=1, repeat=args.repeat
+                )
+            )
+            print(
+                "{:>6} {:>14.2f} {:>14.2f} {:>8.1f}x".format(
+                    size, old * 1000, new * 1000, old / new
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""Measures app startup: the wall time of `import kyan` and create_app() in fresh
+processes, with GENERAL.BOOTSTRAP_ON_START on and off.
+
+Run from the directory holding config.yaml, like kyan.py. --rev also measures
+older commits (checked out into temporary worktrees), e.g. the commit before
+bootstrapping moved out of startup:
+
+    python benchmarks/bench_startup.py --runs 10 --rev <commit>
+
+Commits from before GENERAL.BOOTSTRAP_ON_START always bootstrap, so their two
+rows are the same. Bootstrapping needs the MySQL/MariaDB database from
+config.yaml; --bootstrap off skips those rows.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+import yaml
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+CHILD = """
+import json, time
+start = time.perf_counter()
+import kyan
+imported = time.perf_counter()
+kyan.create_app()
+created = time.perf_counter()
+print(json.dumps([imported - start, created - imported]))
+"""
+
+
+def measure(source_dir, config_dir, runs):
+    """Returns the (import, create_app) times of each run, in seconds"""
+    env = dict(os.environ, PYTHONPATH=source_dir)
+    times = []
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, "-c", CHILD],
+            cwd=config_dir,
+            env=env,
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode:
+            sys.exit("Startup failed:\n" + result.stderr)
+        times.append(json.loads(result.stdout.strip().splitlines()[-1]))
+    return times
+
+
+def write_config(config, bootstrap, directory):
+    config = dict(config, GENERAL=dict(config["GENERAL"]))
+    config["GENERAL"]["BOOTSTRAP_ON_START"] = bootstrap
+    with open(os.path.join(directory, "config.yaml"), "w") as config_file:
+        yaml.safe_dump(config, config_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument(
+        "--rev", action="append", default=[], help="also measure this commit"
+    )
+    parser.add_argument("--config", default="config.yaml")
+    parser.add_argument("--bootstrap", choices=("both", "on", "off"), default="both")
+    args = parser.parse_args()
+
+    with open(args.config) as config_file:
+        config = yaml.safe_load(config_file)
+
+    bootstrap_settings = {
+        "both": (True, False),
+        "on": (True,),
+        "off": (False,),
+    }[args.bootstrap]
+
+    with tempfile.TemporaryDirectory(prefix="kyan-startup-") as temp_dir:
+        sources = [("working tree", ROOT_DIR)]
+        for rev in args.rev:
+            worktree = os.path.join(temp_dir, "rev-" + rev.replace("/", "_"))
+            subprocess.run(
+                ["git", "-C", ROOT_DIR, "worktree", "add", "--detach", worktree, rev],
+                check=True,
+                capture_output=True,
+            )
+            sources.append((rev, worktree))
+
+        try:
+            print(
+                "{:<24} {:>9} {:>12} {:>16} {:>10}".format(
+                    "source", "bootstrap", "import ms", "create_app ms", "total ms"
+                )
+            )
+            for name, source_dir in sources:
+                for bootstrap in bootstrap_settings:
+                    config_dir = tempfile.mkdtemp(dir=temp_dir)
+                    write_config(config, bootstrap, config_dir)
+                    times = measure(source_dir, config_dir, args.runs)
+                    import_ms = statistics.median(t[0] for t in times) * 1000
+                    create_ms = statistics.median(t[1] for t in times) * 1000
+                    print(
+                        "{:<24} {:>9} {:>12.1f} {:>16.1f} {:>10.1f}".format(
+                            name[:24],
+                            "on" if bootstrap else "off",
+                            import_ms,
+                            create_ms,
+                            import_ms + create_ms,
+                        )
+                    )
+        finally:
+            for name, source_dir in sources[1:]:
+                subprocess.run(
+                    [
+                        "git",
+                        "-C",
+                        ROOT_DIR,
+                        "worktree",
+                        "remove",
+                        "--force",
+                        source_dir,
+                    ],
+                    capture_output=True,
+                )
+
+
+if __name__ == "__main__":
+    main()
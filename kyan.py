@@ -1,8 +1,9 @@
 from waitress import serve
 
-from kyan import create_app
+from kyan import create_app, warm_up
 
 app = create_app()
+warm_up(app)
 
 if app.config["DEBUG"]:
     from werkzeug.debug import DebuggedApplication
@@ -1,26 +1,24 @@
+import atexit
 import logging
 import string
 
 from flask import Flask, flash, g, render_template, url_for
 from flask_assets import Bundle
 
-from kyan import models
+from kyan import infohashes
 from kyan.api_handler import api_blueprint
+from kyan.auth import flush_login_ips_at_exit
+from kyan.blacklist import build_email_blacklist
+from kyan.bootstrap import bootstrap_database
+from kyan.commands import register_commands
 from kyan.extensions import assets, cache, config, db, limiter
+from kyan.stats import flush_stats_at_exit
 from kyan.template_utils import bp as template_utils_bp
+from kyan.template_utils import init_bytecode_cache, precompile_templates
 from kyan.utils import random_string
 from kyan.views import register_views
 
 
-def add_categories(categories, main_class, sub_class):
-    for main_cat_name, sub_cat_names in categories:
-        main_cat = main_class(name=main_cat_name)
-        for i, sub_cat_name in enumerate(sub_cat_names):
-            # Composite keys can't autoincrement, set sub_cat id manually (1-index)
-            sub_cat = sub_class(id=i + 1, name=sub_cat_name, main_category=main_cat)
-        db.session.add(main_cat)
-
-
 def create_app():
     app = Flask(__name__)
     app.config.update(config)
@@ -84,8 +82,11 @@ def create_app():
             flash(markup_source, "danger")
             return render_template("error.html"), 500
 
+    build_email_blacklist(app)
+
     # Enable the jinja2 do extension.
     app.jinja_env.add_extension("jinja2.ext.do")
+    init_bytecode_cache(app)
 
     # Database
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
@@ -108,6 +109,7 @@ def create_app():
     app.register_blueprint(template_utils_bp)
     app.register_blueprint(api_blueprint)
     register_views(app)
+    register_commands(app)
 
     cache_config = {
         "CACHE_TYPE": app.config["CACHE"]["TYPE"],
@@ -117,38 +119,25 @@ def create_app():
     limiter.init_app(app)
 
     db.init_app(app)
+    # Queued last_login_ip writes and buffered stats would otherwise be lost when
+    # the worker stops
+    atexit.register(flush_login_ips_at_exit, app)
+    atexit.register(flush_stats_at_exit, app)
     with app.app_context():
-        db.create_all()
-
-        kyan_categories = [
-            (
-                "Anime",
-                [
-                    "Anime Music Video",
-                    "English-translated",
-                    "Non-English-translated",
-                    "Raw",
-                ],
-            ),
-            ("Audio", ["Lossless", "Lossy"]),
-            ("Literature", ["English-translated", "Non-English-translated", "Raw"]),
-            (
-                "Live Action",
-                [
-                    "English-translated",
-                    "Idol/Promotional Video",
-                    "Non-English-translated",
-                    "Raw",
-                ],
-            ),
-            ("Pictures", ["Graphics", "Photos"]),
-            ("Software", ["Applications", "Games"]),
-        ]
-
-        kyan_category_test = models.MainCategory.query.first()
-        if not kyan_category_test:
-            add_categories(kyan_categories, models.MainCategory, models.SubCategory)
-
-            db.session.commit()
+        # Deployments run `flask db bootstrap` once and turn this off, so workers
+        # do not check the schema and categories on every start
+        if app.config["GENERAL"].get("BOOTSTRAP_ON_START", True):
+            bootstrap_database()
 
     return app
+
+
+def warm_up(app):
+    """Loads what the first requests would otherwise wait for. Run by servers
+    before they take requests, not by CLI commands."""
+    with app.app_context():
+        if app.config.get("INFOHASHES", {}).get("WARM_UP", True):
+            infohashes.warm_up()
+
+    if app.config.get("TEMPLATES", {}).get("PRECOMPILE", True):
+        precompile_templates(app)
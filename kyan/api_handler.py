@@ -1,14 +1,44 @@
+import base64
 import binascii
 import functools
 import json
+import os
 import re
-
-import requests
-from flask import Blueprint, Response, abort, g, jsonify, request, url_for
-
-from kyan import backend, forms, models
-from kyan.extensions import cache
-from kyan.views.torrents import _create_upload_category_choices
+import tarfile
+from datetime import datetime, timezone
+from io import BytesIO
+from ipaddress import ip_address
+
+import sqlalchemy
+from flask import (
+    Blueprint,
+    Response,
+    abort,
+    current_app,
+    g,
+    jsonify,
+    redirect,
+    request,
+    send_file,
+    stream_with_context,
+    url_for,
+)
+from sqlalchemy.orm import selectinload
+from werkzeug.datastructures import FileStorage
+from wtforms.validators import ValidationError
+
+from kyan import (
+    avatars,
+    backend,
+    categories,
+    export,
+    forms,
+    infohashes,
+    models,
+    stats,
+    uploads,
+)
+from kyan.auth import authenticate_api_user
 
 api_blueprint = Blueprint("api", __name__, url_prefix="/api")
 
@@ -20,8 +50,8 @@ def basic_auth_user(f):
     def decorator(*args, **kwargs):
         auth = request.authorization
         if auth:
-            user = models.User.by_username_or_email(auth.get("username"))
-            if user and user.validate_authorization(auth.get("password")):
+            user = authenticate_api_user(auth.get("username"), auth.get("password"))
+            if user:
                 g.user = user
         return f(*args, **kwargs)
 
@@ -61,70 +91,377 @@ UPLOAD_API_DEFAULTS = {
     "information": "",
     "description": "",
 }
+DEFAULT_BATCH_MAX_ITEMS = 500
+DEFAULT_BATCH_MAX_TORRENT_SIZE = 10 * 1024 * 1024
+DEFAULT_BATCH_MAX_SIZE = 256 * 1024 * 1024
 
 
-@api_blueprint.route("/upload", methods=["POST"])
-@api_blueprint.route("/v2/upload", methods=["POST"])
-@basic_auth_user
-@api_require_user
-def v2_api_upload():
-    mapped_dict = {"torrent_file": request.files.get("torrent")}
-
-    request_data_field = request.form.get("torrent_data")
+def _parse_torrent_data_field(request_data_field):
+    """Parses the torrent_data JSON field. Returns (data, error)."""
     if request_data_field is None:
-        return jsonify({"errors": ["missing torrent_data field"]}), 400
+        return None, "missing torrent_data field"
 
     try:
         request_data = json.loads(request_data_field)
     except json.decoder.JSONDecodeError:
-        return jsonify({"errors": ["unable to parse valid JSON in torrent_data"]}), 400
+        return None, "unable to parse valid JSON in torrent_data"
+
+    if not isinstance(request_data, dict):
+        return None, "torrent_data must be a JSON object"
+    return request_data, None
+
+
+def _create_api_upload_form(torrent_file, request_data, form_class=forms.UploadForm):
+    """Maps API upload data onto an UploadForm"""
+    mapped_dict = {"torrent_file": torrent_file}
 
     for key, default in UPLOAD_API_DEFAULTS.items():
         mapped_key = UPLOAD_API_FORM_KEYMAP_REVERSE.get(key, key)
         value = request_data.get(key, default)
         mapped_dict[mapped_key] = value if value is not None else default
 
-    upload_form = forms.UploadForm(None, data=mapped_dict, meta={"csrf": False})
-    upload_form.category.choices = _create_upload_category_choices()
+    upload_form = form_class(None, data=mapped_dict, meta={"csrf": False})
+    upload_form.category.choices = categories.get_registry().choices
+    return upload_form
+
+
+def _map_upload_errors(errors):
+    return {UPLOAD_API_FORM_KEYMAP.get(k, k): v for k, v in errors.items()}
+
+
+def _torrent_upload_metadata(torrent):
+    return {
+        "url": url_for("torrents.view", torrent_id=torrent.id, _external=True),
+        "id": torrent.id,
+        "name": torrent.display_name,
+        "hash": torrent.info_hash.hex(),
+        "magnet": torrent.magnet_uri,
+    }
+
+
+@api_blueprint.route("/upload", methods=["POST"])
+@api_blueprint.route("/v2/upload", methods=["POST"])
+@basic_auth_user
+@api_require_user
+def v2_api_upload():
+    request_data, error = _parse_torrent_data_field(request.form.get("torrent_data"))
+    if error:
+        return jsonify({"errors": [error]}), 400
+
+    upload_form = _create_api_upload_form(request.files.get("torrent"), request_data)
 
     if upload_form.validate():
         try:
             torrent = backend.handle_torrent_upload(upload_form, g.user)
-            torrent_metadata = {
-                "url": url_for("torrents.view", torrent_id=torrent.id, _external=True),
-                "id": torrent.id,
-                "name": torrent.display_name,
-                "hash": torrent.info_hash.hex(),
-                "magnet": torrent.magnet_uri,
-            }
-            return jsonify(torrent_metadata)
+            return jsonify(_torrent_upload_metadata(torrent))
+        except backend.TorrentExtraValidationException:
+            pass
+
+    return jsonify({"errors": _map_upload_errors(upload_form.errors)}), 400
+
+
+@api_blueprint.route("/v2/upload/async", methods=["POST"])
+@basic_auth_user
+@api_require_user
+def v2_api_upload_async():
+    request_data, error = _parse_torrent_data_field(request.form.get("torrent_data"))
+    if error:
+        return jsonify({"errors": [error]}), 400
+
+    upload_form = _create_api_upload_form(request.files.get("torrent"), request_data)
+
+    if upload_form.validate():
+        try:
+            pending = uploads.enqueue_upload(upload_form, g.user)
+            return jsonify(_pending_upload_metadata(pending)), 202
         except backend.TorrentExtraValidationException:
             pass
 
-    mapped_errors = {
-        UPLOAD_API_FORM_KEYMAP.get(k, k): v for k, v in upload_form.errors.items()
+    return jsonify({"errors": _map_upload_errors(upload_form.errors)}), 400
+
+
+def _read_batch_files(max_items):
+    """Reads the torrents[] files and/or a tar archive. Returns ((filename, bytes)
+    pairs, error). Stops reading after max_items + 1 torrents.
+
+    No torrent may be larger than UPLOADS.BATCH_MAX_TORRENT_SIZE bytes, nor the
+    whole batch larger than UPLOADS.BATCH_MAX_SIZE, so a small compressed archive
+    cannot expand into gigabytes. Every archive member counts towards the total,
+    as skipping one still means decompressing it."""
+    upload_config = current_app.config.get("UPLOADS", {})
+    max_torrent_size = upload_config.get(
+        "BATCH_MAX_TORRENT_SIZE", DEFAULT_BATCH_MAX_TORRENT_SIZE
+    )
+    max_total_size = upload_config.get("BATCH_MAX_SIZE", DEFAULT_BATCH_MAX_SIZE)
+    too_large = "{} is larger than {} bytes".format
+    batch_too_large = "the batch is larger than {} bytes".format(max_total_size)
+
+    named_files = []
+    total_size = 0
+    for torrent_file in request.files.getlist("torrents")[: max_items + 1]:
+        raw_torrent = torrent_file.read(max_torrent_size + 1)
+        if len(raw_torrent) > max_torrent_size:
+            return None, too_large(torrent_file.filename, max_torrent_size)
+        total_size += len(raw_torrent)
+        if total_size > max_total_size:
+            return None, batch_too_large
+        named_files.append((torrent_file.filename, raw_torrent))
+
+    archive = request.files.get("archive")
+    if archive:
+        with tarfile.open(fileobj=archive.stream, mode="r:*") as tar:
+            for member in tar:
+                if len(named_files) > max_items:
+                    break
+                total_size += member.size
+                if total_size > max_total_size:
+                    return None, batch_too_large
+                if member.isfile() and member.name.lower().endswith(".torrent"):
+                    if member.size > max_torrent_size:
+                        return None, too_large(member.name, max_torrent_size)
+                    named_files.append(
+                        (os.path.basename(member.name), tar.extractfile(member).read())
+                    )
+
+    return named_files, None
+
+
+@api_blueprint.route("/v2/upload/batch", methods=["POST"])
+@basic_auth_user
+@api_require_user
+def v2_api_upload_batch():
+    request_data, error = _parse_torrent_data_field(request.form.get("torrent_data"))
+    if error:
+        return jsonify({"errors": [error]}), 400
+
+    # Per-file overrides of torrent_data, keyed by filename
+    item_data = request_data.pop("items", None) or {}
+    if not isinstance(item_data, dict):
+        return jsonify({"errors": ["torrent_data items must be a JSON object"]}), 400
+
+    if backend.is_ratelimited_uploader(g.user):
+        return (
+            jsonify({"errors": ["Batch uploads are not available to new accounts"]}),
+            403,
+        )
+
+    max_items = current_app.config.get("UPLOADS", {}).get(
+        "BATCH_MAX_ITEMS", DEFAULT_BATCH_MAX_ITEMS
+    )
+    try:
+        named_files, error = _read_batch_files(max_items)
+    except tarfile.TarError:
+        return jsonify({"errors": ["unable to read archive"]}), 400
+    if error:
+        return jsonify({"errors": [error]}), 413
+    if not named_files:
+        return jsonify({"errors": ["no torrents given"]}), 400
+    if len(named_files) > max_items:
+        return (
+            jsonify({"errors": ["at most {} torrents per batch".format(max_items)]}),
+            400,
+        )
+
+    parsed_files = uploads.parse_torrents_parallel(named_files)
+
+    # Look up the info hashes the index knows with one query
+    info_hashes = [
+        data.info_hash
+        for data, _ in parsed_files
+        if data and infohashes.lookup(data.info_hash)
+    ]
+    existing_torrents = {}
+    if info_hashes:
+        query = models.Torrent.query.filter(models.Torrent.info_hash.in_(info_hashes))
+        existing_torrents = {torrent.info_hash: torrent for torrent in query}
+
+    results = []
+    entries = []
+    entry_results = []
+    seen_hashes = set()
+    for (filename, raw_torrent), (torrent_data, error) in zip(
+        named_files, parsed_files
+    ):
+        result = {"filename": filename}
+        results.append(result)
+
+        if torrent_data and torrent_data.info_hash in seen_hashes:
+            error = "Duplicate torrent in batch"
+        elif torrent_data:
+            seen_hashes.add(torrent_data.info_hash)
+            try:
+                torrent_data.db_id = forms.check_existing_torrent(
+                    existing_torrents.get(torrent_data.info_hash)
+                )
+            except ValidationError as e:
+                error = e.args[0]
+        if error:
+            result["errors"] = {"torrent": [error]}
+            continue
+
+        overrides = item_data.get(filename) or {}
+        if not isinstance(overrides, dict):
+            result["errors"] = {"torrent_data": ["item must be a JSON object"]}
+            continue
+
+        upload_form = _create_api_upload_form(
+            FileStorage(BytesIO(raw_torrent), filename=filename),
+            dict(request_data, **overrides),
+            form_class=forms.PreparsedUploadForm,
+        )
+        upload_form.torrent_file.parsed_data = torrent_data
+        if not upload_form.validate():
+            result["errors"] = _map_upload_errors(upload_form.errors)
+            continue
+
+        entries.append(
+            (torrent_data, backend.get_upload_values(upload_form), raw_torrent)
+        )
+        entry_results.append(result)
+
+    created = uploads.create_torrents_batch(
+        entries, g.user, ip_address(request.remote_addr).packed
+    )
+    for result, outcome in zip(entry_results, created):
+        if isinstance(outcome, models.Torrent):
+            result["torrent"] = _torrent_upload_metadata(outcome)
+        else:
+            result["errors"] = _map_upload_errors(outcome)
+
+    return jsonify({"results": results}), 200
+
+
+@api_blueprint.route("/v2/upload/status/<int:upload_id>", methods=["GET"])
+@basic_auth_user
+@api_require_user
+def v2_api_upload_status(upload_id):
+    uploads.sweep_stale_uploads()
+    pending = models.PendingUpload.by_id(upload_id)
+    if not pending or not (pending.uploader_id == g.user.id or g.user.is_moderator):
+        return jsonify({"errors": ["Unknown upload id."]}), 404
+
+    return jsonify(_pending_upload_metadata(pending)), 200
+
+
+def _pending_upload_metadata(pending):
+    metadata = {
+        "id": pending.id,
+        "status": pending.status_str,
+        "status_url": url_for(
+            "api.v2_api_upload_status", upload_id=pending.id, _external=True
+        ),
+        "hash": pending.info_hash.hex(),
     }
-    return jsonify({"errors": mapped_errors}), 400
+    if pending.status == models.PendingUploadStatus.DONE:
+        metadata["torrent"] = _torrent_upload_metadata(pending.torrent)
+    elif pending.status == models.PendingUploadStatus.FAILED:
+        metadata["errors"] = _map_upload_errors(json.loads(pending.errors))
+    return metadata
 
 
 @api_blueprint.route("/avatar/<string:username>", methods=["GET"])
-@cache.cached(timeout=18000)
 def gravatar_proxy(username):
     user = models.User.by_username(username)
-    gravatar_url = user.gravatar_url()
-
-    response = requests.get(gravatar_url)
+    if not user:
+        abort(404)
+    if not current_app.config["GENERAL"]["ENABLE_GRAVATAR"]:
+        return redirect(url_for("static", filename="img/avatar/default.png"))
 
-    if response.status_code == 200:
-        return Response(response.content, content_type=response.headers["Content-Type"])
-    else:
+    opened = avatars.open_avatar(user.gravatar_url())
+    if opened is None:
         abort(404)
+    avatar, avatar_file = opened
+    # Served from the open file, as eviction may remove the blob meanwhile
+    response = send_file(
+        avatar_file,
+        mimetype=avatar.content_type,
+        etag=avatar.digest,
+        max_age=current_app.config.get("AVATARS", {}).get(
+            "FRESH_FOR", avatars.DEFAULT_FRESH_FOR
+        ),
+        conditional=True,
+    )
+    response.content_length = os.fstat(avatar_file.fileno()).st_size
+    return response
 
 
 # INFO
 
 ID_PATTERN = "^[0-9]+$"
 INFO_HASH_PATTERN = "^[0-9a-fA-F]{40}$"
+B32_INFO_HASH_PATTERN = "^[a-zA-Z2-7]{32}$"
+
+INFO_FIELDS = (
+    "submitter",
+    "url",
+    "id",
+    "name",
+    "creation_date",
+    "hash_b32",
+    "hash_hex",
+    "magnet",
+    "main_category",
+    "main_category_id",
+    "sub_category",
+    "sub_category_id",
+    "information",
+    "description",
+    "stats",
+    "filesize",
+    "files",
+    "is_trusted",
+    "is_complete",
+    "is_remake",
+)
+# The filelist can be huge, so bulk lookups only include it when asked for
+BULK_INFO_DEFAULT_FIELDS = tuple(field for field in INFO_FIELDS if field != "files")
+DEFAULT_BULK_INFO_MAX_ITEMS = 100
+
+
+def _torrent_submitter(torrent, viewer):
+    submitter = None
+    if not torrent.anonymous and torrent.user:
+        submitter = torrent.user.username
+    if torrent.user and (viewer == torrent.user or viewer.is_moderator):
+        submitter = torrent.user.username
+    return submitter
+
+
+def _torrent_files(torrent):
+    files = {}
+    if torrent.filelist:
+        files = json.loads(torrent.filelist.filelist_blob.decode("utf-8"))
+    return files
+
+
+def _torrent_info_metadata(torrent, viewer, fields=INFO_FIELDS):
+    field_getters = {
+        "submitter": lambda: _torrent_submitter(torrent, viewer),
+        "url": lambda: url_for("torrents.view", torrent_id=torrent.id, _external=True),
+        "id": lambda: torrent.id,
+        "name": lambda: torrent.display_name,
+        "creation_date": lambda: torrent.created_time.strftime("%Y-%m-%d %H:%M UTC"),
+        "hash_b32": lambda: torrent.info_hash_as_b32,
+        "hash_hex": lambda: torrent.info_hash_as_hex,
+        "magnet": lambda: torrent.magnet_uri,
+        "main_category": lambda: torrent.main_category.name,
+        "main_category_id": lambda: torrent.main_category.id,
+        "sub_category": lambda: torrent.sub_category.name,
+        "sub_category_id": lambda: torrent.sub_category.id,
+        "information": lambda: torrent.information,
+        "description": lambda: torrent.description,
+        "stats": lambda: {
+            "seeders": torrent.stats.seed_count,
+            "leechers": torrent.stats.leech_count,
+            "downloads": torrent.stats.download_count,
+        },
+        "filesize": lambda: torrent.filesize,
+        "files": lambda: _torrent_files(torrent),
+        "is_trusted": lambda: torrent.trusted,
+        "is_complete": lambda: torrent.complete,
+        "is_remake": lambda: torrent.remake,
+    }
+    return {field: field_getters[field]() for field in fields}
 
 
 @api_blueprint.route("/info/<torrent_id_or_hash>", methods=["GET"])
@@ -142,7 +479,7 @@ def v2_api_info(torrent_id_or_hash):
         torrent = models.Torrent.by_id(int(torrent_id_or_hash))
     elif hex_hash_match:
         a2b_hash = binascii.unhexlify(torrent_id_or_hash)
-        torrent = models.Torrent.by_info_hash(a2b_hash)
+        torrent = infohashes.torrent_by_info_hash(a2b_hash)
     else:
         return jsonify({"errors": ["Query was not a valid id or hash."]}), 400
 
@@ -154,41 +491,168 @@ def v2_api_info(torrent_id_or_hash):
     if torrent.deleted and not (viewer and viewer.is_superadmin):
         return jsonify({"errors": ["Query was not a valid id or hash."]}), 400
 
-    submitter = None
-    if not torrent.anonymous and torrent.user:
-        submitter = torrent.user.username
-    if torrent.user and (viewer == torrent.user or viewer.is_moderator):
-        submitter = torrent.user.username
+    return jsonify(_torrent_info_metadata(torrent, viewer)), 200
 
-    files = {}
-    if torrent.filelist:
-        files = json.loads(torrent.filelist.filelist_blob.decode("utf-8"))
 
-    torrent_metadata = {
-        "submitter": submitter,
-        "url": url_for("torrents.view", torrent_id=torrent.id, _external=True),
-        "id": torrent.id,
-        "name": torrent.display_name,
-        "creation_date": torrent.created_time.strftime("%Y-%m-%d %H:%M UTC"),
-        "hash_b32": torrent.info_hash_as_b32,
-        "hash_hex": torrent.info_hash_as_hex,
-        "magnet": torrent.magnet_uri,
-        "main_category": torrent.main_category.name,
-        "main_category_id": torrent.main_category.id,
-        "sub_category": torrent.sub_category.name,
-        "sub_category_id": torrent.sub_category.id,
-        "information": torrent.information,
-        "description": torrent.description,
-        "stats": {
-            "seeders": torrent.stats.seed_count,
-            "leechers": torrent.stats.leech_count,
-            "downloads": torrent.stats.download_count,
-        },
-        "filesize": torrent.filesize,
-        "files": files,
-        "is_trusted": torrent.trusted,
-        "is_complete": torrent.complete,
-        "is_remake": torrent.remake,
-    }
+def _parse_bulk_info_query(query):
+    """Sorts query strings into torrent ids and binary info hashes.
+    Returns (ids, info_hashes, invalid queries). ids and info_hashes map each value
+    to the queries spelling it, e.g. "01" and "1"."""
+    ids, info_hashes, invalid = {}, {}, []
+    for item in query:
+        item = str(item).strip()
+        if re.match(ID_PATTERN, item):
+            ids.setdefault(int(item), []).append(item)
+        elif re.match(INFO_HASH_PATTERN, item):
+            info_hashes.setdefault(binascii.unhexlify(item), []).append(item)
+        elif re.match(B32_INFO_HASH_PATTERN, item):
+            info_hashes.setdefault(base64.b32decode(item.upper()), []).append(item)
+        else:
+            invalid.append(item)
+    return ids, info_hashes, invalid
+
+
+@api_blueprint.route("/v2/info", methods=["GET", "POST"])
+@basic_auth_user
+@api_require_user
+def v2_api_bulk_info():
+    """Looks up many torrents by id, hex or base32 info hash at once.
+    Takes ?q=a,b,c&fields=x,y (or a JSON body with q and fields lists) and
+    streams one JSON object per query, as JSON lines."""
+    if request.method == "POST":
+        request_data = request.get_json(silent=True)
+        if not isinstance(request_data, dict):
+            return jsonify({"errors": ["Request body must be a JSON object."]}), 400
+        query = request_data.get("q") or []
+        fields = request_data.get("fields") or BULK_INFO_DEFAULT_FIELDS
+    else:
+        query = [q for arg in request.args.getlist("q") for q in arg.split(",") if q]
+        fields_arg = request.args.get("fields")
+        fields = fields_arg.split(",") if fields_arg else BULK_INFO_DEFAULT_FIELDS
+
+    if not isinstance(query, list) or not isinstance(fields, (list, tuple)):
+        return jsonify({"errors": ["q and fields must be lists."]}), 400
+    if not query:
+        return jsonify({"errors": ["No ids or hashes given."]}), 400
+
+    max_items = current_app.config.get("API", {}).get(
+        "BULK_INFO_MAX_ITEMS", DEFAULT_BULK_INFO_MAX_ITEMS
+    )
+    if len(query) > max_items:
+        return (
+            jsonify({"errors": ["At most {} ids or hashes.".format(max_items)]}),
+            400,
+        )
+
+    unknown_fields = [field for field in fields if field not in INFO_FIELDS]
+    if unknown_fields:
+        return (
+            jsonify({"errors": ["Unknown fields: " + ", ".join(unknown_fields)]}),
+            400,
+        )
+
+    ids, info_hashes, invalid = _parse_bulk_info_query(query)
+
+    torrents = []
+    if ids or info_hashes:
+        Torrent = models.Torrent
+        torrent_query = Torrent.query.filter(
+            sqlalchemy.or_(
+                Torrent.id.in_(list(ids)), Torrent.info_hash.in_(list(info_hashes))
+            )
+        )
+        if "files" in fields:
+            torrent_query = torrent_query.options(selectinload(Torrent.filelist))
+        if "submitter" in fields:
+            torrent_query = torrent_query.options(selectinload(Torrent.user))
+        torrents = torrent_query.all()
+
+    viewer = g.user
+    results = {}
+    for torrent in torrents:
+        if torrent.deleted and not viewer.is_superadmin:
+            continue
+        for item in ids.get(torrent.id, []) + info_hashes.get(torrent.info_hash, []):
+            results[item] = torrent
+
+    def generate():
+        for item in query:
+            item = str(item).strip()
+            torrent = results.get(item)
+            if torrent:
+                line = {
+                    "query": item,
+                    "result": _torrent_info_metadata(torrent, viewer, fields),
+                }
+            else:
+                line = {"query": item, "errors": ["Query was not a valid id or hash."]}
+            yield json.dumps(line) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
+# STATS
 
-    return jsonify(torrent_metadata), 200
+
+@api_blueprint.route("/v2/stats", methods=["POST"])
+@basic_auth_user
+@api_require_user
+def v2_api_stats():
+    """Ingests (info_hash, seeders, leechers, completed) records, as JSON lines or,
+    with Content-Type application/octet-stream, as stats.BINARY_RECORD structs"""
+    if not g.user.is_superadmin:
+        return jsonify({"errors": ["Insufficient permissions"]}), 403
+
+    if request.mimetype == "application/octet-stream":
+        records = stats.read_binary_records(request.stream)
+    else:
+        records = stats.read_json_lines(request.stream)
+    return jsonify(stats.ingest(records))
+
+
+# EXPORT
+
+
+@api_blueprint.route("/v2/export", methods=["GET"])
+@basic_auth_user
+@api_require_user
+def v2_api_export():
+    """Streams the torrent catalogue as JSON lines or CSV (?format=), optionally
+    gzipped (?gzip=1), incrementally with ?since_id= or ?since_updated= (a UTC
+    ISO 8601 time). Hidden torrents, and the hashes of deleted ones, are only
+    included for moderators; other users get just their ids."""
+    output_format = request.args.get("format", "jsonl")
+    if output_format not in export.FORMATS:
+        return jsonify({"errors": ["format must be jsonl or csv"]}), 400
+    compress = request.args.get("gzip", "").lower() in ("1", "true", "yes")
+
+    try:
+        since_id = request.args.get("since_id", type=int)
+        since_updated = request.args.get("since_updated")
+        if since_updated:
+            since_updated = datetime.fromisoformat(since_updated)
+            if since_updated.tzinfo:
+                # updated_time is stored as naive UTC
+                since_updated = since_updated.astimezone(timezone.utc).replace(
+                    tzinfo=None
+                )
+    except ValueError:
+        return jsonify({"errors": ["Invalid since_updated"]}), 400
+    if since_id is None and request.args.get("since_id"):
+        return jsonify({"errors": ["Invalid since_id"]}), 400
+
+    chunks = export.export_chunks(
+        output_format,
+        compress,
+        since_id=since_id,
+        since_updated=since_updated or None,
+        include_hidden=g.user.is_moderator or g.user.is_superadmin,
+    )
+    mimetype = "application/x-ndjson" if output_format == "jsonl" else "text/csv"
+    filename = "catalogue." + output_format
+    if compress:
+        mimetype = "application/gzip"
+        filename += ".gz"
+    response = Response(stream_with_context(chunks), mimetype=mimetype)
+    response.headers["Content-Disposition"] = "attachment; filename=" + filename
+    return response
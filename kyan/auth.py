@@ -0,0 +1,208 @@
+import hashlib
+import hmac
+import threading
+import time
+
+import flask
+import sqlalchemy
+from sqlalchemy import orm
+
+from kyan import models
+from kyan.extensions import cache, db
+from kyan.utils import call_after_commit, sha1_hash
+
+app = flask.current_app
+
+DEFAULT_API_AUTH_CACHE_TTL = 300
+DEFAULT_SESSION_USER_TTL = 10
+DEFAULT_LOGIN_IP_FLUSH_INTERVAL = 60
+
+# user id -> (expiry, {column: value}) for users loaded by before_request
+_session_users = {}
+
+# user id -> packed IP, waiting to be written to users.last_login_ip
+_pending_login_ips = {}
+_pending_login_ips_lock = threading.Lock()
+_login_ips_flushed_at = time.monotonic()
+
+
+def _password_hash_version(user):
+    """Identifies the user's current password hash. Changing the password changes
+    the version, which invalidates any credentials cached for the old one."""
+    return sha1_hash(user.password_hash.hash).hex()
+
+
+def _credential_cache_key(user, password):
+    """A keyed hash of (user id, password, password hash version), so the cache
+    never holds anything a password could be recovered from"""
+    message = "{}\0{}\0{}".format(user.id, _password_hash_version(user), password)
+    digest = hmac.new(
+        app.secret_key.encode("utf-8"), message.encode("utf-8"), hashlib.sha256
+    ).hexdigest()
+    return "api_auth:" + digest
+
+
+def _login_matches(user, login):
+    return user.username.lower() == login.lower() or (
+        user.email is not None and user.email.lower() == login.lower()
+    )
+
+
+def authenticate_api_user(login, password):
+    """Returns the active User for the username/email and password, or None.
+
+    Verified credentials are cached for API.AUTH_CACHE_TTL seconds, so repeated
+    API calls skip both the username/email lookup and the argon2 verification.
+    The user row is still loaded (by id) and checked each time, so bans take
+    effect at once, and a password change makes old cache entries unreachable."""
+    if not login or not password:
+        return None
+
+    ttl = app.config.get("API", {}).get("AUTH_CACHE_TTL", DEFAULT_API_AUTH_CACHE_TTL)
+    login_key = "api_login:" + hashlib.sha256(login.lower().encode("utf-8")).hexdigest()
+
+    user = None
+    user_id = cache.get(login_key)
+    if user_id is not None:
+        user = models.User.by_id(user_id)
+        # The username or email may have changed since it was cached
+        if user and not _login_matches(user, login):
+            user = None
+    if user is None:
+        user = models.User.by_username_or_email(login)
+        if not user:
+            return None
+        cache.set(login_key, user.id, timeout=ttl)
+
+    if user.status != models.UserStatusType.ACTIVE:
+        return None
+
+    credential_key = _credential_cache_key(user, password)
+    if cache.get(credential_key):
+        return user
+
+    if user.validate_authorization(password):
+        cache.set(credential_key, True, timeout=ttl)
+        return user
+    return None
+
+
+def _user_columns(user):
+    mapper = sqlalchemy.inspect(models.User)
+    return {attr.key: getattr(user, attr.key) for attr in mapper.column_attrs}
+
+
+def _user_from_columns(columns):
+    """Attaches a User built from cached column values to the session, without
+    querying the database"""
+    user = models.User.__mapper__.class_manager.new_instance()
+    for key, value in columns.items():
+        setattr(user, key, value)
+    orm.make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+def get_session_user(user_id):
+    """Returns the User for a logged in session, or None.
+
+    Users are kept in an in-process cache for CACHE.SESSION_USER_TTL seconds.
+    Commits that change a user drop it from this process' cache; other
+    processes see the change once their copy expires."""
+    ttl = app.config["CACHE"].get("SESSION_USER_TTL", DEFAULT_SESSION_USER_TTL)
+
+    cached = _session_users.get(user_id)
+    if cached and cached[0] > time.monotonic():
+        return _user_from_columns(cached[1])
+
+    user = models.User.by_id(user_id)
+    if user:
+        _session_users[user_id] = (time.monotonic() + ttl, _user_columns(user))
+    else:
+        _session_users.pop(user_id, None)
+    return user
+
+
+def forget_session_user(user_id):
+    _session_users.pop(user_id, None)
+
+
+@sqlalchemy.event.listens_for(models.User, "after_update")
+@sqlalchemy.event.listens_for(models.User, "after_delete")
+def _forget_changed_user(mapper, connection, user):
+    user_id = user.id
+    session = orm.object_session(user)
+    call_after_commit(
+        session, ("session_user", user_id), lambda: forget_session_user(user_id)
+    )
+
+
+def _same_ip(stored_ip, packed_ip):
+    # IPv4 addresses come back from BINARY(16) columns zero-padded to 16 bytes
+    return stored_ip is not None and stored_ip.rstrip(b"\0") == packed_ip.rstrip(b"\0")
+
+
+def update_login_ip(user, packed_ip):
+    """Records the user's current IP. Instead of committing inline, the write is
+    queued, and written in one batch with other users' by flush_login_ips_if_due
+    at the end of a request; repeated changes coalesce."""
+    if _same_ip(user.last_login_ip, packed_ip):
+        return
+
+    # Update the loaded (and cached) user without marking it dirty
+    orm.attributes.set_committed_value(user, "last_login_ip", packed_ip)
+    cached = _session_users.get(user.id)
+    if cached:
+        cached[1]["last_login_ip"] = packed_ip
+
+    with _pending_login_ips_lock:
+        _pending_login_ips[user.id] = packed_ip
+
+
+def flush_login_ips_if_due():
+    """Flushes the queued IPs if CACHE.LOGIN_IP_FLUSH_INTERVAL seconds have passed
+    since the last flush. Cheap enough to call after every request."""
+    interval = app.config["CACHE"].get(
+        "LOGIN_IP_FLUSH_INTERVAL", DEFAULT_LOGIN_IP_FLUSH_INTERVAL
+    )
+    if _pending_login_ips and time.monotonic() - _login_ips_flushed_at >= interval:
+        flush_login_ips()
+
+
+def flush_login_ips():
+    """Writes all queued last_login_ip updates in one executemany UPDATE"""
+    global _login_ips_flushed_at
+
+    with _pending_login_ips_lock:
+        pending = list(_pending_login_ips.items())
+        _pending_login_ips.clear()
+        _login_ips_flushed_at = time.monotonic()
+
+    if not pending:
+        return
+
+    users = models.User.__table__
+    statement = (
+        users.update()
+        .where(users.c.id == sqlalchemy.bindparam("user_id"))
+        .values(last_login_ip=sqlalchemy.bindparam("ip"))
+    )
+    try:
+        with db.engine.begin() as connection:
+            connection.execute(
+                statement, [{"user_id": uid, "ip": ip} for uid, ip in pending]
+            )
+    except sqlalchemy.exc.SQLAlchemyError:
+        # Retried by the next flush, unless the user's IP has changed again since
+        with _pending_login_ips_lock:
+            for user_id, packed_ip in pending:
+                _pending_login_ips.setdefault(user_id, packed_ip)
+        raise
+
+
+def flush_login_ips_at_exit(flask_app):
+    """Registered with atexit, so a stopping worker does not lose its queue"""
+    with flask_app.app_context():
+        try:
+            flush_login_ips()
+        except sqlalchemy.exc.SQLAlchemyError:
+            flask_app.logger.exception("Failed to write queued login IPs")
@@ -0,0 +1,227 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import namedtuple
+
+import flask
+
+from kyan.utils import lazy_module
+
+app = flask.current_app
+
+# Only the avatar proxy uses requests
+_requests = lazy_module("requests")
+_requests_adapters = lazy_module("requests.adapters")
+
+DEFAULT_FRESH_FOR = 18000  # 5 hours
+DEFAULT_MISSING_FRESH_FOR = 3600
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+DEFAULT_TIMEOUT = (3, 5)
+# Blobs served within this many seconds are not touched again for LRU purposes
+TOUCH_INTERVAL = 86400
+
+Avatar = namedtuple("Avatar", ["path", "digest", "content_type"])
+
+_session = None
+_session_lock = threading.Lock()
+_eviction_lock = threading.Lock()
+_estimated_size = None
+
+
+def _config(key, default):
+    return app.config.get("AVATARS", {}).get(key, default)
+
+
+def _timeout():
+    timeout = _config("TIMEOUT", DEFAULT_TIMEOUT)
+    # YAML gives a list for (connect, read)
+    return tuple(timeout) if isinstance(timeout, list) else timeout
+
+
+def _get_session():
+    """Returns the requests session shared by all avatar fetches"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            HTTPAdapter = _requests_adapters().HTTPAdapter
+            _session = _requests().Session()
+            _session.mount("https://", HTTPAdapter(pool_maxsize=16))
+            _session.mount("http://", HTTPAdapter(pool_maxsize=16))
+        return _session
+
+
+def _cache_dir():
+    return _config(
+        "CACHE_DIR", os.path.join(app.config["GENERAL"]["BASE_DIR"], "avatar_cache")
+    )
+
+
+def _blob_path(digest):
+    return os.path.join(_cache_dir(), "blobs", digest[:2], digest)
+
+
+def _index_path(url):
+    key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    return os.path.join(_cache_dir(), "index", key[:2], key + ".json")
+
+
+def _write_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as out_file:
+            out_file.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _read_entry(url):
+    try:
+        with open(_index_path(url), "r") as in_file:
+            return json.load(in_file)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_entry(url, entry):
+    _write_atomic(_index_path(url), json.dumps(entry).encode("utf-8"))
+
+
+def _avatar_from_entry(entry):
+    """Returns the cached Avatar for an index entry, or None if it is a cached 404
+    or its blob has been evicted"""
+    if entry.get("missing"):
+        return None
+    path = _blob_path(entry["digest"])
+    try:
+        # Approximate LRU: eviction removes the blobs touched longest ago
+        if time.time() - os.path.getmtime(path) > TOUCH_INTERVAL:
+            os.utime(path)
+    except OSError:
+        return None
+    return Avatar(path, entry["digest"], entry["content_type"])
+
+
+def _store(url, response):
+    content = response.content
+    digest = hashlib.sha256(content).hexdigest()
+    path = _blob_path(digest)
+    if not os.path.exists(path):
+        _write_atomic(path, content)
+        _evict_if_needed(len(content))
+    entry = {
+        "digest": digest,
+        "content_type": response.headers.get("Content-Type", "image/jpeg"),
+        "etag": response.headers.get("ETag"),
+        "fetched": time.time(),
+    }
+    _write_entry(url, entry)
+    return Avatar(path, digest, entry["content_type"])
+
+
+def get_avatar(url):
+    """Returns the Avatar for a Gravatar URL, or None if Gravatar has none.
+
+    Images are stored on disk once per distinct content (by SHA-256) and reused for
+    AVATARS.FRESH_FOR seconds, then revalidated with their ETag. 404s are
+    remembered for AVATARS.MISSING_FRESH_FOR seconds. If Gravatar cannot be
+    reached, a stale copy is served when there is one."""
+    entry = _read_entry(url)
+    cached = _avatar_from_entry(entry) if entry else None
+    now = time.time()
+    if entry and (cached or entry.get("missing")):
+        fresh_for = (
+            _config("MISSING_FRESH_FOR", DEFAULT_MISSING_FRESH_FOR)
+            if entry.get("missing")
+            else _config("FRESH_FOR", DEFAULT_FRESH_FOR)
+        )
+        if now - entry["fetched"] < fresh_for:
+            return cached
+
+    headers = {}
+    if cached and entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    try:
+        response = _get_session().get(url, headers=headers, timeout=_timeout())
+    except _requests().RequestException:
+        app.logger.warning("Failed to fetch avatar %s", url, exc_info=True)
+        return cached
+
+    if response.status_code == 304 and cached:
+        entry["fetched"] = now
+        _write_entry(url, entry)
+        return cached
+    if response.status_code == 200:
+        return _store(url, response)
+    if response.status_code == 404:
+        _write_entry(url, {"missing": True, "fetched": now})
+        return None
+
+    app.logger.warning("Avatar %s returned HTTP %d", url, response.status_code)
+    return cached
+
+
+def open_avatar(url):
+    """Returns (Avatar, open binary file) for a Gravatar URL, or None.
+
+    The open file stays readable if the blob is evicted while it is served. If the
+    blob was evicted since get_avatar() found it, the avatar is looked up once
+    more, which fetches it again."""
+    for _ in range(2):
+        avatar = get_avatar(url)
+        if avatar is None:
+            return None
+        try:
+            return avatar, open(avatar.path, "rb")
+        except FileNotFoundError:
+            app.logger.info("Avatar blob %s evicted before serving", avatar.digest)
+    return None
+
+
+def _scan_blobs():
+    """Returns (mtime, size, path) for every stored blob"""
+    blobs = []
+    for root, _, filenames in os.walk(os.path.join(_cache_dir(), "blobs")):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            blobs.append((stat.st_mtime, stat.st_size, path))
+    return blobs
+
+
+def _evict_if_needed(added_size):
+    """Removes the least recently served blobs once the blob store grows past
+    AVATARS.MAX_SIZE bytes. Index entries of evicted blobs are refetched on use.
+
+    The store size is tracked in memory and only rescanned from disk when it looks
+    too big, so other processes' writes are picked up at that point."""
+    global _estimated_size
+    max_size = _config("MAX_SIZE", DEFAULT_MAX_SIZE)
+    with _eviction_lock:
+        if _estimated_size is not None:
+            _estimated_size += added_size
+            if _estimated_size <= max_size:
+                return
+
+        blobs = _scan_blobs()
+        total_size = sum(size for _, size, _ in blobs)
+        if total_size > max_size:
+            # Evict down to 90%, so the next few writes do not rescan
+            target_size = max_size * 0.9
+            for _, size, path in sorted(blobs):
+                if total_size <= target_size:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total_size -= size
+        _estimated_size = total_size
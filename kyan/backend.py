@@ -8,8 +8,8 @@ import sqlalchemy
 from flask import current_app, request
 from werkzeug.utils import secure_filename
 
-from kyan import models, utils
-from kyan.extensions import db
+from kyan import bans, models, utils
+from kyan.extensions import cache, db
 
 app = current_app
 
@@ -56,16 +56,6 @@ class TorrentExtraValidationException(Exception):
         self.errors = errors
 
 
-@utils.cached_function
-def get_category_id_map():
-    cat_id_map = {}
-    for main_cat in models.MainCategory.query:
-        cat_id_map[main_cat.id_as_string] = [main_cat.name]
-        for sub_cat in main_cat.sub_categories:
-            cat_id_map[sub_cat.id_as_string] = [main_cat.name, sub_cat.name]
-    return cat_id_map
-
-
 def _replace_utf8_values(dict_or_list):
     did_change = False
     if isinstance(dict_or_list, dict):
@@ -119,40 +109,120 @@ def validate_torrent_post_upload(torrent, upload_form=None):
         raise TorrentExtraValidationException(errors)
 
 
-def check_uploader_ratelimit(user):
-    now = datetime.utcnow()
-    next_allowed_time = now
+def _recent_upload_keys(uploader_id, uploader_ip):
+    """Cache keys of the recent upload lists for an uploader, each with the filter
+    that rebuilds it from the torrents table"""
+    # IPv4 addresses read back from BINARY(16) columns are zero-padded
+    keys = [
+        (
+            "recent_uploads:ip:" + uploader_ip.ljust(16, b"\0").hex(),
+            models.Torrent.uploader_ip == uploader_ip,
+        )
+    ]
+    if uploader_id is not None:
+        keys.append(
+            (
+                "recent_uploads:user:{}".format(uploader_id),
+                models.Torrent.uploader_id == uploader_id,
+            )
+        )
+    return keys
 
-    Torrent = models.Torrent
 
-    def filter_uploader(query):
-        if user:
-            return query.filter(
-                sqlalchemy.or_(
-                    Torrent.user == user,
-                    Torrent.uploader_ip == ip_address(request.remote_addr).packed,
-                )
-            )
-        else:
-            return query.filter(
-                Torrent.uploader_ip == ip_address(request.remote_addr).packed
-            )
+def _recent_uploads_timeout():
+    return (
+        app.config["LIMITS"]["UPLOAD_BURST_DURATION"]
+        + app.config["LIMITS"]["UPLOAD_TIMEOUT"]
+    )
 
-    time_range_start = now - timedelta(
+
+def _get_recent_uploads(key, criterion, window_start):
+    """Returns the (created_time, torrent id) list for a key, newest last. A cold
+    cache entry is rebuilt from the torrents table once.
+
+    Entries are told apart by torrent id only: times rebuilt from the database
+    lose the microseconds that recorded uploads have."""
+    uploads = cache.get(key)
+    if uploads is None:
+        uploads = (
+            db.session.query(models.Torrent.created_time, models.Torrent.id)
+            .filter(criterion, models.Torrent.created_time >= window_start)
+            .order_by(models.Torrent.created_time)
+            .all()
+        )
+        uploads = [tuple(upload) for upload in uploads]
+        cache.set(key, uploads, timeout=_recent_uploads_timeout())
+    return [upload for upload in uploads if upload[0] >= window_start]
+
+
+def record_upload(upload, uploader_id, uploader_ip):
+    """Adds a (created_time, torrent id) upload to its uploader's recent upload
+    lists. Lists not in the cache are left alone; they are rebuilt when read.
+
+    The read-modify-write is not atomic, so of two uploads by one uploader
+    recorded at the same moment, one can be missed until the list expires and
+    is rebuilt. The lists are only shared between processes if CACHE.TYPE is a
+    shared cache; with the "simple" cache, each process enforces the limit on
+    the uploads it has seen, plus whatever was in the database when it built
+    the list."""
+    window_start = datetime.utcnow() - timedelta(
         seconds=app.config["LIMITS"]["UPLOAD_BURST_DURATION"]
     )
-    torrent_count_query = db.session.query(sqlalchemy.func.count(Torrent.id))
-    torrent_count = (
-        filter_uploader(torrent_count_query)
-        .filter(Torrent.created_time >= time_range_start)
-        .scalar()
+    for key, _ in _recent_upload_keys(uploader_id, uploader_ip):
+        uploads = cache.get(key)
+        if uploads is None:
+            continue
+        uploads = [recent for recent in uploads if recent[0] >= window_start]
+        if all(recent[1] != upload[1] for recent in uploads):
+            uploads.append(upload)
+        cache.set(key, uploads, timeout=_recent_uploads_timeout())
+
+
+def _unfinished_uploads(user, uploader_ip, window_start):
+    """Returns (created_time, pending upload id) for the uploader's queued and
+    processing async uploads, which count against the ratelimit until they are
+    done (and recorded as torrents) or have failed"""
+    PendingUpload = models.PendingUpload
+    uploader = PendingUpload.uploader_ip == uploader_ip
+    if user:
+        uploader = sqlalchemy.or_(uploader, PendingUpload.uploader_id == user.id)
+    query = db.session.query(PendingUpload.created_time, PendingUpload.id).filter(
+        uploader,
+        PendingUpload.status.in_(
+            [models.PendingUploadStatus.PENDING, models.PendingUploadStatus.PROCESSING]
+        ),
+        PendingUpload.created_time >= window_start,
     )
+    return query.all()
+
+
+def check_uploader_ratelimit(user):
+    """Returns (now, uploads in the last UPLOAD_BURST_DURATION, next allowed upload
+    time) for the user and request IP, from sliding windows kept in the cache"""
+    now = datetime.utcnow()
+    next_allowed_time = now
+
+    window_start = now - timedelta(
+        seconds=app.config["LIMITS"]["UPLOAD_BURST_DURATION"]
+    )
+    uploader_ip = ip_address(request.remote_addr).packed
+    # Upload id -> created_time, as an upload is often in both the user's and
+    # the IP's list
+    recent_uploads = {}
+    for key, criterion in _recent_upload_keys(user.id if user else None, uploader_ip):
+        for created_time, torrent_id in _get_recent_uploads(
+            key, criterion, window_start
+        ):
+            recent_uploads[torrent_id] = created_time
+    for created_time, pending_id in _unfinished_uploads(
+        user, uploader_ip, window_start
+    ):
+        recent_uploads[("pending", pending_id)] = created_time
+    torrent_count = len(recent_uploads)
 
     if torrent_count >= app.config["LIMITS"]["MAX_UPLOAD_BURST"]:
-        last_torrent = (
-            filter_uploader(Torrent.query).order_by(Torrent.created_time.desc()).first()
-        )
-        after_timeout = last_torrent.created_time + timedelta(
+        last_upload_time = max(recent_uploads.values())
+        after_timeout = last_upload_time + timedelta(
             seconds=app.config["LIMITS"]["UPLOAD_TIMEOUT"]
         )
 
@@ -162,14 +232,19 @@ def check_uploader_ratelimit(user):
     return now, torrent_count, next_allowed_time
 
 
-def handle_torrent_upload(upload_form, uploading_user=None, fromAPI=False):
-    torrent_data = upload_form.torrent_file.parsed_data
+def is_ratelimited_uploader(uploading_user):
+    """Returns whether uploads by the user (or an anonymous uploader) are ratelimited"""
     no_or_new_account = not uploading_user or (
         uploading_user.age < app.config["LIMITS"]["RATELIMIT_ACCOUNT_AGE"]
         and not uploading_user.is_trusted
     )
+    return app.config["LIMITS"]["RATELIMIT_UPLOADS"] and no_or_new_account
 
-    if app.config["LIMITS"]["RATELIMIT_UPLOADS"] and no_or_new_account:
+
+def check_upload_allowed(upload_form, uploading_user=None):
+    """Runs the ratelimit and anonymous upload checks, adding errors to the form
+    and raising TorrentExtraValidationException if the upload is not allowed."""
+    if is_ratelimited_uploader(uploading_user):
         now, torrent_count, next_time = check_uploader_ratelimit(uploading_user)
         if next_time > now:
             upload_form.ratelimit.errors = ["You've gone over the upload ratelimit."]
@@ -181,26 +256,85 @@ def handle_torrent_upload(upload_form, uploading_user=None, fromAPI=False):
                 app.config["RAID_MODE"]["UPLOADS_MESSAGE"]
             ]
             raise TorrentExtraValidationException()
-        elif models.RangeBan.is_rangebanned(ip_address(request.remote_addr).packed):
+        elif bans.is_rangebanned(ip_address(request.remote_addr).packed):
             upload_form.rangebanned.errors = [
                 "Your IP is banned from uploading anonymously."
             ]
             raise TorrentExtraValidationException()
 
+
+def get_upload_values(upload_form):
+    """Returns the user-supplied upload fields as a plain (JSON-able) dict"""
+    main_cat_id, sub_cat_id = upload_form.category.parsed_data.get_category_ids()
+    return {
+        "display_name": upload_form.display_name.data or "",
+        "information": upload_form.information.data or "",
+        "description": upload_form.description.data or "",
+        "category": [main_cat_id, sub_cat_id],
+        "anonymous": bool(upload_form.is_anonymous.data),
+        "hidden": bool(upload_form.is_hidden.data),
+        "remake": bool(upload_form.is_remake.data),
+        "complete": bool(upload_form.is_complete.data),
+        "trusted": bool(upload_form.is_trusted.data),
+        "comment_locked": bool(upload_form.is_comment_locked.data),
+    }
+
+
+def handle_torrent_upload(upload_form, uploading_user=None, fromAPI=False):
+    check_upload_allowed(upload_form, uploading_user)
+
+    torrent = create_torrent(
+        upload_form.torrent_file.parsed_data,
+        get_upload_values(upload_form),
+        uploading_user,
+        ip_address(request.remote_addr).packed,
+        upload_form,
+    )
+
+    torrent_file = upload_form.torrent_file.data
+    if app.config.get("BACKUP_TORRENT_FOLDER"):
+        torrent_file.seek(0, 0)
+        torrent_file.save(get_backup_torrent_path(torrent, torrent_file.filename))
+    torrent_file.close()
+    return torrent
+
+
+def get_backup_torrent_path(torrent, filename):
+    torrent_dir = app.config["BACKUP_TORRENT_FOLDER"]
+    os.makedirs(torrent_dir, exist_ok=True)
+    return os.path.join(
+        torrent_dir, "{}.{}".format(torrent.id, secure_filename(filename))
+    )
+
+
+def create_torrent(
+    torrent_data,
+    upload_values,
+    uploading_user,
+    uploader_ip,
+    upload_form=None,
+    commit=True,
+):
+    """Creates a Torrent (with its filelist, stats and trackers) from parsed torrent
+    data and the values returned by get_upload_values. With commit=False the
+    changes are only flushed, so several uploads can share one transaction."""
     if torrent_data.db_id is not None:
         old_torrent = models.Torrent.by_id(torrent_data.db_id)
         db.session.delete(old_torrent)
-        db.session.commit()
-        _delete_info_dict(old_torrent)
+        _delete_info_dict_after_commit(old_torrent)
+        if commit:
+            db.session.commit()
+        else:
+            db.session.flush()
 
     info_dict = torrent_data.torrent_dict["info"]
     changed_to_utf8 = _replace_utf8_values(torrent_data.torrent_dict)
     display_name = (
-        upload_form.display_name.data.strip()
+        upload_values["display_name"].strip()
         or info_dict["name"].decode("utf8").strip()
     )
-    information = (upload_form.information.data or "").strip()
-    description = (upload_form.description.data or "").strip()
+    information = upload_values["information"].strip()
+    description = upload_values["description"].strip()
     display_name = sanitize_string(display_name)
     information = sanitize_string(information)
     description = sanitize_string(description)
@@ -221,30 +355,23 @@ def handle_torrent_upload(upload_form, uploading_user=None, fromAPI=False):
         encoding=torrent_encoding,
         filesize=torrent_filesize,
         user=uploading_user,
-        uploader_ip=ip_address(request.remote_addr).packed,
+        uploader_ip=uploader_ip,
     )
-    info_dict_path = torrent.info_dict_path
-    info_dict_dir = os.path.dirname(info_dict_path)
-    os.makedirs(info_dict_dir, exist_ok=True)
-    with open(info_dict_path, "wb") as out_file:
-        out_file.write(torrent_data.bencoded_info_dict)
+    _write_info_dict_after_commit(torrent, torrent_data.bencoded_info_dict)
     torrent.stats = models.Statistic()
     torrent.has_torrent = True
     torrent.flags = 0
-    torrent.anonymous = upload_form.is_anonymous.data if uploading_user else True
-    torrent.hidden = upload_form.is_hidden.data
-    torrent.remake = upload_form.is_remake.data
-    torrent.complete = upload_form.is_complete.data
+    torrent.anonymous = upload_values["anonymous"] if uploading_user else True
+    torrent.hidden = upload_values["hidden"]
+    torrent.remake = upload_values["remake"]
+    torrent.complete = upload_values["complete"]
     can_mark_trusted = uploading_user and uploading_user.is_trusted
-    torrent.trusted = upload_form.is_trusted.data if can_mark_trusted else False
+    torrent.trusted = upload_values["trusted"] if can_mark_trusted else False
     can_mark_locked = uploading_user and uploading_user.is_moderator
     torrent.comment_locked = (
-        upload_form.is_comment_locked.data if can_mark_locked else False
+        upload_values["comment_locked"] if can_mark_locked else False
     )
-    (
-        torrent.main_category_id,
-        torrent.sub_category_id,
-    ) = upload_form.category.parsed_data.get_category_ids()
+    torrent.main_category_id, torrent.sub_category_id = upload_values["category"]
     torrent_filelist = info_dict.get("files")
     used_path_encoding = changed_to_utf8 and "utf-8" or torrent_encoding
     parsed_file_tree = dict()
@@ -307,22 +434,43 @@ def handle_torrent_upload(upload_form, uploading_user=None, fromAPI=False):
         db.session.add(torrent_tracker)
     validate_torrent_post_upload(torrent, upload_form)
     db.session.add(models.TrackerApi(torrent.info_hash, "insert"))
-    db.session.commit()
-    torrent_file = upload_form.torrent_file.data
-    if app.config.get("BACKUP_TORRENT_FOLDER"):
-        torrent_file.seek(0, 0)
-        torrent_dir = app.config["BACKUP_TORRENT_FOLDER"]
-        os.makedirs(torrent_dir, exist_ok=True)
-        torrent_path = os.path.join(
-            torrent_dir,
-            "{}.{}".format(torrent.id, secure_filename(torrent_file.filename)),
-        )
-        torrent_file.save(torrent_path)
-    torrent_file.close()
+    db.session.flush()
+
+    upload = (torrent.created_time, torrent.id)
+    uploader_id = uploading_user.id if uploading_user else None
+    utils.call_after_commit(
+        db.session,
+        ("record_upload", torrent.id),
+        lambda: record_upload(upload, uploader_id, uploader_ip),
+    )
+    if commit:
+        db.session.commit()
     return torrent
 
 
-def _delete_info_dict(torrent):
+def _write_info_dict_after_commit(torrent, bencoded_info_dict):
+    """Writes the info_dict file once the torrent is committed, so uploads that
+    fail or are rolled back leave no file behind"""
+    info_dict_path = torrent.info_dict_path
+
+    def write_info_dict():
+        os.makedirs(os.path.dirname(info_dict_path), exist_ok=True)
+        with open(info_dict_path, "wb") as out_file:
+            out_file.write(bencoded_info_dict)
+
+    # Same key as the delete, so replacing a deleted torrent only writes the file
+    utils.call_after_commit(
+        db.session, ("info_dict", info_dict_path), write_info_dict
+    )
+
+
+def _delete_info_dict_after_commit(torrent):
     info_dict_path = torrent.info_dict_path
-    if os.path.exists(info_dict_path):
-        os.remove(info_dict_path)
+
+    def delete_info_dict():
+        if os.path.exists(info_dict_path):
+            os.remove(info_dict_path)
+
+    utils.call_after_commit(
+        db.session, ("info_dict", info_dict_path), delete_info_dict
+    )
@@ -0,0 +1,190 @@
+import ipaddress
+import threading
+import time
+from datetime import datetime, timedelta
+
+import flask
+
+from kyan import models
+from kyan.extensions import db
+from kyan.utils import VersionedSnapshot
+
+app = flask.current_app
+
+# Range bans are also added by hand in the database, so reload them every so often
+DEFAULT_RANGE_BAN_MAX_AGE = 300
+DEFAULT_TEMP_DURATION = 604800
+DEFAULT_SWEEP_INTERVAL = 3600
+DEFAULT_SWEEP_BATCH_SIZE = 500
+
+_sweeper = None
+_sweeper_lock = threading.Lock()
+
+
+def _padded(ip):
+    """IPv4 addresses come back from BINARY(16) columns zero-padded to 16 bytes"""
+    return ip.ljust(16, b"\0")
+
+
+def _load_banned_ips():
+    query = db.session.query(models.Ban.user_ip).filter(models.Ban.user_ip.isnot(None))
+    return frozenset(_padded(user_ip) for user_ip, in query)
+
+
+banned_ips = VersionedSnapshot("banned_ips", _load_banned_ips)
+banned_ips.invalidate_on_commit(models.Ban)
+
+
+def is_ip_banned(ip):
+    """Returns whether the packed IP address has a Ban, without a database query"""
+    return _padded(ip) in banned_ips.get()
+
+
+class PrefixTrie(object):
+    """A binary trie of network prefixes. Each node is a [zero, one, values]
+    list, values holding what was inserted for the prefix ending there (or None);
+    a lookup walks at most `bits` nodes, whatever the number of prefixes."""
+
+    def __init__(self, bits):
+        self.bits = bits
+        self._root = [None, None, None]
+
+    def insert(self, network, value):
+        node = self._root
+        address = int(network.network_address)
+        for depth in range(network.prefixlen):
+            bit = (address >> (self.bits - 1 - depth)) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+        # Several bans may cover the same prefix
+        if node[2] is None:
+            node[2] = []
+        node[2].append(value)
+
+    def match(self, address):
+        """Returns every value inserted for a prefix containing the integer
+        address, shortest prefix first"""
+        node = self._root
+        depth = 0
+        while node is not None:
+            if node[2] is not None:
+                yield from node[2]
+            if depth == self.bits:
+                break
+            node = node[(address >> (self.bits - 1 - depth)) & 1]
+            depth += 1
+
+
+def _temp_duration():
+    return timedelta(
+        seconds=app.config.get("RANGEBANS", {}).get(
+            "TEMP_DURATION", DEFAULT_TEMP_DURATION
+        )
+    )
+
+
+def _load_range_bans():
+    tries = {4: PrefixTrie(32), 6: PrefixTrie(128)}
+    duration = _temp_duration()
+    for range_ban in models.RangeBan.query.filter_by(enabled=True):
+        network = ipaddress.ip_network(range_ban.cidr_string, strict=False)
+        expires = range_ban.temp + duration if range_ban.temp else datetime.max
+        tries[network.version].insert(network, expires)
+    return tries
+
+
+range_bans = VersionedSnapshot(
+    "range_bans", _load_range_bans, max_age=DEFAULT_RANGE_BAN_MAX_AGE
+)
+range_bans.invalidate_on_commit(models.RangeBan)
+
+
+def is_rangebanned(ip):
+    """Returns whether the packed IP address falls in an enabled RangeBan, without
+    a database query. Temporary bans older than RANGEBANS.TEMP_DURATION are
+    ignored, whether or not the sweeper has disabled them yet."""
+    if isinstance(ip, bytes) and len(ip) == 4:
+        address = ipaddress.IPv4Address(ip)
+    elif isinstance(ip, bytes) and len(ip) == 16:
+        address = ipaddress.IPv6Address(ip)
+        if address.ipv4_mapped:
+            address = address.ipv4_mapped
+    else:
+        raise ValueError("Invalid IP address format")
+
+    _start_sweeper()
+    trie = range_bans.get()[address.version]
+    now = datetime.utcnow()
+    return any(expires > now for expires in trie.match(int(address)))
+
+
+def sweep_expired_range_bans():
+    """Disables enabled temporary range bans that are past TEMP_DURATION, in
+    batches of RANGEBANS.SWEEP_BATCH_SIZE. Returns the number disabled."""
+    batch_size = app.config.get("RANGEBANS", {}).get(
+        "SWEEP_BATCH_SIZE", DEFAULT_SWEEP_BATCH_SIZE
+    )
+    cutoff = datetime.utcnow() - _temp_duration()
+
+    disabled = 0
+    while True:
+        expired_ids = [
+            range_ban_id
+            for range_ban_id, in db.session.query(models.RangeBan.id)
+            .filter(
+                models.RangeBan.enabled,
+                models.RangeBan.temp.isnot(None),
+                models.RangeBan.temp < cutoff,
+            )
+            .limit(batch_size)
+        ]
+        if not expired_ids:
+            break
+
+        models.RangeBan.query.filter(models.RangeBan.id.in_(expired_ids)).update(
+            {"enabled": False}, synchronize_session=False
+        )
+        db.session.commit()
+        disabled += len(expired_ids)
+        if len(expired_ids) < batch_size:
+            break
+
+    # Bulk updates skip the ORM events, so bump the version by hand
+    if disabled:
+        range_bans.invalidate()
+    return disabled
+
+
+def _sweep_forever(flask_app):
+    interval = flask_app.config.get("RANGEBANS", {}).get(
+        "SWEEP_INTERVAL", DEFAULT_SWEEP_INTERVAL
+    )
+    while True:
+        with flask_app.app_context():
+            try:
+                disabled = sweep_expired_range_bans()
+                if disabled:
+                    flask_app.logger.info("Disabled %d expired range bans", disabled)
+            except Exception:
+                flask_app.logger.exception("Sweeping expired range bans failed")
+                db.session.rollback()
+            finally:
+                db.session.remove()
+        time.sleep(interval)
+
+
+def _start_sweeper():
+    """Starts the expired range ban sweeper thread on first use"""
+    global _sweeper
+    if _sweeper is not None:
+        return
+    with _sweeper_lock:
+        if _sweeper is None:
+            _sweeper = threading.Thread(
+                target=_sweep_forever,
+                args=(app._get_current_object(),),
+                name="kyan-rangeban-sweeper",
+                daemon=True,
+            )
+            _sweeper.start()
@@ -0,0 +1,114 @@
+import re
+from collections import deque
+
+import flask
+
+app = flask.current_app
+
+
+class SubstringMatcher(object):
+    """Aho-Corasick automaton over a set of needles. search() walks the text once,
+    so its cost depends on the text length, not on the number of needles."""
+
+    def __init__(self, needles):
+        self._goto = [{}]
+        self._fail = [0]
+        self._match = [False]
+
+        for needle in needles:
+            if not needle:
+                continue
+            state = 0
+            for char in needle:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][char] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._match.append(False)
+                state = next_state
+            self._match[state] = True
+
+        # Breadth-first, so fail links always point at already finished states
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                if self._match[self._fail[next_state]]:
+                    self._match[next_state] = True
+
+    def search(self, text):
+        """Returns whether any needle occurs in text"""
+        goto = self._goto
+        fail = self._fail
+        match = self._match
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if match[state]:
+                return True
+        return False
+
+
+class EmailBlacklist(object):
+    """Matches emails against GENERAL.EMAIL_BLACKLIST and
+    GENERAL.EMAIL_DOMAIN_BLACKLIST, compiled once.
+
+    EMAIL_BLACKLIST strings match anywhere in the lowercased email, and compiled
+    re.Pattern entries are searched as before. EMAIL_DOMAIN_BLACKLIST entries
+    match the email's domain and all of its subdomains."""
+
+    def __init__(self, email_blacklist=(), domain_blacklist=()):
+        substrings = []
+        patterns = []
+        for item in email_blacklist:
+            if isinstance(item, re.Pattern):
+                patterns.append(item)
+            elif isinstance(item, str):
+                substrings.append(item)
+            else:
+                raise Exception(
+                    "Unexpected email validator type {!r} ({!r})".format(
+                        type(item), item
+                    )
+                )
+        self._substrings = SubstringMatcher(substrings)
+        self._patterns = patterns
+        self._domains = frozenset(
+            domain.lower().strip(".") for domain in domain_blacklist
+        )
+
+    def _domain_blacklisted(self, domain):
+        labels = domain.split(".")
+        return any(".".join(labels[i:]) in self._domains for i in range(len(labels)))
+
+    def is_blacklisted(self, email):
+        email = email.strip()
+        if self._domains and self._domain_blacklisted(
+            email.rsplit("@", 1)[-1].lower().rstrip(".")
+        ):
+            return True
+        if self._substrings.search(email.lower()):
+            return True
+        return any(pattern.search(email) for pattern in self._patterns)
+
+
+def build_email_blacklist(flask_app):
+    """Compiles the email blacklists from the config into flask_app.extensions"""
+    general_config = flask_app.config["GENERAL"]
+    flask_app.extensions["kyan_email_blacklist"] = EmailBlacklist(
+        general_config.get("EMAIL_BLACKLIST", []),
+        general_config.get("EMAIL_DOMAIN_BLACKLIST", []),
+    )
+
+
+def get_email_blacklist():
+    return app.extensions["kyan_email_blacklist"]
@@ -0,0 +1,48 @@
+from kyan import models
+from kyan.extensions import db
+
+KYAN_CATEGORIES = [
+    (
+        "Anime",
+        [
+            "Anime Music Video",
+            "English-translated",
+            "Non-English-translated",
+            "Raw",
+        ],
+    ),
+    ("Audio", ["Lossless", "Lossy"]),
+    ("Literature", ["English-translated", "Non-English-translated", "Raw"]),
+    (
+        "Live Action",
+        [
+            "English-translated",
+            "Idol/Promotional Video",
+            "Non-English-translated",
+            "Raw",
+        ],
+    ),
+    ("Pictures", ["Graphics", "Photos"]),
+    ("Software", ["Applications", "Games"]),
+]
+
+
+def add_categories(categories, main_class, sub_class):
+    for main_cat_name, sub_cat_names in categories:
+        main_cat = main_class(name=main_cat_name)
+        for i, sub_cat_name in enumerate(sub_cat_names):
+            # Composite keys can't autoincrement, set sub_cat id manually (1-index)
+            sub_class(id=i + 1, name=sub_cat_name, main_category=main_cat)
+        db.session.add(main_cat)
+
+
+def bootstrap_database():
+    """Creates missing tables and seeds the categories if there are none.
+    Returns whether categories were added."""
+    db.create_all()
+
+    if models.MainCategory.query.first():
+        return False
+    add_categories(KYAN_CATEGORIES, models.MainCategory, models.SubCategory)
+    db.session.commit()
+    return True
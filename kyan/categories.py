@@ -0,0 +1,112 @@
+import re
+from collections import namedtuple
+
+import flask
+
+from kyan import models
+from kyan.extensions import db
+from kyan.utils import VersionedSnapshot
+
+app = flask.current_app
+
+CATEGORY_ID_RE = re.compile(r"^(\d+)_(\d+)$")
+
+
+class Category(namedtuple("Category", ["main_id", "sub_id", "names"])):
+    """A main (sub_id 0) or sub category, as stored in the registry"""
+
+    __slots__ = ()
+
+    def get_category_ids(self):
+        return (self.main_id, self.sub_id)
+
+    @property
+    def id_as_string(self):
+        return "{}_{}".format(self.main_id, self.sub_id)
+
+    @property
+    def is_main(self):
+        return self.sub_id == 0
+
+    @property
+    def name(self):
+        """Full name, eg. Anime - English-translated"""
+        return " - ".join(self.names)
+
+
+class CategoryRegistry(object):
+    """Every main and sub category, indexed by ids, id string and full name"""
+
+    def __init__(self, categories):
+        self._by_ids = {}
+        self._by_string = {}
+        self._by_name = {}
+        for category in categories:
+            self._by_ids[category.get_category_ids()] = category
+            self._by_string[category.id_as_string] = category
+            self._by_name[category.name] = category
+
+        # (id, name, is_main_cat) for upload/edit forms, in id string order
+        self.choices = [("", "[Select a category]")] + [
+            (key, self._by_string[key].name, self._by_string[key].is_main)
+            for key in sorted(self._by_string)
+        ]
+
+    def __iter__(self):
+        return iter(self._by_ids.values())
+
+    def by_ids(self, main_cat_id, sub_cat_id):
+        return self._by_ids.get((main_cat_id, sub_cat_id))
+
+    def by_string(self, id_string):
+        return self._by_string.get(id_string)
+
+    def by_name(self, name):
+        return self._by_name.get(name)
+
+    def parse(self, id_string):
+        """Returns (main_cat_id, sub_cat_id) for a category id string such as the
+        c= search parameter. "0_0" means all categories. Raises ValueError if the
+        string is malformed or names a category that does not exist."""
+        cat_match = CATEGORY_ID_RE.match(id_string)
+        if not cat_match:
+            raise ValueError("Malformed category id: " + id_string)
+        cat_ids = tuple(int(x) for x in cat_match.groups())
+        if cat_ids != (0, 0) and cat_ids not in self._by_ids:
+            raise ValueError("Unknown category: " + id_string)
+        return cat_ids
+
+    def name_of(self, id_string, default="???"):
+        category = self._by_string.get(id_string)
+        return category.name if category else default
+
+
+def _load_registry():
+    main_names = dict(
+        db.session.query(models.MainCategory.id, models.MainCategory.name)
+    )
+    categories = [
+        Category(main_id, 0, (main_name,)) for main_id, main_name in main_names.items()
+    ]
+    sub_query = db.session.query(
+        models.SubCategory.main_category_id,
+        models.SubCategory.id,
+        models.SubCategory.name,
+    )
+    for main_id, sub_id, sub_name in sub_query:
+        if main_id not in main_names:
+            app.logger.warning(
+                "Skipping sub category %d_%d: main category missing", main_id, sub_id
+            )
+            continue
+        categories.append(Category(main_id, sub_id, (main_names[main_id], sub_name)))
+    return CategoryRegistry(categories)
+
+
+registry = VersionedSnapshot("categories", _load_registry)
+registry.invalidate_on_commit(models.MainCategory, models.SubCategory)
+
+
+def get_registry():
+    """Returns the CategoryRegistry, without a database query once loaded"""
+    return registry.get()
@@ -0,0 +1,173 @@
+import json
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from kyan import bootstrap, email, export, jobs, models, moderation, stats
+from kyan.extensions import db
+from kyan.utils import lazy_module
+
+# Only `flask tracker sync` needs it, and it imports requests
+_tracker_sync = lazy_module("kyan.tracker_sync")
+
+stats_cli = AppGroup("stats", help="Torrent statistics.")
+tracker_cli = AppGroup("tracker", help="Tracker API synchronisation.")
+moderation_cli = AppGroup("moderation", help="Bulk moderation.")
+jobs_cli = AppGroup("jobs", help="Background jobs.")
+email_cli = AppGroup("email", help="Outgoing email.")
+db_cli = AppGroup("db", help="Database schema and seed data.")
+export_cli = AppGroup("export", help="Catalogue dumps.")
+
+
+@stats_cli.command("ingest")
+@click.argument("input_file", type=click.File("rb"), default="-")
+@click.option(
+    "--format",
+    "input_format",
+    type=click.Choice(["jsonl", "binary"]),
+    default="jsonl",
+    help="JSON lines, or fixed-size (info_hash, seeders, leechers, completed) "
+    "records of 20 bytes and three big-endian uint32s.",
+)
+@click.option("--batch-size", type=int, default=None, help="Records per upsert.")
+def ingest_stats(input_file, input_format, batch_size):
+    """Load (info_hash, seeders, leechers, completed) records into statistics."""
+    if input_format == "binary":
+        records = stats.read_binary_records(input_file)
+    else:
+        records = stats.read_json_lines(input_file)
+    counts = stats.ingest(records, batch_size)
+    counts["written"] = stats.buffer.flush()
+    click.echo(json.dumps(counts))
+
+
+@tracker_cli.command("sync")
+@click.option("--once", is_flag=True, help="Exit once the queue is empty.")
+def sync_tracker(once):
+    """Push queued torrent inserts and removals to the tracker API."""
+    synced = _tracker_sync().run(once=once)
+    click.echo("Synced {} tracker API rows".format(synced))
+
+
+def _get_user(username):
+    user = models.User.by_username(username)
+    if not user:
+        raise click.BadParameter("No user named {}".format(username))
+    return user
+
+
+def _nuke(nuke, what, username, admin_name):
+    user = _get_user(username)
+    admin = _get_user(admin_name)
+    if not admin.is_moderator:
+        raise click.BadParameter("{} is not a moderator".format(admin_name))
+
+    count = nuke(user.id)
+    if count > 0:
+        # The admin log links to the user page
+        with current_app.test_request_context():
+            moderation.log_nuke(user, admin, count, what)
+    db.session.commit()
+    click.echo("Nuked {} {} of {}".format(count, what, user.username))
+
+
+@moderation_cli.command("nuke-torrents")
+@click.argument("username")
+@click.option("--admin", required=True, help="Moderator the admin log names.")
+def nuke_torrents(username, admin):
+    """Delete and ban every torrent uploaded by a user."""
+    _nuke(moderation.nuke_torrents, "torrents", username, admin)
+
+
+@moderation_cli.command("nuke-comments")
+@click.argument("username")
+@click.option("--admin", required=True, help="Moderator the admin log names.")
+def nuke_comments(username, admin):
+    """Delete every comment by a user."""
+    _nuke(moderation.nuke_comments, "comments", username, admin)
+
+
+@jobs_cli.command("worker")
+@click.option("--once", is_flag=True, help="Exit once the queue is empty.")
+def jobs_worker(once):
+    """Run queued nukes, report resolutions and decision emails."""
+    ran = jobs.run_worker(once=once)
+    click.echo("Ran {} jobs".format(ran))
+
+
+@email_cli.command("worker")
+@click.option("--once", is_flag=True, help="Exit once the outbox is empty.")
+def email_worker(once):
+    """Send queued emails."""
+    sent, failed = email.run_worker(once=once)
+    click.echo("Sent {} emails, {} failed attempts".format(sent, failed))
+
+
+@email_cli.command("status")
+def email_status():
+    """Show outbox delivery metrics."""
+    click.echo(json.dumps(email.outbox_metrics()))
+
+
+@db_cli.command("bootstrap")
+def bootstrap_db():
+    """Create missing tables and seed the categories."""
+    seeded = bootstrap.bootstrap_database()
+    click.echo("Database ready" + (", categories added" if seeded else ""))
+
+
+@export_cli.command("catalogue")
+@click.argument("output_file", type=click.File("wb"), default="-")
+@click.option(
+    "--format",
+    "output_format",
+    type=click.Choice(export.FORMATS),
+    default="jsonl",
+    help="JSON lines or CSV with a header row.",
+)
+@click.option("--gzip", "compress", is_flag=True, help="Gzip the output.")
+@click.option("--since-id", type=int, default=None, help="Only torrents after this id.")
+@click.option(
+    "--since-updated",
+    type=click.DateTime(),
+    default=None,
+    help="Only torrents updated after this UTC time, in updated_time order.",
+)
+@click.option(
+    "--include-hidden",
+    is_flag=True,
+    help="Include hidden torrents, and the hashes of deleted ones.",
+)
+@click.option("--batch-size", type=int, default=None, help="Rows per batch.")
+def export_catalogue(
+    output_file,
+    output_format,
+    compress,
+    since_id,
+    since_updated,
+    include_hidden,
+    batch_size,
+):
+    """Write the torrent catalogue (id, hash, name, category, size, stats,
+    times) to OUTPUT_FILE or stdout."""
+    for chunk in export.export_chunks(
+        output_format,
+        compress,
+        since_id=since_id,
+        since_updated=since_updated,
+        include_hidden=include_hidden,
+        batch_size=batch_size,
+    ):
+        output_file.write(chunk)
+
+
+def register_commands(flask_app):
+    """Register the CLI command groups using the flask_app object"""
+    flask_app.cli.add_command(stats_cli)
+    flask_app.cli.add_command(tracker_cli)
+    flask_app.cli.add_command(moderation_cli)
+    flask_app.cli.add_command(jobs_cli)
+    flask_app.cli.add_command(email_cli)
+    flask_app.cli.add_command(db_cli)
+    flask_app.cli.add_command(export_cli)
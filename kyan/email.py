@@ -1,11 +1,39 @@
-import smtplib
+import time
+from datetime import datetime, timedelta
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
-import requests
+import sqlalchemy
 from flask import current_app as app
 
 from kyan import models
+from kyan.extensions import db
+from kyan.utils import lazy_module
+
+DEFAULT_BATCH_SIZE = 50
+DEFAULT_MAX_ATTEMPTS = 6
+DEFAULT_RETRY_BACKOFF = 60
+DEFAULT_POLL_INTERVAL = 5
+DEFAULT_TIMEOUT = 30
+DEFAULT_SEND_LEASE = 300
+
+# Only the outbox worker (or EMAIL.QUEUE: false) sends, web workers just queue
+_requests = lazy_module("requests")
+_smtplib = lazy_module("smtplib")
+
+
+class EmailError(Exception):
+    pass
+
+
+def send_errors():
+    """Exceptions that mean one email failed to send"""
+    return (
+        EmailError,
+        _requests().RequestException,
+        _smtplib().SMTPException,
+        OSError,
+    )
 
 
 class EmailHolder(object):
@@ -28,7 +56,7 @@ class EmailHolder(object):
         if isinstance(self.recipient, models.User):
             return self.recipient.email
         else:
-            return self.recipient.email
+            return self.recipient
 
     def as_mimemultipart(self):
         msg = MIMEMultipart()
@@ -43,49 +71,267 @@ class EmailHolder(object):
         return msg
 
 
-def send_email(email_holder):
+def _email_config(key, default):
+    return app.config["EMAIL"].get(key, default)
+
+
+def send_email(email_holder, commit=False):
+    """Queues the email in the outbox for `flask email worker`, as part of the
+    caller's transaction unless commit=True. With EMAIL.QUEUE set to false it is
+    sent right away instead."""
+    if not _email_config("QUEUE", True):
+        transport = create_transport()
+        if transport:
+            try:
+                transport.send(
+                    email_holder.format_recipient(),
+                    email_holder.recipient_email(),
+                    email_holder,
+                )
+            finally:
+                transport.close()
+        return
+
+    db.session.add(
+        models.OutboxEmail(
+            recipient=email_holder.format_recipient(),
+            recipient_email=email_holder.recipient_email(),
+            subject=email_holder.subject,
+            text=email_holder.text,
+            html=email_holder.html,
+        )
+    )
+    if commit:
+        db.session.commit()
+
+
+class MailgunTransport(object):
+    """Sends through the Mailgun API over one pooled requests session"""
+
+    def __init__(self):
+        self._session = _requests().Session()
+        self._session.auth = ("api", app.config["EMAIL"]["MAILGUN"]["API_KEY"])
+
+    def send(self, recipient, recipient_email, email_holder):
+        mailgun_endpoint = app.config["EMAIL"]["MAILGUN"]["API_BASE"] + "/messages"
+        data = {
+            "from": app.config["EMAIL"]["FROM_ADDRESS"],
+            "to": recipient,
+            "subject": email_holder.subject,
+            "text": email_holder.text,
+            "html": email_holder.html,
+        }
+        r = self._session.post(
+            mailgun_endpoint,
+            data=data,
+            timeout=_email_config("TIMEOUT", DEFAULT_TIMEOUT),
+        )
+        if r.status_code != 200:
+            raise EmailError("Mailgun returned HTTP {}".format(r.status_code))
+
+    def close(self):
+        self._session.close()
+
+
+class SMTPTransport(object):
+    """Sends over one SMTP connection, opened (STARTTLS and login) on first use
+    and reopened if the server drops it"""
+
+    def __init__(self):
+        self._server = None
+
+    def _connect(self):
+        smtp_config = app.config["EMAIL"]["SMTP"]
+        server = _smtplib().SMTP(
+            smtp_config["SERVER"],
+            smtp_config["PORT"],
+            timeout=_email_config("TIMEOUT", DEFAULT_TIMEOUT),
+        )
+        server.ehlo()
+        server.starttls()
+        server.ehlo()
+        server.login(smtp_config["USERNAME"], smtp_config["PASSWORD"])
+        return server
+
+    def send(self, recipient, recipient_email, email_holder):
+        msg = email_holder.as_mimemultipart()
+        for attempt in range(2):
+            if self._server is None:
+                self._server = self._connect()
+            try:
+                self._server.sendmail(
+                    app.config["EMAIL"]["SMTP"]["USERNAME"],
+                    recipient_email,
+                    msg.as_string(),
+                )
+                return
+            except _smtplib().SMTPServerDisconnected:
+                # Idle connections time out, retry once on a fresh one
+                self._server = None
+                if attempt:
+                    raise
+
+    def close(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except _smtplib().SMTPException:
+                pass
+            self._server = None
+
+
+def create_transport():
     mail_backend = app.config["EMAIL"]["BACKEND"]
     if mail_backend == "mailgun":
-        _send_mailgun(email_holder)
+        return MailgunTransport()
     elif mail_backend == "smtp":
-        _send_smtp(email_holder)
+        return SMTPTransport()
     elif mail_backend:
-        # TODO: Do this in logging.error when we have that set up
-        print("Unknown mail backend:", mail_backend)
-
-
-def _send_mailgun(email_holder):
-    mailgun_endpoint = app.config["EMAIL"]["MAILGUN"]["API_BASE"] + "/messages"
-    auth = ("api", app.config["EMAIL"]["MAILGUN"]["API_KEY"])
-    data = {
-        "from": app.config["EMAIL"]["FROM_ADDRESS"],
-        "to": email_holder.format_recipient(),
-        "subject": email_holder.subject,
-        "text": email_holder.text,
-        "html": email_holder.html,
-    }
-    r = requests.post(mailgun_endpoint, data=data, auth=auth)
-    # TODO real error handling?
-    assert r.status_code == 200
+        app.logger.error("Unknown mail backend: %s", mail_backend)
+    return None
+
+
+def _claim_batch():
+    """Claims up to EMAIL.BATCH_SIZE due emails, skipping ones another worker has
+    locked, and commits. Claimed emails are marked SENDING and counted as an
+    attempt, with a lease of EMAIL.SEND_LEASE seconds in next_attempt_time; if
+    the worker dies, they are claimed again once it runs out. Only this short
+    transaction holds locks on the outbox, not the sending."""
+    OutboxEmail = models.OutboxEmail
+    now = datetime.utcnow()
+    batch = (
+        db.session.query(
+            OutboxEmail.id,
+            OutboxEmail.recipient,
+            OutboxEmail.recipient_email,
+            OutboxEmail.subject,
+            OutboxEmail.text,
+            OutboxEmail.html,
+            OutboxEmail.attempts,
+        )
+        .filter(
+            OutboxEmail.status.in_(
+                [models.OutboxEmailStatus.QUEUED, models.OutboxEmailStatus.SENDING]
+            ),
+            OutboxEmail.next_attempt_time <= now,
+        )
+        .order_by(OutboxEmail.next_attempt_time)
+        .limit(_email_config("BATCH_SIZE", DEFAULT_BATCH_SIZE))
+        .with_for_update(skip_locked=True)
+        .all()
+    )
+    if batch:
+        lease = timedelta(seconds=_email_config("SEND_LEASE", DEFAULT_SEND_LEASE))
+        OutboxEmail.query.filter(OutboxEmail.id.in_([row.id for row in batch])).update(
+            {
+                "status": models.OutboxEmailStatus.SENDING,
+                "attempts": OutboxEmail.attempts + 1,
+                "next_attempt_time": now + lease,
+            },
+            synchronize_session=False,
+        )
+    db.session.commit()
+    return batch
 
 
-def _send_smtp(email_holder):
-    # NOTE: Unused, most likely untested! Should work, however.
-    msg = email_holder.as_mimemultipart()
+def _record_result(outbox_id, values):
+    """Stores one email's outcome in its own transaction"""
+    models.OutboxEmail.query.filter_by(
+        id=outbox_id, status=models.OutboxEmailStatus.SENDING
+    ).update(values, synchronize_session=False)
+    db.session.commit()
 
-    server = smtplib.SMTP(
-        app.config["EMAIL"]["SMTP"]["SERVER"], app.config["EMAIL"]["SMTP"]["PORT"]
+
+def send_batch(transport):
+    """Sends one batch of due outbox emails. Failed emails are retried after
+    EMAIL.RETRY_BACKOFF seconds, doubled per attempt, and marked failed after
+    EMAIL.MAX_ATTEMPTS. Returns (sent, failed) counts."""
+    max_attempts = _email_config("MAX_ATTEMPTS", DEFAULT_MAX_ATTEMPTS)
+    backoff = _email_config("RETRY_BACKOFF", DEFAULT_RETRY_BACKOFF)
+
+    errors = send_errors()
+    sent = failed = 0
+    for outbox_email in _claim_batch():
+        email_holder = EmailHolder(
+            subject=outbox_email.subject,
+            recipient=outbox_email.recipient,
+            text=outbox_email.text,
+            html=outbox_email.html,
+        )
+        attempts = outbox_email.attempts + 1
+        try:
+            transport.send(
+                outbox_email.recipient, outbox_email.recipient_email, email_holder
+            )
+        except errors as e:
+            failed += 1
+            values = {"last_error": str(e)[:1024]}
+            if attempts >= max_attempts:
+                values["status"] = models.OutboxEmailStatus.FAILED
+            else:
+                delay = backoff * 2 ** (attempts - 1)
+                values["status"] = models.OutboxEmailStatus.QUEUED
+                values["next_attempt_time"] = datetime.utcnow() + timedelta(
+                    seconds=delay
+                )
+        else:
+            sent += 1
+            values = {
+                "status": models.OutboxEmailStatus.SENT,
+                "sent_time": datetime.utcnow(),
+            }
+        _record_result(outbox_email.id, values)
+    return sent, failed
+
+
+def run_worker(once=False):
+    """Sends queued emails over one reused transport, then (unless once) keeps
+    polling every EMAIL.POLL_INTERVAL seconds. The transport is closed whenever the
+    outbox runs dry. Returns the total (sent, failed) counts."""
+    poll_interval = _email_config("POLL_INTERVAL", DEFAULT_POLL_INTERVAL)
+    total_sent = total_failed = 0
+    transport = None
+    while True:
+        if transport is None:
+            transport = create_transport()
+            if transport is None:
+                return total_sent, total_failed
+        try:
+            sent, failed = send_batch(transport)
+        finally:
+            db.session.remove()
+
+        total_sent += sent
+        total_failed += failed
+        if sent or failed:
+            app.logger.info("Outbox: sent %d, failed %d", sent, failed)
+        else:
+            transport.close()
+            transport = None
+            if once:
+                return total_sent, total_failed
+            time.sleep(poll_interval)
+
+
+def outbox_metrics():
+    """Returns outbox counts by status and the age in seconds of the oldest
+    queued email"""
+    OutboxEmail = models.OutboxEmail
+    counts = dict(
+        db.session.query(OutboxEmail.status, sqlalchemy.func.count(OutboxEmail.id))
+        .group_by(OutboxEmail.status)
+        .all()
     )
-    server.set_debuglevel(1)
-    server.ehlo()
-    server.starttls()
-    server.ehlo()
-    server.login(
-        app.config["EMAIL"]["SMTP"]["USERNAME"], app.config["EMAIL"]["SMTP"]["PASSWORD"]
+    oldest_queued = (
+        db.session.query(sqlalchemy.func.min(OutboxEmail.created_time))
+        .filter(OutboxEmail.status == models.OutboxEmailStatus.QUEUED)
+        .scalar()
     )
-    server.sendmail(
-        app.config["EMAIL"]["SMTP"]["USERNAME"],
-        email_holder.recipient_email(),
-        msg.as_string(),
+    metrics = {
+        status.name.lower(): counts.get(status, 0)
+        for status in models.OutboxEmailStatus
+    }
+    metrics["oldest_queued_age"] = (
+        (datetime.utcnow() - oldest_queued).total_seconds() if oldest_queued else 0
     )
-    server.quit()
+    return metrics
@@ -0,0 +1,185 @@
+import csv
+import io
+import json
+import zlib
+
+import sqlalchemy
+from flask import current_app as app
+
+from kyan import categories, models
+from kyan.extensions import db
+
+DEFAULT_BATCH_SIZE = 5000
+CHUNK_SIZE = 64 * 1024
+FORMATS = ("jsonl", "csv")
+
+FIELDS = (
+    "id",
+    "hash",
+    "name",
+    "category",
+    "category_name",
+    "size",
+    "seeders",
+    "leechers",
+    "downloads",
+    "created",
+    "updated",
+    "deleted",
+)
+
+
+def _select_batch(after, since_updated, batch_size):
+    Torrent = models.Torrent
+    Statistic = models.Statistic
+    query = (
+        sqlalchemy.select(
+            Torrent.id,
+            Torrent.info_hash,
+            Torrent.display_name,
+            Torrent.main_category_id,
+            Torrent.sub_category_id,
+            Torrent.filesize,
+            Torrent.flags,
+            Torrent.created_time,
+            Torrent.updated_time,
+            Statistic.seed_count,
+            Statistic.leech_count,
+            Statistic.download_count,
+        )
+        .outerjoin(Statistic, Statistic.torrent_id == Torrent.id)
+        .limit(batch_size)
+        .execution_options(yield_per=batch_size)
+    )
+    # Keyset pagination: every batch starts after the last row of the previous one
+    if since_updated is None:
+        return query.where(Torrent.id > after).order_by(Torrent.id)
+    updated_time, torrent_id = after
+    return query.where(
+        sqlalchemy.or_(
+            Torrent.updated_time > updated_time,
+            sqlalchemy.and_(
+                Torrent.updated_time == updated_time, Torrent.id > torrent_id
+            ),
+        )
+    ).order_by(Torrent.updated_time, Torrent.id)
+
+
+def _record(row, registry, include_hidden):
+    flags = models.TorrentFlags
+    record = dict.fromkeys(FIELDS)
+    deleted = bool(row.flags & (flags.DELETED | flags.BANNED))
+    if not include_hidden and (deleted or row.flags & flags.HIDDEN):
+        # Only the id, so mirrors can drop the torrent without learning its hash
+        record.update(id=row.id, deleted=True)
+        return record
+
+    record.update(id=row.id, hash=row.info_hash.hex(), deleted=deleted)
+    if deleted:
+        # Deleted torrents are only listed so mirrors can drop them
+        return record
+
+    cat_id = "{}_{}".format(row.main_category_id, row.sub_category_id)
+    record.update(
+        name=row.display_name,
+        category=cat_id,
+        category_name=registry.name_of(cat_id),
+        size=row.filesize,
+        seeders=row.seed_count or 0,
+        leechers=row.leech_count or 0,
+        downloads=row.download_count or 0,
+        created=row.created_time.isoformat(),
+        updated=row.updated_time.isoformat(),
+    )
+    return record
+
+
+def iter_records(
+    since_id=None, since_updated=None, include_hidden=False, batch_size=None
+):
+    """Yields one dict per torrent (see FIELDS), in id order, or in updated_time
+    order with since_updated. Only torrents with an id above since_id, or updated
+    after since_updated, are included. Deleted and banned torrents are included
+    with only their id and hash, so incremental exports can remove them. Without
+    include_hidden (only moderators get it), hidden, deleted and banned torrents
+    are all reduced to their id and deleted=True.
+
+    Rows are read in keyset batches of EXPORT.BATCH_SIZE through a server-side
+    cursor, so memory use does not depend on the size of the catalogue. Seeder
+    and leecher counts are as of the export; they do not mark a torrent updated."""
+    if batch_size is None:
+        batch_size = app.config.get("EXPORT", {}).get("BATCH_SIZE", DEFAULT_BATCH_SIZE)
+    registry = categories.get_registry()
+
+    if since_updated is None:
+        after = since_id or 0
+    else:
+        after = (since_updated, since_id or 0)
+
+    while True:
+        statement = _select_batch(after, since_updated, batch_size)
+        count = 0
+        for row in db.session.execute(statement):
+            count += 1
+            after = row.id if since_updated is None else (row.updated_time, row.id)
+            yield _record(row, registry, include_hidden)
+        # End the transaction between batches, so a long export does not keep an
+        # old snapshot (and its connection) open
+        db.session.commit()
+        if count < batch_size:
+            return
+
+
+def jsonl_lines(records):
+    for record in records:
+        yield json.dumps(record) + "\n"
+
+
+def csv_lines(records):
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, FIELDS, lineterminator="\n")
+    writer.writeheader()
+    for record in records:
+        writer.writerow(record)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    # The header, if there were no records
+    if buf.getvalue():
+        yield buf.getvalue()
+
+
+def gzip_chunks(chunks, level=6):
+    """Compresses a stream of bytes into one gzip stream"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _joined(lines):
+    """Encodes lines and joins them into chunks of about CHUNK_SIZE bytes"""
+    parts = []
+    size = 0
+    for line in lines:
+        data = line.encode("utf-8")
+        parts.append(data)
+        size += len(data)
+        if size >= CHUNK_SIZE:
+            yield b"".join(parts)
+            parts = []
+            size = 0
+    if parts:
+        yield b"".join(parts)
+
+
+def export_chunks(output_format="jsonl", compress=False, **kwargs):
+    """Yields the export as bytes, in the given format (one of FORMATS),
+    gzipped if compress. Takes the iter_records arguments."""
+    lines = (jsonl_lines if output_format == "jsonl" else csv_lines)(
+        iter_records(**kwargs)
+    )
+    chunks = _joined(lines)
+    return gzip_chunks(chunks) if compress else chunks
@@ -33,7 +33,9 @@ def _get_config():
     yaml_config_file = "config.yaml"
     if os.path.exists(yaml_config_file):
         with open(yaml_config_file, "r") as file:
-            yaml_config_data = yaml.safe_load(file)
+            # The libyaml loader, when available, is much faster
+            loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+            yaml_config_data = yaml.load(file, Loader=loader)
             config.update(yaml_config_data)
 
     return config
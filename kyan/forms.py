@@ -1,9 +1,6 @@
 import functools
 import os
-import re
 
-import dns.exception
-import dns.resolver
 import flask
 from flask_wtf import FlaskForm
 from flask_wtf.file import FileField, FileRequired
@@ -17,7 +14,7 @@ from wtforms.validators import (DataRequired, Email, EqualTo, Length, Optional,
 from wtforms.widgets import Select as SelectWidget  # For DisabledSelectField
 from wtforms.widgets import html_params
 
-from kyan import bencode, models, utils
+from kyan import bencode, blacklist, categories, infohashes, resolver, utils
 from kyan.extensions import config
 from kyan.models import User
 
@@ -78,21 +75,8 @@ def upload_recaptcha_validator_shim(form, field):
 
 
 def register_email_blacklist_validator(form, field):
-    email_blacklist = app.config["GENERAL"].get("EMAIL_BLACKLIST", [])
-    email = field.data.strip()
-    validation_exception = StopValidation("Blacklisted email provider")
-
-    for item in email_blacklist:
-        if isinstance(item, re.Pattern):
-            if item.search(email):
-                raise validation_exception
-        elif isinstance(item, str):
-            if item in email.lower():
-                raise validation_exception
-        else:
-            raise Exception(
-                "Unexpected email validator type {!r} ({!r})".format(type(item), item)
-            )
+    if blacklist.get_email_blacklist().is_blacklisted(field.data):
+        raise StopValidation("Blacklisted email provider")
     return True
 
 
@@ -106,37 +90,23 @@ def register_email_server_validator(form, field):
     email_domain = email.split("@", 1)[-1]
 
     try:
-        # Query domain MX records
-        mx_records = list(dns.resolver.query(email_domain, "MX"))
-
-    except dns.exception.DNSException:
+        addresses = resolver.get_resolver().mail_server_addresses(email_domain)
+    except resolver.ResolverError:
         app.logger.error(
             "Unable to query MX records for email: %s - ignoring", email, exc_info=False
         )
         return True
 
-    for mx_record in mx_records:
-        try:
-            # Query mailserver A records
-            a_records = list(dns.resolver.query(mx_record.exchange))
-            for a_record in a_records:
-                # Check for address in blacklist
-                if a_record.address in server_blacklist:
-                    app.logger.warning(
-                        "Rejected email %s due to blacklisted mailserver (%s, %s)",
-                        email,
-                        a_record.address,
-                        mx_record.exchange,
-                    )
-                    raise validation_exception
-
-        except dns.exception.DNSException:
+    for exchange, address in addresses:
+        # Check for address in blacklist
+        if address in server_blacklist:
             app.logger.warning(
-                "Failed to query A records for mailserver: %s (%s) - ignoring",
-                mx_record.exchange,
+                "Rejected email %s due to blacklisted mailserver (%s, %s)",
                 email,
-                exc_info=False,
+                address,
+                exchange,
             )
+            raise validation_exception
 
     return True
 
@@ -348,16 +318,13 @@ class EditForm(FlaskForm):
     category = DisabledSelectField("Category")
 
     def validate_category(form, field):
-        cat_match = re.match(r"^(\d+)_(\d+)$", field.data)
-        if not cat_match:
+        if not categories.CATEGORY_ID_RE.match(field.data):
             raise ValidationError("Please select a category")
 
-        main_cat_id = int(cat_match.group(1))
-        sub_cat_id = int(cat_match.group(2))
-
-        cat = models.SubCategory.by_category_ids(main_cat_id, sub_cat_id)
+        cat = categories.get_registry().by_string(field.data)
 
-        if not cat:
+        # Only sub categories can be picked
+        if not cat or cat.is_main:
             raise ValidationError("Please select a proper category")
 
         field.parsed_data = cat
@@ -443,16 +410,13 @@ class UploadForm(FlaskForm):
     category = DisabledSelectField("Category")
 
     def validate_category(form, field):
-        cat_match = re.match(r"^(\d+)_(\d+)$", field.data)
-        if not cat_match:
+        if not categories.CATEGORY_ID_RE.match(field.data):
             raise ValidationError("Please select a category")
 
-        main_cat_id = int(cat_match.group(1))
-        sub_cat_id = int(cat_match.group(2))
-
-        cat = models.SubCategory.by_category_ids(main_cat_id, sub_cat_id)
+        cat = categories.get_registry().by_string(field.data)
 
-        if not cat:
+        # Only sub categories can be picked
+        if not cat or cat.is_main:
             raise ValidationError("Please select a proper category")
 
         field.parsed_data = cat
@@ -486,67 +450,23 @@ class UploadForm(FlaskForm):
     rangebanned = HiddenField()
 
     def validate_torrent_file(form, field):
-        # Decode and ensure data is bencoded data
-        try:
-            torrent_dict = bencode.decode(field.data)
-            # field.data.close()
-        except (bencode.MalformedBencodeException, UnicodeError):
-            raise ValidationError("Malformed torrent file")
-
-        # Uncomment for debug print of the torrent
-        # _debug_print_torrent_metadata(torrent_dict)
+        torrent_data = parse_torrent_data(field.data, field.data.filename)
+        # Check if the info_hash exists already in the database. New torrents are
+        # ruled out by the info hash index without a query.
+        existing_torrent = infohashes.torrent_by_info_hash(torrent_data.info_hash)
+        torrent_data.db_id = check_existing_torrent(existing_torrent)
 
-        try:
-            _validate_torrent_metadata(torrent_dict)
-        except AssertionError as e:
-            raise ValidationError("Malformed torrent metadata ({})".format(e.args[0]))
-
-        site_tracker = app.config["GENERAL"]["MAIN_ANNOUNCE_URL"]
-        ensure_tracker = app.config["GENERAL"]["ENFORCE_MAIN_ANNOUNCE_URL"]
-
-        try:
-            tracker_found = _validate_trackers(torrent_dict, site_tracker)
-        except AssertionError as e:
-            raise ValidationError("Malformed torrent trackers ({})".format(e.args[0]))
-
-        # Ensure private torrents are using our tracker
-        if torrent_dict["info"].get("private") == 1:
-            if torrent_dict["announce"].decode("utf-8") != site_tracker:
-                raise ValidationError(
-                    "Private torrent: please set {} as the main tracker".format(
-                        site_tracker
-                    )
-                )
-
-        elif ensure_tracker and not tracker_found:
-            raise ValidationError(
-                "Please include {} in the trackers of the torrent".format(site_tracker)
-            )
+        # Torrent is legit, pass original filename and dict along
+        field.parsed_data = torrent_data
 
-        # Note! bencode will sort dict keys, as per the spec
-        # This may result in a different hash if the uploaded torrent does not match the
-        # spec, but it's their own fault for using broken software! Right?
-        bencoded_info_dict = bencode.encode(torrent_dict["info"])
-        info_hash = utils.sha1_hash(bencoded_info_dict)
 
-        # Check if the info_hash exists already in the database
-        existing_torrent = models.Torrent.by_info_hash(info_hash)
-        existing_torrent_id = existing_torrent.id if existing_torrent else None
-        if existing_torrent and not existing_torrent.deleted:
-            raise ValidationError(
-                "This torrent already exists (#{})".format(existing_torrent.id)
-            )
-        if existing_torrent and existing_torrent.banned:
-            raise ValidationError("This torrent is banned".format(existing_torrent.id))
+class PreparsedUploadForm(UploadForm):
+    """An UploadForm whose torrent_file.parsed_data has already been set, e.g. by
+    a batch upload that decodes and checks its torrents up front."""
 
-        # Torrent is legit, pass original filename and dict along
-        field.parsed_data = TorrentFileData(
-            filename=os.path.basename(field.data.filename),
-            torrent_dict=torrent_dict,
-            info_hash=info_hash,
-            bencoded_info_dict=bencoded_info_dict,
-            db_id=existing_torrent_id,
-        )
+    def validate_torrent_file(form, field):
+        if getattr(field, "parsed_data", None) is None:
+            raise ValidationError("Torrent file was not parsed")
 
 
 class UserForm(FlaskForm):
@@ -633,6 +553,72 @@ class TrustedDecisionForm(FlaskForm):
     reject = SubmitField("Reject")
 
 
+def parse_torrent_data(torrent_file, filename):
+    """Decodes and validates an uploaded torrent (bytes or a file object), raising
+    ValidationError on errors. Returns a TorrentFileData without a db_id."""
+    # Decode and ensure data is bencoded data
+    try:
+        torrent_dict = bencode.decode(torrent_file)
+    except (bencode.MalformedBencodeException, UnicodeError):
+        raise ValidationError("Malformed torrent file")
+
+    # Uncomment for debug print of the torrent
+    # _debug_print_torrent_metadata(torrent_dict)
+
+    try:
+        _validate_torrent_metadata(torrent_dict)
+    except AssertionError as e:
+        raise ValidationError("Malformed torrent metadata ({})".format(e.args[0]))
+
+    site_tracker = app.config["GENERAL"]["MAIN_ANNOUNCE_URL"]
+    ensure_tracker = app.config["GENERAL"]["ENFORCE_MAIN_ANNOUNCE_URL"]
+
+    try:
+        tracker_found = _validate_trackers(torrent_dict, site_tracker)
+    except AssertionError as e:
+        raise ValidationError("Malformed torrent trackers ({})".format(e.args[0]))
+
+    # Ensure private torrents are using our tracker
+    if torrent_dict["info"].get("private") == 1:
+        if torrent_dict["announce"].decode("utf-8") != site_tracker:
+            raise ValidationError(
+                "Private torrent: please set {} as the main tracker".format(
+                    site_tracker
+                )
+            )
+
+    elif ensure_tracker and not tracker_found:
+        raise ValidationError(
+            "Please include {} in the trackers of the torrent".format(site_tracker)
+        )
+
+    # Note! bencode will sort dict keys, as per the spec
+    # This may result in a different hash if the uploaded torrent does not match the
+    # spec, but it's their own fault for using broken software! Right?
+    bencoded_info_dict = bencode.encode(torrent_dict["info"])
+    info_hash = utils.sha1_hash(bencoded_info_dict)
+
+    return TorrentFileData(
+        filename=os.path.basename(filename),
+        torrent_dict=torrent_dict,
+        info_hash=info_hash,
+        bencoded_info_dict=bencoded_info_dict,
+        db_id=None,
+    )
+
+
+def check_existing_torrent(existing_torrent):
+    """Raises ValidationError if the torrent already in the database (or None)
+    blocks the upload. Returns the id of a deleted torrent to replace, or None."""
+    if existing_torrent and not existing_torrent.deleted:
+        raise ValidationError(
+            "This torrent already exists (#{})".format(existing_torrent.id)
+        )
+    if existing_torrent and existing_torrent.banned:
+        raise ValidationError("This torrent is banned")
+    return existing_torrent.id if existing_torrent else None
+
+
 def _validate_trackers(torrent_dict, tracker_to_check_for=None):
     announce = torrent_dict.get("announce")
     assert announce is not None, "no tracker in torrent"
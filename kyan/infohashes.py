@@ -0,0 +1,273 @@
+import bisect
+import threading
+import time
+from array import array
+from collections import namedtuple
+
+import flask
+import sqlalchemy
+from sqlalchemy import func, orm
+
+from kyan import models
+from kyan.extensions import cache, db
+from kyan.utils import VersionedSnapshot, call_after_commit
+
+app = flask.current_app
+
+# Rebuilt now and then to drop the overlay and pick up hand edits in the database
+DEFAULT_REBUILD_INTERVAL = 21600
+DEFAULT_REFRESH_INTERVAL = 5
+# A process further behind the shared change log than this rebuilds instead
+MAX_REPLAY = 10000
+
+CHANGE_SEQ_KEY = "infohashes:change_seq"
+CHANGE_KEY = "infohashes:change:{}"
+
+HASH_SIZE = 20
+DELETED = 1
+BANNED = 2
+
+InfoHashEntry = namedtuple("InfoHashEntry", ["id", "deleted", "banned"])
+
+
+def _config(key, default):
+    return app.config.get("INFOHASHES", {}).get(key, default)
+
+
+def _entry(torrent_id, flags):
+    return InfoHashEntry(torrent_id, bool(flags & DELETED), bool(flags & BANNED))
+
+
+def _compact_flags(torrent_flags):
+    return (DELETED if torrent_flags & models.TorrentFlags.DELETED else 0) | (
+        BANNED if torrent_flags & models.TorrentFlags.BANNED else 0
+    )
+
+
+class _HashColumn(object):
+    """Presents a buffer of concatenated 20-byte hashes as a sequence for bisect"""
+
+    def __init__(self, buf):
+        self._buf = buf
+
+    def __len__(self):
+        return len(self._buf) // HASH_SIZE
+
+    def __getitem__(self, i):
+        return self._buf[i * HASH_SIZE : (i + 1) * HASH_SIZE]
+
+
+class InfoHashIndex(object):
+    """Every torrent's info hash with its id and deleted/banned flags, in about 25
+    bytes per torrent.
+
+    The bulk of the hashes sit in one sorted bytes buffer (20 bytes each), with
+    the ids and flags in parallel arrays, and are found by binary search. Changes
+    since the load go to a small dict overlay that is checked first. Every
+    INFOHASHES.REFRESH_INTERVAL seconds, changes made by other processes are
+    replayed from the shared change log (see publish_changes), and torrents
+    uploaded since are picked up by polling for ids above the highest one seen."""
+
+    def __init__(self, hashes, ids, flags, max_id, change_seq):
+        self._hashes = bytes(hashes)
+        self._column = _HashColumn(self._hashes)
+        self._ids = ids
+        self._flags = flags
+        self._max_id = max_id
+        # The last change log entry applied
+        self._change_seq = change_seq
+        # Not found yet, perhaps still being written by the publishing process
+        self._missing_seq = None
+        # info_hash -> (id, flags), or None for removed torrents
+        self._overlay = {}
+        self._lock = threading.Lock()
+        self._refreshed_at = time.monotonic()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def _find(self, info_hash):
+        i = bisect.bisect_left(self._column, info_hash)
+        if i < len(self._ids) and self._column[i] == info_hash:
+            return i
+        return None
+
+    def get(self, info_hash):
+        """Returns the InfoHashEntry for a 20-byte info hash, or None"""
+        info_hash = bytes(info_hash)
+        if info_hash in self._overlay:
+            value = self._overlay[info_hash]
+            return _entry(*value) if value else None
+        i = self._find(info_hash)
+        if i is None:
+            return None
+        return _entry(self._ids[i], self._flags[i])
+
+    def set(self, info_hash, torrent_id, torrent_flags):
+        with self._lock:
+            self._overlay[bytes(info_hash)] = (
+                torrent_id,
+                _compact_flags(torrent_flags),
+            )
+            self._max_id = max(self._max_id, torrent_id)
+
+    def remove(self, info_hash):
+        with self._lock:
+            self._overlay[bytes(info_hash)] = None
+
+    def apply(self, info_hash, torrent_id, torrent_flags):
+        """Applies one change, with torrent_flags None for a deleted torrent"""
+        if torrent_flags is None:
+            self.remove(info_hash)
+        else:
+            self.set(info_hash, torrent_id, torrent_flags)
+
+    def _replay_changes(self):
+        """Applies the change log entries published since the last replay.
+        Returns False if they can no longer all be read, so the index has to be
+        rebuilt."""
+        change_seq = cache.get(CHANGE_SEQ_KEY) or 0
+        if change_seq <= self._change_seq:
+            return True
+        if change_seq - self._change_seq > MAX_REPLAY:
+            return False
+
+        seqs = range(self._change_seq + 1, change_seq + 1)
+        changes = cache.get_many(*[CHANGE_KEY.format(seq) for seq in seqs])
+        for seq, change in zip(seqs, changes):
+            if change is None:
+                # Gone from the cache, unless its publisher has yet to write it
+                if seq == self._missing_seq:
+                    return False
+                self._missing_seq = seq
+                return True
+            self.apply(*change)
+            self._change_seq = seq
+        return True
+
+    def refresh_if_due(self):
+        """Catches up with other processes' changes, at most every
+        INFOHASHES.REFRESH_INTERVAL seconds. Returns False if the index is too far
+        behind and has to be rebuilt."""
+        now = time.monotonic()
+        interval = _config("REFRESH_INTERVAL", DEFAULT_REFRESH_INTERVAL)
+        if now - self._refreshed_at < interval:
+            return True
+        self._refreshed_at = now
+        if not self._replay_changes():
+            return False
+
+        Torrent = models.Torrent
+        query = db.session.query(Torrent.info_hash, Torrent.id, Torrent.flags).filter(
+            Torrent.id > self._max_id
+        )
+        for info_hash, torrent_id, torrent_flags in query:
+            self.set(info_hash, torrent_id, torrent_flags)
+        return True
+
+
+def _load_index():
+    Torrent = models.Torrent
+    # Read first: changes published while loading are replayed, which is harmless
+    change_seq = cache.get(CHANGE_SEQ_KEY) or 0
+    max_id = db.session.query(func.max(Torrent.id)).scalar() or 0
+    hashes = bytearray()
+    ids = array("I")
+    flags = bytearray()
+    # BINARY columns sort bytewise, the same order bisect uses
+    query = (
+        db.session.query(Torrent.info_hash, Torrent.id, Torrent.flags)
+        .filter(Torrent.id <= max_id)
+        .order_by(Torrent.info_hash)
+        .yield_per(10000)
+    )
+    for info_hash, torrent_id, torrent_flags in query:
+        hashes += info_hash
+        ids.append(torrent_id)
+        flags.append(_compact_flags(torrent_flags))
+    return InfoHashIndex(hashes, ids, flags, max_id, change_seq)
+
+
+_snapshot = VersionedSnapshot(
+    "infohashes", _load_index, max_age=DEFAULT_REBUILD_INTERVAL
+)
+
+
+def get_index():
+    index = _snapshot.get()
+    if not index.refresh_if_due():
+        _snapshot.expire()
+        index = _snapshot.get()
+    return index
+
+
+def lookup(info_hash):
+    """Returns the InfoHashEntry (id, deleted, banned) of the torrent with the
+    info hash, or None. Unknown hashes never cost a database query."""
+    return get_index().get(info_hash)
+
+
+def torrent_by_info_hash(info_hash):
+    """Like Torrent.by_info_hash, but only queries (by id) for known hashes"""
+    entry = lookup(info_hash)
+    return models.Torrent.by_id(entry.id) if entry else None
+
+
+def warm_up():
+    """Loads the index, so the first lookups do not wait for it"""
+    app.logger.info("Loaded %d info hashes", len(_snapshot.get()))
+
+
+def publish_changes(changes):
+    """Applies (info_hash, torrent_id, torrent_flags) changes, with torrent_flags
+    None for deleted torrents, to this process's index and appends them to the
+    change log in the shared cache, from which every other process replays them.
+    The log entries expire with the index rebuild interval."""
+    index = _snapshot.peek()
+    if index is not None:
+        for change in changes:
+            index.apply(*change)
+
+    # Atomic on shared backends such as redis
+    last_seq = cache.cache.inc(CHANGE_SEQ_KEY, delta=len(changes))
+    if last_seq is None:
+        # No working shared cache to publish to, so have everyone rebuild
+        _snapshot.invalidate()
+        return
+    first_seq = last_seq - len(changes) + 1
+    cache.set_many(
+        {
+            CHANGE_KEY.format(seq): (bytes(info_hash), torrent_id, torrent_flags)
+            for seq, (info_hash, torrent_id, torrent_flags) in enumerate(
+                changes, first_seq
+            )
+        },
+        timeout=DEFAULT_REBUILD_INTERVAL,
+    )
+
+
+def publish_after_commit(session, changes):
+    """publish_changes once the session commits, for bulk statements that change
+    torrent flags without ORM events"""
+    call_after_commit(
+        session, ("infohashes", id(changes)), lambda: publish_changes(changes)
+    )
+
+
+def _after_commit(target, change):
+    call_after_commit(
+        orm.object_session(target),
+        ("infohashes", bytes(target.info_hash)),
+        lambda: publish_changes([change]),
+    )
+
+
+@sqlalchemy.event.listens_for(models.Torrent, "after_insert")
+@sqlalchemy.event.listens_for(models.Torrent, "after_update")
+def _set_torrent(mapper, connection, target):
+    _after_commit(target, (target.info_hash, target.id, target.flags))
+
+
+@sqlalchemy.event.listens_for(models.Torrent, "after_delete")
+def _remove_torrent(mapper, connection, target):
+    _after_commit(target, (target.info_hash, target.id, None))
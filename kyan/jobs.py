@@ -0,0 +1,212 @@
+import functools
+import json
+import time
+import traceback
+from datetime import datetime, timedelta
+
+import flask
+import sqlalchemy
+
+from kyan import email, models, moderation
+from kyan.extensions import db
+
+app = flask.current_app
+
+DEFAULT_POLL_INTERVAL = 2
+DEFAULT_RUNNING_TIMEOUT = 3600
+SWEEP_INTERVAL = 60
+
+_handlers = {}
+_swept_at = None
+
+
+def handler(kind):
+    """Registers fn(payload, set_progress) as the handler for a job kind. The
+    handler must not commit; its changes are committed together with the job's
+    DONE status. It returns a short result message."""
+
+    def decorator(f):
+        _handlers[kind] = f
+        return f
+
+    return decorator
+
+
+def enqueue(kind, payload, created_by=None):
+    """Adds a job for the worker to the session. Does not commit."""
+    if kind not in _handlers:
+        raise ValueError("Unknown job kind: " + kind)
+    job = models.Job(
+        kind=kind,
+        payload=json.dumps(payload),
+        created_by_id=created_by.id if created_by else None,
+    )
+    db.session.add(job)
+    return job
+
+
+def set_progress(job_id, progress, total=None):
+    """Records a job's progress in its own transaction, so the status page sees
+    it while the job's work is still uncommitted"""
+    values = {"progress": progress}
+    if total is not None:
+        values["total"] = total
+    jobs = models.Job.__table__
+    with db.engine.begin() as connection:
+        connection.execute(
+            sqlalchemy.update(jobs).where(jobs.c.id == job_id).values(**values)
+        )
+
+
+def claim_next():
+    """Marks the oldest queued job as running and returns its id, or None.
+    Rows locked by another worker are skipped."""
+    job = (
+        models.Job.query.filter_by(status=models.JobStatus.QUEUED)
+        .order_by(models.Job.id)
+        .with_for_update(skip_locked=True)
+        .first()
+    )
+    if not job:
+        db.session.rollback()
+        return None
+
+    job.status = models.JobStatus.RUNNING
+    job.started_time = datetime.utcnow()
+    db.session.commit()
+    return job.id
+
+
+def sweep_stale_jobs():
+    """Every SWEEP_INTERVAL seconds, fails jobs that have been running for longer
+    than JOBS.RUNNING_TIMEOUT, as the worker that had them most likely died. Their
+    changes were never committed, so they can be queued again by hand."""
+    global _swept_at
+    now = time.monotonic()
+    if _swept_at is not None and now - _swept_at < SWEEP_INTERVAL:
+        return
+    _swept_at = now
+
+    timeout = app.config.get("JOBS", {}).get("RUNNING_TIMEOUT", DEFAULT_RUNNING_TIMEOUT)
+    swept = models.Job.query.filter(
+        models.Job.status == models.JobStatus.RUNNING,
+        models.Job.started_time < datetime.utcnow() - timedelta(seconds=timeout),
+    ).update(
+        {
+            "status": models.JobStatus.FAILED,
+            "error": "Timed out, the worker running the job most likely died",
+            "finished_time": datetime.utcnow(),
+        },
+        synchronize_session=False,
+    )
+    db.session.commit()
+    if swept:
+        app.logger.warning("Failed %d timed out jobs", swept)
+
+
+def run_job(job_id):
+    job = models.Job.by_id(job_id)
+    try:
+        job_handler = _handlers[job.kind]
+        result = job_handler(
+            json.loads(job.payload), functools.partial(set_progress, job_id)
+        )
+    except Exception:
+        db.session.rollback()
+        app.logger.exception("Job %s failed", job_id)
+        job = models.Job.by_id(job_id)
+        job.status = models.JobStatus.FAILED
+        job.error = traceback.format_exc()
+    else:
+        job.status = models.JobStatus.DONE
+        job.result = result
+    job.finished_time = datetime.utcnow()
+    db.session.commit()
+
+
+def run_worker(once=False):
+    """Runs queued jobs oldest first, then (unless once) keeps polling for new
+    ones every JOBS.POLL_INTERVAL seconds. Returns the number of jobs run."""
+    poll_interval = app.config.get("JOBS", {}).get(
+        "POLL_INTERVAL", DEFAULT_POLL_INTERVAL
+    )
+    ran = 0
+    while True:
+        # Handlers build admin log links and render emails with url_for
+        with app.test_request_context():
+            try:
+                sweep_stale_jobs()
+                job_id = claim_next()
+                if job_id is not None:
+                    run_job(job_id)
+                    ran += 1
+            finally:
+                db.session.remove()
+
+        if job_id is None:
+            if once:
+                return ran
+            time.sleep(poll_interval)
+
+
+# HANDLERS
+
+
+@handler("nuke_torrents")
+def _nuke_torrents(payload, set_progress):
+    user = models.User.by_id(payload["user_id"])
+    count = moderation.nuke_torrents(user.id)
+    if count > 0:
+        moderation.log_nuke(
+            user, models.User.by_id(payload["admin_id"]), count, "torrents"
+        )
+    set_progress(1, 1)
+    return "Nuked {} torrents of {}".format(count, user.username)
+
+
+@handler("nuke_comments")
+def _nuke_comments(payload, set_progress):
+    user = models.User.by_id(payload["user_id"])
+    count = moderation.nuke_comments(user.id)
+    if count > 0:
+        moderation.log_nuke(
+            user, models.User.by_id(payload["admin_id"]), count, "comments"
+        )
+    set_progress(1, 1)
+    return "Nuked {} comments of {}".format(count, user.username)
+
+
+@handler("resolve_reports")
+def _resolve_reports(payload, set_progress):
+    """Payload: {"admin_id", "reports": [{"report_id", "action"}]}"""
+    admin = models.User.by_id(payload["admin_id"])
+    resolved = 0
+    set_progress(0, len(payload["reports"]))
+    for i, entry in enumerate(payload["reports"]):
+        report = models.Report.by_id(entry["report_id"])
+        # Skip reports closed since the job was queued
+        if report and report.status == 0:
+            torrent = models.Torrent.by_id(report.torrent_id)
+            moderation.resolve_report(report, torrent, entry["action"], admin)
+            resolved += 1
+        set_progress(i + 1)
+    return "Resolved {} reports".format(resolved)
+
+
+@handler("trusted_decision_email")
+def _send_trusted_decision_email(payload, set_progress):
+    user = models.User.by_id(payload["user_id"])
+    is_accepted = payload["is_accepted"]
+    email_msg = email.EmailHolder(
+        subject="Your {} Trusted Application was {}.".format(
+            app.config["GENERAL"]["GLOBAL_SITE_NAME"],
+            ("rejected", "accepted")[is_accepted],
+        ),
+        recipient=user,
+        text=flask.render_template("email/trusted.txt", is_accepted=is_accepted),
+        html=flask.render_template("email/trusted.html", is_accepted=is_accepted),
+    )
+    # Queued in the outbox together with the job's status
+    email.send_email(email_msg)
+    set_progress(1, 1)
+    return "Queued trusted decision email to {}".format(user.username)
@@ -0,0 +1,104 @@
+from collections import namedtuple
+
+import flask
+from jinja2.filters import do_filesizeformat
+
+from kyan import categories
+from kyan.torrents import create_magnet
+
+# Stands in for the torrent id in URLs built once per listing
+_ID_SENTINEL = 9007199254740993
+
+TorrentRow = namedtuple(
+    "TorrentRow",
+    [
+        "id",
+        "row_class",
+        "category_url",
+        "category_icon_url",
+        "category_name",
+        "display_name",
+        "view_url",
+        "comment_count",
+        "comments_title",
+        "download_url",
+        "magnet_uri",
+        "filesize",
+        "created_timestamp",
+        "created_time",
+        "seed_count",
+        "leech_count",
+        "download_count",
+    ],
+)
+
+
+class _TorrentUrl(object):
+    """url_for for one endpoint, evaluated once and then filled with torrent ids"""
+
+    def __init__(self, endpoint):
+        url = flask.url_for(endpoint, torrent_id=_ID_SENTINEL)
+        self._prefix, self._suffix = url.split(str(_ID_SENTINEL))
+
+    def __call__(self, torrent_id):
+        return "{}{}{}".format(self._prefix, torrent_id, self._suffix)
+
+
+def _row_class(torrent):
+    if torrent.deleted:
+        return "deleted"
+    elif torrent.hidden:
+        return "warning"
+    elif torrent.remake:
+        return "danger"
+    elif torrent.trusted:
+        return "success"
+    return "default"
+
+
+def iter_torrent_rows(torrents):
+    """Turns torrents into TorrentRows for search_results.html, with every URL,
+    label and formatted value precomputed, so the template only interpolates.
+    Rows are made as they are iterated, so a streamed torrent query stays
+    streamed.
+
+    The url_for calls and category lookups happen once per listing (and once per
+    category), not once per row."""
+    view_url = _TorrentUrl("torrents.view")
+    download_url = _TorrentUrl("torrents.download")
+    registry = categories.get_registry()
+    category_urls = {}
+
+    for torrent in torrents:
+        cat_id = "{}_{}".format(torrent.main_category_id, torrent.sub_category_id)
+        category = category_urls.get(cat_id)
+        if category is None:
+            category = category_urls[cat_id] = (
+                flask.url_for("main.home", c=cat_id),
+                flask.url_for("static", filename="img/icons/{}.png".format(cat_id)),
+                registry.name_of(cat_id),
+            )
+
+        comment_count = torrent.comment_count
+        stats = torrent.stats
+        yield TorrentRow(
+            id=torrent.id,
+            row_class=_row_class(torrent),
+            category_url=category[0],
+            category_icon_url=category[1],
+            category_name=category[2],
+            display_name=torrent.display_name,
+            view_url=view_url(torrent.id),
+            comment_count=comment_count,
+            comments_title="{} comment{}".format(
+                comment_count, "s" if comment_count > 1 else ""
+            ),
+            download_url=download_url(torrent.id) if torrent.has_torrent else None,
+            magnet_uri=create_magnet(torrent),
+            filesize=do_filesizeformat(torrent.filesize, True),
+            created_timestamp=int(torrent.created_utc_timestamp),
+            created_time=torrent.created_time.strftime("%Y-%m-%d %H:%M"),
+            seed_count=stats.seed_count,
+            leech_count=stats.leech_count,
+            download_count=stats.download_count,
+        )
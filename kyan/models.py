@@ -97,7 +97,9 @@ class TorrentBase(object):
         # Even though this is same for both tables, declarative requires this
         return db.Column(db.Integer, db.ForeignKey("users.id"), nullable=True)
 
-    uploader_ip = db.Column(BinaryType(length=16), default=None, nullable=True)
+    uploader_ip = db.Column(
+        BinaryType(length=16), default=None, nullable=True, index=True
+    )
     has_torrent = db.Column(db.Boolean, nullable=False, default=False)
 
     comment_count = db.Column(db.Integer, default=0, nullable=False, index=True)
@@ -110,6 +112,7 @@ class TorrentBase(object):
         default=datetime.utcnow,
         onupdate=datetime.utcnow,
         nullable=False,
+        index=True,
     )
 
     @declarative.declared_attr
@@ -900,6 +903,8 @@ class TrackerApiBase(object):
     info_hash = db.Column(BinaryType(length=20), nullable=False)
     method = db.Column(db.String(length=255), nullable=False)
     # Methods = insert, remove
+    # Set while `flask tracker sync` is pushing the row
+    claimed_time = db.Column(db.DateTime(timezone=False), nullable=True, default=None)
 
     def __init__(self, info_hash, method):
         self.info_hash = info_hash
@@ -1038,6 +1043,156 @@ class TrustedReview(db.Model):
     )
 
 
+class PendingUploadStatus(IntEnum):
+    PENDING = 0
+    PROCESSING = 1
+    DONE = 2
+    FAILED = 3
+
+
+class PendingUpload(db.Model):
+    __tablename__ = "pending_uploads"
+
+    id = db.Column(db.Integer, primary_key=True)
+    uploader_id = db.Column(
+        db.Integer, db.ForeignKey("users.id"), nullable=True, index=True
+    )
+    uploader_ip = db.Column(BinaryType(length=16), default=None, nullable=True)
+    info_hash = db.Column(BinaryType(length=20), nullable=False)
+    filename = db.Column(db.String(length=255), nullable=False)
+    # JSON of the values returned by backend.get_upload_values
+    upload_values = db.Column(TextType, nullable=False)
+    status = db.Column(
+        ChoiceType(PendingUploadStatus, impl=db.Integer()),
+        nullable=False,
+        default=PendingUploadStatus.PENDING,
+        index=True,
+    )
+    # JSON of {field: [errors]} for failed uploads
+    errors = db.Column(TextType, nullable=True)
+    torrent_id = db.Column(db.Integer, db.ForeignKey("torrents.id"), nullable=True)
+
+    created_time = db.Column(db.DateTime(timezone=False), default=datetime.utcnow)
+    updated_time = db.Column(
+        db.DateTime(timezone=False), default=datetime.utcnow, onupdate=datetime.utcnow
+    )
+
+    uploader = db.relationship("User", uselist=False, foreign_keys=[uploader_id])
+    torrent = db.relationship("Torrent", uselist=False, foreign_keys=[torrent_id])
+
+    def __repr__(self):
+        return "<PendingUpload %r>" % self.id
+
+    @property
+    def raw_path(self):
+        """Returns a path to the stored torrent file in form of 'pending_uploads/123.torrent'"""
+        return os.path.join(
+            app.config["GENERAL"]["BASE_DIR"],
+            "pending_uploads",
+            "{}.torrent".format(self.id),
+        )
+
+    @property
+    def status_str(self):
+        return self.status.name.lower()
+
+    @classmethod
+    def by_id(cls, id):
+        return cls.query.get(id)
+
+    @classmethod
+    def claim(cls, id):
+        """Atomically moves a pending upload to processing. Returns whether this
+        caller won the claim."""
+        query = cls.query.filter_by(id=id, status=PendingUploadStatus.PENDING)
+        claimed = query.update({"status": PendingUploadStatus.PROCESSING}, False)
+        db.session.commit()
+        return claimed == 1
+
+
+class JobStatus(IntEnum):
+    QUEUED = 0
+    RUNNING = 1
+    DONE = 2
+    FAILED = 3
+
+
+class Job(db.Model):
+    __tablename__ = "jobs"
+
+    id = db.Column(db.Integer, primary_key=True)
+    # Name of the handler registered in kyan.jobs
+    kind = db.Column(db.String(length=64), nullable=False)
+    # JSON arguments for the handler
+    payload = db.Column(TextType, nullable=False)
+    status = db.Column(
+        ChoiceType(JobStatus, impl=db.Integer()),
+        nullable=False,
+        default=JobStatus.QUEUED,
+        index=True,
+    )
+    progress = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer, nullable=True)
+    result = db.Column(db.String(length=1024), nullable=True)
+    error = db.Column(TextType, nullable=True)
+    created_by_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=True)
+
+    created_time = db.Column(db.DateTime(timezone=False), default=datetime.utcnow)
+    started_time = db.Column(db.DateTime(timezone=False), nullable=True)
+    finished_time = db.Column(db.DateTime(timezone=False), nullable=True)
+
+    created_by = db.relationship("User", uselist=False, foreign_keys=[created_by_id])
+
+    def __repr__(self):
+        return "<Job %r>" % self.id
+
+    @property
+    def status_str(self):
+        return self.status.name.lower()
+
+    @classmethod
+    def by_id(cls, id):
+        return cls.query.get(id)
+
+
+class OutboxEmailStatus(IntEnum):
+    QUEUED = 0
+    SENT = 1
+    FAILED = 2
+    # Claimed by a worker until next_attempt_time
+    SENDING = 3
+
+
+class OutboxEmail(db.Model):
+    __tablename__ = "email_outbox"
+
+    id = db.Column(db.Integer, primary_key=True)
+    # "username <address>", as in the To header
+    recipient = db.Column(db.String(length=512), nullable=False)
+    recipient_email = db.Column(db.String(length=255), nullable=False)
+    subject = db.Column(db.String(length=255), nullable=False)
+    text = db.Column(TextType, nullable=False)
+    html = db.Column(TextType, nullable=True)
+    status = db.Column(
+        ChoiceType(OutboxEmailStatus, impl=db.Integer()),
+        nullable=False,
+        default=OutboxEmailStatus.QUEUED,
+    )
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.String(length=1024), nullable=True)
+
+    created_time = db.Column(db.DateTime(timezone=False), default=datetime.utcnow)
+    next_attempt_time = db.Column(
+        db.DateTime(timezone=False), default=datetime.utcnow, nullable=False
+    )
+    sent_time = db.Column(db.DateTime(timezone=False), nullable=True)
+
+    __table_args__ = (Index("status_next_attempt_idx", "status", "next_attempt_time"),)
+
+    def __repr__(self):
+        return "<OutboxEmail %r>" % self.id
+
+
 # Actually declare our site-specific classes
 
 # Torrent
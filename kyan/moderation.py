@@ -0,0 +1,120 @@
+import flask
+import sqlalchemy
+from sqlalchemy import func
+
+from kyan import infohashes, models
+from kyan.extensions import db
+
+
+def _user_torrent_ids(user_id):
+    return sqlalchemy.select(models.Torrent.id).where(
+        models.Torrent.uploader_id == user_id
+    )
+
+
+def nuke_torrents(user_id):
+    """Deletes and bans every torrent uploaded by the user, zeroes their seeders and
+    leechers and queues their removal from the tracker, in three set-based
+    statements. Does not commit. Returns the number of torrents nuked."""
+    Torrent = models.Torrent
+    nuked = (
+        db.session.query(Torrent.info_hash, Torrent.id, Torrent.flags)
+        .filter(Torrent.uploader_id == user_id)
+        .all()
+    )
+    if not nuked:
+        return 0
+
+    db.session.execute(
+        sqlalchemy.insert(models.TrackerApi.__table__).from_select(
+            ["info_hash", "method"],
+            sqlalchemy.select(Torrent.info_hash, sqlalchemy.literal("remove")).where(
+                Torrent.uploader_id == user_id
+            ),
+        )
+    )
+    db.session.execute(
+        sqlalchemy.update(models.Statistic.__table__)
+        .where(models.Statistic.torrent_id.in_(_user_torrent_ids(user_id)))
+        .values(seed_count=0, leech_count=0)
+    )
+    nuke_flags = int(models.TorrentFlags.DELETED | models.TorrentFlags.BANNED)
+    db.session.execute(
+        sqlalchemy.update(Torrent.__table__)
+        .where(Torrent.uploader_id == user_id)
+        .values(flags=Torrent.flags.op("|")(nuke_flags))
+    )
+    infohashes.publish_after_commit(
+        db.session,
+        [
+            (info_hash, torrent_id, torrent_flags | nuke_flags)
+            for info_hash, torrent_id, torrent_flags in nuked
+        ],
+    )
+    return len(nuked)
+
+
+def nuke_comments(user_id):
+    """Deletes every comment by the user and recomputes comment_count of the
+    affected torrents in one grouped UPDATE. Does not commit.
+    Returns the number of comments deleted."""
+    Comment = models.Comment
+    torrent_ids = [
+        torrent_id
+        for torrent_id, in db.session.query(Comment.torrent_id)
+        .filter(Comment.user_id == user_id)
+        .distinct()
+    ]
+    if not torrent_ids:
+        return 0
+
+    deleted = db.session.execute(
+        sqlalchemy.delete(Comment.__table__).where(Comment.user_id == user_id)
+    ).rowcount
+
+    comment_count = (
+        sqlalchemy.select(func.count(Comment.id))
+        .where(Comment.torrent_id == models.Torrent.id)
+        .scalar_subquery()
+    )
+    db.session.execute(
+        sqlalchemy.update(models.Torrent.__table__)
+        .where(models.Torrent.id.in_(torrent_ids))
+        .values(comment_count=comment_count)
+    )
+    return deleted
+
+
+def log_nuke(user, admin, count, what):
+    """Adds the "Nuked N <what> of [user](url)" admin log entry"""
+    url = flask.url_for("users.view_user", user_name=user.username)
+    log = "Nuked {0} {1} of [{2}]({3})".format(count, what, user.username, url)
+    db.session.add(models.AdminLog(log=log, admin_id=admin.id))
+
+
+def resolve_report(report, torrent, action, admin):
+    """Applies a report action ("delete", "hide" or anything else to close the
+    report) and logs it. Does not commit."""
+    report_user = models.User.by_id(report.user_id)
+    log = "Report #{}: {} [#{}]({}), reported by [{}]({})"
+    if action == "delete":
+        torrent.deleted = True
+        report.status = 1
+        verb = "Deleted"
+    elif action == "hide":
+        torrent.hidden = True
+        report.status = 1
+        verb = "Hid"
+    else:
+        report.status = 2
+        verb = "Closed"
+    log = log.format(
+        report.id,
+        verb,
+        torrent.id,
+        flask.url_for("torrents.view", torrent_id=torrent.id),
+        report_user.username,
+        flask.url_for("users.view_user", user_name=report_user.username),
+    )
+    db.session.add(models.AdminLog(log=log, admin_id=admin.id))
+    models.Report.remove_reviewed(torrent.id)
@@ -0,0 +1,118 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait as wait_futures
+
+import flask
+
+from kyan.utils import lazy_module
+
+app = flask.current_app
+
+# dnspython is only needed once someone registers
+_dns_resolver = lazy_module("dns.resolver")
+_dns_exception = lazy_module("dns.exception")
+
+DEFAULT_CACHE_SIZE = 10000
+DEFAULT_TIMEOUT = 3
+DEFAULT_WORKERS = 8
+
+_resolver = None
+_resolver_lock = threading.Lock()
+
+
+class ResolverError(Exception):
+    pass
+
+
+class MailServerResolver(object):
+    """Looks up the addresses of a domain's mail servers.
+
+    `resolver` is anything with dnspython's Resolver.resolve(qname, rdtype,
+    lifetime=...) signature; the default one keeps answers in an LRU cache shared
+    by all threads, for as long as their TTL allows. The A lookups for the MX hosts
+    run concurrently, and the whole lookup is bounded by `timeout` seconds."""
+
+    def __init__(self, resolver=None, timeout=DEFAULT_TIMEOUT, workers=DEFAULT_WORKERS):
+        if resolver is None:
+            resolver = _dns_resolver().Resolver()
+            resolver.cache = _dns_resolver().LRUCache(DEFAULT_CACHE_SIZE)
+        self.resolver = resolver
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="kyan-dns"
+        )
+
+    def mail_server_addresses(self, domain):
+        """Returns (exchange, address) pairs for the domain's MX hosts. MX hosts
+        that fail to resolve, or do not resolve in time, are left out. Raises
+        ResolverError if the MX records themselves cannot be looked up."""
+        deadline = time.monotonic() + self.timeout
+        try:
+            mx_records = list(
+                self.resolver.resolve(domain, "MX", lifetime=self.timeout)
+            )
+        except _dns_exception().DNSException as e:
+            raise ResolverError("Unable to query MX records: " + domain) from e
+
+        futures = {
+            self._executor.submit(
+                self.resolver.resolve,
+                mx_record.exchange,
+                "A",
+                lifetime=max(deadline - time.monotonic(), 0.01),
+            ): mx_record.exchange
+            for mx_record in mx_records
+        }
+        done, not_done = wait_futures(
+            futures, timeout=max(deadline - time.monotonic(), 0)
+        )
+
+        addresses = []
+        for future in done:
+            try:
+                a_records = future.result()
+            except _dns_exception().DNSException:
+                app.logger.warning(
+                    "Failed to query A records for mailserver: %s (%s) - ignoring",
+                    futures[future],
+                    domain,
+                )
+                continue
+            addresses.extend(
+                (futures[future], a_record.address) for a_record in a_records
+            )
+        for future in not_done:
+            future.cancel()
+            app.logger.warning(
+                "Timed out querying A records for mailserver: %s (%s) - ignoring",
+                futures[future],
+                domain,
+            )
+        return addresses
+
+
+def get_resolver():
+    """Returns the process-wide MailServerResolver, configured from DNS.*"""
+    global _resolver
+    with _resolver_lock:
+        if _resolver is None:
+            dns_config = app.config.get("DNS", {})
+            resolver = _dns_resolver().Resolver()
+            resolver.cache = _dns_resolver().LRUCache(
+                dns_config.get("CACHE_SIZE", DEFAULT_CACHE_SIZE)
+            )
+            _resolver = MailServerResolver(
+                resolver,
+                timeout=dns_config.get("TIMEOUT", DEFAULT_TIMEOUT),
+                workers=dns_config.get("WORKERS", DEFAULT_WORKERS),
+            )
+        return _resolver
+
+
+def set_resolver(resolver):
+    """Replaces the process-wide MailServerResolver, e.g. with one wrapping a fake
+    dnspython-style resolver in tests"""
+    global _resolver
+    with _resolver_lock:
+        _resolver = resolver
@@ -1,16 +1,17 @@
-import re
 import shlex
 
 import flask
 import sqlalchemy
+from flask_sqlalchemy.pagination import Pagination
 
-from kyan import models
+from kyan import categories, models
 from kyan.extensions import db
 
 app = flask.current_app
 
 DEFAULT_MAX_SEARCH_RESULT = 1000
 DEFAULT_PER_PAGE = 75
+DEFAULT_STREAM_BATCH_SIZE = 500
 SEARCH_PAGINATE_DISPLAY_MSG = (
     "Displaying results {start}-{end} out of {total} results.<br>\n"
     "Please refine your search results if you can't find "
@@ -34,6 +35,35 @@ class QueryPairCaller(object):
         return wrapper
 
 
+class StreamingPagination(Pagination):
+    """Like Query.paginate, except that items is the page's query, run through a
+    server-side cursor (yield_per) as it is iterated instead of loaded up front"""
+
+    def _query_items(self):
+        query = self._query_args["query"]
+        return (
+            query.limit(self.per_page)
+            .offset(self._query_offset)
+            .yield_per(self._query_args["batch_size"])
+        )
+
+    def _query_count(self):
+        return self._query_args["query"].order_by(None).count()
+
+    # Pagination's first and last count the items, which would run the query
+    @property
+    def first(self):
+        if (self.page - 1) * self.per_page >= self.total:
+            return 0
+        return (self.page - 1) * self.per_page + 1
+
+    @property
+    def last(self):
+        if not self.first:
+            return 0
+        return min(self.page * self.per_page, self.total)
+
+
 def _generate_query_string(term, category, filter, user):
     params = {}
     if term:
@@ -59,7 +89,11 @@ def search_db(
     admin=False,
     logged_in_user=None,
     per_page=75,
+    stream=False,
 ):
+    """Returns the matching torrents: a query limited to per_page for RSS, a
+    pagination otherwise. With stream=True the torrents are fetched in batches
+    of SEARCH.STREAM_BATCH_SIZE as they are iterated, for streamed responses."""
     if page > 4294967295:
         flask.abort(404)
 
@@ -108,23 +142,13 @@ def search_db(
 
     user = models.User.by_id(user) if user else None
 
-    main_category, sub_category = None, None
     main_cat_id, sub_cat_id = 0, 0
     if category:
-        cat_match = re.match(r"^(\d+)_(\d+)$", category)
-        if not cat_match:
+        try:
+            main_cat_id, sub_cat_id = categories.get_registry().parse(category)
+        except ValueError:
             flask.abort(400)
 
-        main_cat_id, sub_cat_id = map(int, cat_match.groups())
-
-        if main_cat_id > 0:
-            if sub_cat_id > 0:
-                sub_category = models.SubCategory.by_category_ids(
-                    main_cat_id, sub_cat_id
-                )
-            else:
-                main_category = models.MainCategory.by_id(main_cat_id)
-
     model_class = models.Torrent
     query = db.session.query(model_class)
 
@@ -167,13 +191,13 @@ def search_db(
                     )
                 )
 
-    if main_category:
-        qpc.filter(models.Torrent.main_category_id == main_cat_id)
-    elif sub_category:
+    if sub_cat_id:
         qpc.filter(
             models.Torrent.main_category_id == main_cat_id,
             models.Torrent.sub_category_id == sub_cat_id,
         )
+    elif main_cat_id:
+        qpc.filter(models.Torrent.main_category_id == main_cat_id)
 
     if filter_tuple:
         qpc.filter(
@@ -189,16 +213,33 @@ def search_db(
 
     query = query.order_by(getattr(sort_column, order)())
 
+    batch_size = app.config["SEARCH"].get(
+        "STREAM_BATCH_SIZE", DEFAULT_STREAM_BATCH_SIZE
+    )
     if rss:
         query = query.limit(per_page)
+        if stream:
+            query = query.yield_per(batch_size)
+    elif stream:
+        query = StreamingPagination(
+            query=query,
+            page=page,
+            per_page=per_page,
+            max_per_page=None,
+            error_out=False,
+            batch_size=batch_size,
+        )
+        # The items are not loaded yet, so check the page against the count
+        if page > 1 and (page - 1) * per_page >= query.total:
+            flask.abort(404)
     else:
         query = query.paginate(page=page, per_page=per_page)
 
-        if term:
-            query.display_msg = SEARCH_PAGINATE_DISPLAY_MSG.format(
-                start=query.page * query.per_page - query.per_page + 1,
-                end=min(query.page * query.per_page, query.total),
-                total=query.total,
-            )
+    if term and not rss:
+        query.display_msg = SEARCH_PAGINATE_DISPLAY_MSG.format(
+            start=query.page * query.per_page - query.per_page + 1,
+            end=min(query.page * query.per_page, query.total),
+            total=query.total,
+        )
 
     return query
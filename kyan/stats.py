@@ -0,0 +1,254 @@
+import binascii
+import json
+import struct
+import threading
+import time
+from datetime import datetime
+
+import flask
+from sqlalchemy.dialects import mysql
+
+from kyan import models
+from kyan.extensions import db
+
+app = flask.current_app
+
+DEFAULT_INGEST_BATCH_SIZE = 1000
+DEFAULT_FLUSH_SIZE = 10000
+DEFAULT_FLUSH_INTERVAL = 30
+DEFAULT_WRITE_DELTA = 2
+
+# info_hash, seeders, leechers, completed as big-endian unsigned 32-bit integers
+BINARY_RECORD = struct.Struct("!20sIII")
+
+
+class StatsRecordError(Exception):
+    pass
+
+
+def parse_json_line(line):
+    """Parses one {"info_hash", "seeders", "leechers", "completed"} JSON line into
+    an (info_hash, seeders, leechers, completed) record"""
+    try:
+        data = json.loads(line)
+        info_hash = binascii.unhexlify(data["info_hash"])
+        counts = tuple(int(data[key]) for key in ("seeders", "leechers", "completed"))
+    except (ValueError, TypeError, KeyError, binascii.Error):
+        raise StatsRecordError("Malformed stats line")
+
+    if len(info_hash) != 20 or min(counts) < 0:
+        raise StatsRecordError("Malformed stats line")
+    return (info_hash,) + counts
+
+
+def read_json_lines(lines):
+    """Yields records from an iterable of JSON lines (str or bytes). Malformed
+    lines are yielded as None, so callers can count them."""
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            yield parse_json_line(line)
+        except StatsRecordError:
+            yield None
+
+
+def read_binary_records(stream, chunk_records=4096):
+    """Yields records from a file-like object of fixed-size BINARY_RECORD structs.
+    A truncated final record is yielded as None."""
+    chunk_size = BINARY_RECORD.size * chunk_records
+    leftover = b""
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        data = leftover + chunk
+        usable = len(data) - len(data) % BINARY_RECORD.size
+        yield from BINARY_RECORD.iter_unpack(data[:usable])
+        leftover = data[usable:]
+    if leftover:
+        yield None
+
+
+def _significant(current, counts, delta):
+    """Whether new (seeders, leechers, completed) counts differ enough from the
+    stored ones to be worth a write"""
+    if current is None:
+        return True
+    for old, new in zip(current, counts):
+        # Torrents going dead or coming back to life always show
+        if (old == 0) != (new == 0) or abs(new - old) >= delta:
+            return True
+    return False
+
+
+class StatsBuffer(object):
+    """Write-behind buffer for statistics. Updates are merged per torrent in
+    memory (the latest one wins) and written in multi-row upserts when
+    STATS.FLUSH_SIZE torrents are pending or STATS.FLUSH_INTERVAL seconds have
+    passed. Counts that moved less than STATS.WRITE_DELTA since the stored ones
+    are not written, which spares the three count indexes most of their churn."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._flushed_at = time.monotonic()
+        self._flusher = None
+
+    def _config(self, key, default):
+        return app.config.get("STATS", {}).get(key, default)
+
+    def add(self, updates):
+        """Queues a {torrent_id: (seeders, leechers, completed)} dict"""
+        self._start_flusher()
+        with self._lock:
+            self._pending.update(updates)
+            pending_count = len(self._pending)
+            since_flush = time.monotonic() - self._flushed_at
+
+        flush_size = self._config("FLUSH_SIZE", DEFAULT_FLUSH_SIZE)
+        flush_interval = self._config("FLUSH_INTERVAL", DEFAULT_FLUSH_INTERVAL)
+        if pending_count >= flush_size or since_flush >= flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Writes out everything pending. Returns the number of rows written."""
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+            self._flushed_at = time.monotonic()
+
+        batch_size = self._config("INGEST_BATCH_SIZE", DEFAULT_INGEST_BATCH_SIZE)
+        delta = self._config("WRITE_DELTA", DEFAULT_WRITE_DELTA)
+        Statistic = models.Statistic
+        items = list(pending.items())
+        written = 0
+        for start in range(0, len(items), batch_size):
+            batch = dict(items[start : start + batch_size])
+            current = {
+                torrent_id: counts
+                for torrent_id, *counts in db.session.query(
+                    Statistic.torrent_id,
+                    Statistic.seed_count,
+                    Statistic.leech_count,
+                    Statistic.download_count,
+                ).filter(Statistic.torrent_id.in_(list(batch)))
+            }
+            now = datetime.utcnow()
+            rows = [
+                {
+                    "torrent_id": torrent_id,
+                    "seed_count": seeders,
+                    "leech_count": leechers,
+                    "download_count": completed,
+                    "last_updated": now,
+                }
+                for torrent_id, (seeders, leechers, completed) in batch.items()
+                if _significant(
+                    current.get(torrent_id), (seeders, leechers, completed), delta
+                )
+            ]
+            if rows:
+                _upsert_statistics(rows)
+            db.session.commit()
+            written += len(rows)
+        return written
+
+    def _flush_forever(self, flask_app):
+        while True:
+            time.sleep(self._config("FLUSH_INTERVAL", DEFAULT_FLUSH_INTERVAL))
+            with flask_app.app_context():
+                try:
+                    self.flush()
+                except Exception:
+                    flask_app.logger.exception("Flushing buffered stats failed")
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+
+    def _start_flusher(self):
+        """Starts the interval flush thread on first use"""
+        if self._flusher is not None:
+            return
+        with self._lock:
+            if self._flusher is None:
+                self._flusher = threading.Thread(
+                    target=self._flush_forever,
+                    args=(app._get_current_object(),),
+                    name="kyan-stats-flusher",
+                    daemon=True,
+                )
+                self._flusher.start()
+
+
+buffer = StatsBuffer()
+
+
+def flush_stats_at_exit(flask_app):
+    """Registered with atexit, so a stopping worker writes out the stats it has
+    already reported as ingested"""
+    with flask_app.app_context():
+        try:
+            buffer.flush()
+        except Exception:
+            flask_app.logger.exception("Failed to write buffered stats")
+
+
+def _upsert_statistics(rows):
+    statement = mysql.insert(models.Statistic.__table__).values(rows)
+    statement = statement.on_duplicate_key_update(
+        seed_count=statement.inserted.seed_count,
+        leech_count=statement.inserted.leech_count,
+        download_count=statement.inserted.download_count,
+        last_updated=statement.inserted.last_updated,
+    )
+    db.session.execute(statement)
+
+
+def _buffer_batch(records):
+    """Resolves one batch of records to torrents and queues them on the stats
+    buffer. Returns the number of distinct info hashes that matched a torrent."""
+    # Later records for the same hash win
+    latest = {record[0]: record[1:] for record in records}
+    torrent_ids = dict(
+        db.session.query(models.Torrent.info_hash, models.Torrent.id).filter(
+            models.Torrent.info_hash.in_(list(latest))
+        )
+    )
+    db.session.commit()
+    buffer.add(
+        {torrent_id: latest[info_hash] for info_hash, torrent_id in torrent_ids.items()}
+    )
+    return len(torrent_ids)
+
+
+def ingest(records, batch_size=None):
+    """Resolves (info_hash, seeders, leechers, completed) records to torrents in
+    batches of STATS.INGEST_BATCH_SIZE, with one indexed info_hash lookup per
+    batch, and queues them on the stats buffer. None entries count as invalid.
+    Returns a dict of counts."""
+    if batch_size is None:
+        batch_size = app.config.get("STATS", {}).get(
+            "INGEST_BATCH_SIZE", DEFAULT_INGEST_BATCH_SIZE
+        )
+
+    counts = {"received": 0, "matched": 0, "unknown": 0, "invalid": 0}
+    batch = []
+
+    def flush_batch():
+        matched = _buffer_batch(batch)
+        counts["matched"] += matched
+        counts["unknown"] += len({record[0] for record in batch}) - matched
+        batch.clear()
+
+    for record in records:
+        counts["received"] += 1
+        if record is None:
+            counts["invalid"] += 1
+            continue
+        batch.append(record)
+        if len(batch) >= batch_size:
+            flush_batch()
+    if batch:
+        flush_batch()
+    return counts
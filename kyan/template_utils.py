@@ -5,9 +5,10 @@ from datetime import datetime
 from email.utils import formatdate
 
 import flask
+from jinja2 import FileSystemBytecodeCache, TemplateError
 from werkzeug.urls import urlencode
 
-from kyan.backend import get_category_id_map
+from kyan import categories
 from kyan.torrents import create_magnet
 
 app = flask.current_app
@@ -15,6 +16,37 @@ bp = flask.Blueprint("template-utils", __name__)
 _static_cache = {}  # For static_cachebuster
 
 
+# ########################## TEMPLATE CACHE ##########################
+
+
+def init_bytecode_cache(flask_app):
+    """Keeps compiled templates on disk in TEMPLATES.BYTECODE_CACHE_DIR, so
+    workers share them and new workers skip compiling. Entries are keyed by the
+    template source, so edited templates are recompiled."""
+    cache_dir = flask_app.config.get("TEMPLATES", {}).get(
+        "BYTECODE_CACHE_DIR",
+        os.path.join(flask_app.config["GENERAL"]["BASE_DIR"], "template_cache"),
+    )
+    if not cache_dir:
+        return
+    os.makedirs(cache_dir, exist_ok=True)
+    flask_app.jinja_env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+
+
+def precompile_templates(flask_app):
+    """Loads every template into the environment's cache (and the bytecode
+    cache). Returns the number of templates loaded."""
+    loaded = 0
+    for name in flask_app.jinja_env.list_templates():
+        try:
+            flask_app.jinja_env.get_template(name)
+        except TemplateError:
+            flask_app.logger.exception("Failed to compile template %s", name)
+            continue
+        loaded += 1
+    return loaded
+
+
 # ######################## CONTEXT PROCESSORS ########################
 
 # For processing ES links
@@ -94,7 +126,7 @@ def filter_truthy(input_list):
 @bp.app_template_global()
 def category_name(cat_id):
     """Given a category id (eg. 1_2), returns a category name (eg. Anime - English-translated)"""
-    return " - ".join(get_category_id_map().get(cat_id, ["???"]))
+    return categories.get_registry().name_of(cat_id)
 
 
 # ######################### TEMPLATE FILTERS #########################
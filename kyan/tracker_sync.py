@@ -0,0 +1,148 @@
+import time
+from datetime import datetime, timedelta
+
+import flask
+import requests
+import sqlalchemy
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from kyan import models
+from kyan.extensions import db
+
+app = flask.current_app
+
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_POLL_INTERVAL = 5
+DEFAULT_RETRIES = 5
+DEFAULT_BACKOFF = 0.5
+DEFAULT_TIMEOUT = 10
+DEFAULT_CLAIM_TIMEOUT = 300
+
+
+class TrackerSyncError(Exception):
+    pass
+
+
+def _config(key, default):
+    return app.config.get("TRACKER_SYNC", {}).get(key, default)
+
+
+def create_session():
+    """A requests session that reuses connections to the tracker and retries
+    failed pushes with exponential backoff"""
+    retry = Retry(
+        total=_config("RETRIES", DEFAULT_RETRIES),
+        backoff_factor=_config("BACKOFF", DEFAULT_BACKOFF),
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=None,
+    )
+    session = requests.Session()
+    session.mount("http://", HTTPAdapter(max_retries=retry))
+    session.mount("https://", HTTPAdapter(max_retries=retry))
+    session.headers["Authorization"] = app.config["GENERAL"]["TRACKER_API_AUTH"]
+    return session
+
+
+def collapse(rows):
+    """Reduces TrackerApi rows (oldest first) to the last method per info hash, so
+    an insert followed by a remove only sends the remove, and vice versa.
+    Returns (insert, remove) lists of info hashes."""
+    last_method = {}
+    for row in rows:
+        last_method[row.info_hash] = row.method
+    insert = [h for h, method in last_method.items() if method == "insert"]
+    remove = [h for h, method in last_method.items() if method == "remove"]
+    return insert, remove
+
+
+def push(session, insert, remove):
+    """POSTs {"insert": [hex info hashes], "remove": [hex info hashes]} to
+    GENERAL.TRACKER_API_URL, authorized with GENERAL.TRACKER_API_AUTH"""
+    response = session.post(
+        app.config["GENERAL"]["TRACKER_API_URL"],
+        json={
+            "insert": [info_hash.hex() for info_hash in insert],
+            "remove": [info_hash.hex() for info_hash in remove],
+        },
+        timeout=_config("TIMEOUT", DEFAULT_TIMEOUT),
+    )
+    if response.status_code != 200:
+        raise TrackerSyncError(
+            "Tracker API returned HTTP {}".format(response.status_code)
+        )
+
+
+def _claim_batch():
+    """Claims up to TRACKER_SYNC.BATCH_SIZE of the oldest unclaimed rows, or rows
+    whose claim is older than TRACKER_SYNC.CLAIM_TIMEOUT (left by a dead worker),
+    and commits. Rows locked by another worker are skipped. Only this short
+    transaction holds locks on the table, not the push."""
+    TrackerApi = models.TrackerApi
+    now = datetime.utcnow()
+    stale = now - timedelta(seconds=_config("CLAIM_TIMEOUT", DEFAULT_CLAIM_TIMEOUT))
+    rows = (
+        db.session.query(TrackerApi.id, TrackerApi.info_hash, TrackerApi.method)
+        .filter(
+            sqlalchemy.or_(
+                TrackerApi.claimed_time.is_(None), TrackerApi.claimed_time < stale
+            )
+        )
+        .order_by(TrackerApi.id)
+        .limit(_config("BATCH_SIZE", DEFAULT_BATCH_SIZE))
+        .with_for_update(skip_locked=True)
+        .all()
+    )
+    if rows:
+        TrackerApi.query.filter(TrackerApi.id.in_([row.id for row in rows])).update(
+            {"claimed_time": now}, synchronize_session=False
+        )
+    db.session.commit()
+    return rows
+
+
+def sync_batch(session):
+    """Claims a batch of rows, pushes them and deletes them. If the push fails
+    the claim is released, so the rows stay queued. Returns the number of rows
+    handled."""
+    rows = _claim_batch()
+    if not rows:
+        return 0
+
+    batch = models.TrackerApi.query.filter(
+        models.TrackerApi.id.in_([row.id for row in rows])
+    )
+    try:
+        push(session, *collapse(rows))
+    except (requests.RequestException, TrackerSyncError):
+        batch.update({"claimed_time": None}, synchronize_session=False)
+        db.session.commit()
+        raise
+
+    batch.delete(synchronize_session=False)
+    db.session.commit()
+    return len(rows)
+
+
+def run(once=False):
+    """Drains the TrackerApi table, then (unless once) keeps polling it every
+    TRACKER_SYNC.POLL_INTERVAL seconds"""
+    poll_interval = _config("POLL_INTERVAL", DEFAULT_POLL_INTERVAL)
+    session = create_session()
+    total = 0
+    while True:
+        try:
+            synced = sync_batch(session)
+        except (requests.RequestException, TrackerSyncError):
+            if once:
+                raise
+            app.logger.exception("Pushing to the tracker API failed")
+            synced = 0
+        finally:
+            db.session.remove()
+
+        total += synced
+        if not synced:
+            if once:
+                return total
+            time.sleep(poll_interval)
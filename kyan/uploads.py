@@ -0,0 +1,261 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from ipaddress import ip_address
+
+import flask
+import sqlalchemy
+from wtforms.validators import ValidationError
+
+from kyan import backend, forms, models
+from kyan.extensions import db
+
+app = flask.current_app
+
+DEFAULT_WORKERS = 2
+DEFAULT_BATCH_VALIDATION_WORKERS = 4
+DEFAULT_BATCH_COMMIT_SIZE = 50
+DEFAULT_PROCESSING_TIMEOUT = 600
+# Seconds between checks for uploads abandoned by dead workers
+SWEEP_INTERVAL = 60
+
+_executor = None
+_executor_lock = threading.Lock()
+_sweep_lock = threading.Lock()
+_swept_at = None
+
+
+def _get_executor():
+    """Returns the upload worker pool, creating it on first use"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            workers = app.config.get("UPLOADS", {}).get("WORKERS", DEFAULT_WORKERS)
+            _executor = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="kyan-upload"
+            )
+        return _executor
+
+
+def sweep_stale_uploads():
+    """Every SWEEP_INTERVAL seconds, fails uploads that have been processing for
+    longer than UPLOADS.PROCESSING_TIMEOUT and requeues uploads that have been
+    pending that long, as the worker that had them most likely died. The first
+    sweep in a process requeues every pending upload."""
+    global _swept_at
+    now = time.monotonic()
+    with _sweep_lock:
+        first_sweep = _swept_at is None
+        if not first_sweep and now - _swept_at < SWEEP_INTERVAL:
+            return
+        _swept_at = now
+
+    PendingUpload = models.PendingUpload
+    timeout = app.config.get("UPLOADS", {}).get(
+        "PROCESSING_TIMEOUT", DEFAULT_PROCESSING_TIMEOUT
+    )
+    cutoff = datetime.utcnow() - timedelta(seconds=timeout)
+
+    stale_ids = [
+        pending_id
+        for (pending_id,) in db.session.query(PendingUpload.id).filter(
+            PendingUpload.status == models.PendingUploadStatus.PROCESSING,
+            PendingUpload.updated_time < cutoff,
+        )
+    ]
+    for pending_id in stale_ids:
+        # A worker that is merely slow may still finish the upload first
+        if PendingUpload.query.filter_by(
+            id=pending_id, status=models.PendingUploadStatus.PROCESSING
+        ).update({"status": models.PendingUploadStatus.FAILED}, False):
+            _fail(pending_id, {"torrent_file": ["Processing timed out"]})
+
+    pending_uploads = db.session.query(PendingUpload.id).filter(
+        PendingUpload.status == models.PendingUploadStatus.PENDING
+    )
+    if not first_sweep:
+        pending_uploads = pending_uploads.filter(PendingUpload.updated_time < cutoff)
+    # Claiming is atomic, so requeueing an upload that is still queued is harmless
+    for (pending_id,) in pending_uploads.all():
+        _submit(pending_id)
+
+
+def _submit(pending_id, torrent_data=None):
+    flask_app = app._get_current_object()
+    _get_executor().submit(_process_in_app_context, flask_app, pending_id, torrent_data)
+
+
+def enqueue_upload(upload_form, uploading_user=None):
+    """Runs the cheap request-time checks, stores the raw torrent file and queues
+    the rest of the upload for the worker pool. Returns the PendingUpload."""
+    backend.check_upload_allowed(upload_form, uploading_user)
+    torrent_data = upload_form.torrent_file.parsed_data
+
+    pending = models.PendingUpload(
+        uploader_id=uploading_user.id if uploading_user else None,
+        uploader_ip=ip_address(flask.request.remote_addr).packed,
+        info_hash=torrent_data.info_hash,
+        filename=torrent_data.filename,
+        upload_values=json.dumps(backend.get_upload_values(upload_form)),
+    )
+    db.session.add(pending)
+    db.session.commit()
+
+    raw_path = pending.raw_path
+    os.makedirs(os.path.dirname(raw_path), exist_ok=True)
+    torrent_file = upload_form.torrent_file.data
+    torrent_file.seek(0, 0)
+    torrent_file.save(raw_path)
+    torrent_file.close()
+
+    sweep_stale_uploads()
+    # The form already decoded and validated the torrent
+    _submit(pending.id, torrent_data)
+    return pending
+
+
+def _process_in_app_context(flask_app, pending_id, torrent_data):
+    with flask_app.app_context():
+        try:
+            process_upload(pending_id, torrent_data)
+        except Exception:
+            flask_app.logger.exception("Pending upload %s failed", pending_id)
+            db.session.rollback()
+            _fail(pending_id, {"torrent_file": ["Internal error while processing"]})
+        finally:
+            db.session.remove()
+
+
+def _fail(pending_id, errors):
+    pending = models.PendingUpload.by_id(pending_id)
+    pending.status = models.PendingUploadStatus.FAILED
+    pending.errors = json.dumps(errors)
+    db.session.commit()
+    if os.path.exists(pending.raw_path):
+        os.remove(pending.raw_path)
+
+
+def process_upload(pending_id, torrent_data=None):
+    """Turns a claimed pending upload into a Torrent. Does the file tree, tracker
+    and info_dict work that handle_torrent_upload does in-request.
+
+    torrent_data is the TorrentFileData the upload form parsed. Uploads requeued
+    without it (e.g. after a restart) are decoded again from the stored file."""
+    if not models.PendingUpload.claim(pending_id):
+        return
+
+    pending = models.PendingUpload.by_id(pending_id)
+    with open(pending.raw_path, "rb") as in_file:
+        raw_torrent = in_file.read()
+
+    try:
+        if torrent_data is None:
+            torrent_data = forms.parse_torrent_data(raw_torrent, pending.filename)
+        existing_torrent = models.Torrent.by_info_hash(torrent_data.info_hash)
+        torrent_data.db_id = forms.check_existing_torrent(existing_torrent)
+    except ValidationError as e:
+        return _fail(pending_id, {"torrent_file": list(e.args)})
+
+    try:
+        torrent = backend.create_torrent(
+            torrent_data,
+            json.loads(pending.upload_values),
+            pending.uploader,
+            pending.uploader_ip,
+            commit=False,
+        )
+        # In the same transaction, so the upload is never counted twice against
+        # the ratelimit, nor left processing once the torrent exists
+        pending.torrent_id = torrent.id
+        pending.status = models.PendingUploadStatus.DONE
+        db.session.commit()
+    except backend.TorrentExtraValidationException as e:
+        db.session.rollback()
+        return _fail(pending_id, e.errors)
+    except sqlalchemy.exc.IntegrityError:
+        # Somebody else uploaded the same torrent in the meantime
+        db.session.rollback()
+        try:
+            forms.check_existing_torrent(models.Torrent.by_info_hash(pending.info_hash))
+        except ValidationError as e:
+            return _fail(pending_id, {"torrent_file": list(e.args)})
+        raise
+
+    if app.config.get("BACKUP_TORRENT_FOLDER"):
+        backup_path = backend.get_backup_torrent_path(torrent, pending.filename)
+        with open(backup_path, "wb") as out_file:
+            out_file.write(raw_torrent)
+    # Gone if the upload timed out and the sweep removed it
+    if os.path.exists(pending.raw_path):
+        os.remove(pending.raw_path)
+
+
+def parse_torrents_parallel(named_files):
+    """Decodes and validates (filename, raw bytes) pairs on a thread pool.
+    Returns a (TorrentFileData or None, error or None) pair for each, in order."""
+    flask_app = app._get_current_object()
+    workers = app.config.get("UPLOADS", {}).get(
+        "BATCH_VALIDATION_WORKERS", DEFAULT_BATCH_VALIDATION_WORKERS
+    )
+
+    def parse(named_file):
+        filename, raw_torrent = named_file
+        with flask_app.app_context():
+            try:
+                return forms.parse_torrent_data(raw_torrent, filename), None
+            except ValidationError as e:
+                return None, e.args[0]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(parse, named_files))
+
+
+def create_torrents_batch(entries, uploading_user, uploader_ip):
+    """Creates torrents for (torrent_data, upload_values, raw bytes) entries,
+    committing every UPLOADS.BATCH_COMMIT_SIZE torrents. Each torrent gets its own
+    savepoint, so one bad torrent does not roll back the rest.
+    Returns a Torrent or an errors dict per entry, in order."""
+    commit_size = app.config.get("UPLOADS", {}).get(
+        "BATCH_COMMIT_SIZE", DEFAULT_BATCH_COMMIT_SIZE
+    )
+
+    results = []
+    uncommitted = 0
+    for torrent_data, upload_values, _ in entries:
+        try:
+            with db.session.begin_nested():
+                torrent = backend.create_torrent(
+                    torrent_data,
+                    upload_values,
+                    uploading_user,
+                    uploader_ip,
+                    commit=False,
+                )
+        except backend.TorrentExtraValidationException as e:
+            results.append(e.errors)
+            continue
+        except sqlalchemy.exc.IntegrityError:
+            # Somebody else uploaded the same torrent in the meantime
+            results.append({"torrent_file": ["This torrent already exists"]})
+            continue
+
+        results.append(torrent)
+        uncommitted += 1
+        if uncommitted >= commit_size:
+            db.session.commit()
+            uncommitted = 0
+    db.session.commit()
+
+    if app.config.get("BACKUP_TORRENT_FOLDER"):
+        for result, (torrent_data, _, raw_torrent) in zip(results, entries):
+            if isinstance(result, models.Torrent):
+                backup_path = backend.get_backup_torrent_path(
+                    result, torrent_data.filename
+                )
+                with open(backup_path, "wb") as out_file:
+                    out_file.write(raw_torrent)
+
+    return results
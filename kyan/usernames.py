@@ -0,0 +1,190 @@
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+import flask
+import sqlalchemy
+from sqlalchemy import func, orm
+
+from kyan import models
+from kyan.extensions import db
+from kyan.utils import VersionedSnapshot, call_after_commit
+
+app = flask.current_app
+
+# Renames and hand edits in the database are picked up by a full rebuild
+DEFAULT_REBUILD_INTERVAL = 3600
+DEFAULT_REFRESH_INTERVAL = 5
+DEFAULT_FALSE_POSITIVE_RATE = 0.01
+DEFAULT_CACHE_SIZE = 10000
+# Headroom for registrations before the filter is rebuilt bigger
+CAPACITY_FACTOR = 2
+MIN_CAPACITY = 1024
+
+UserRef = namedtuple("UserRef", ["id", "username"])
+
+
+def _config(key, default):
+    return app.config.get("USERNAMES", {}).get(key, default)
+
+
+def _key(username):
+    """Usernames are ascii_general_ci: case-insensitive, trailing spaces ignored.
+    Returns None for names that can never match."""
+    if not username.isascii():
+        return None
+    return username.rstrip(" ").lower().encode("ascii")
+
+
+class BloomFilter(object):
+    """A bit array answering "definitely absent" or "maybe present" for byte
+    strings, in about 10 bits per key at a 1% false positive rate"""
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.num_bits = max(
+            8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        )
+        self.num_hashes = max(1, int(round(self.num_bits / capacity * math.log(2))))
+        self._bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.num_bits for i in range(self.num_hashes))
+
+    def add(self, key):
+        for position in self._positions(key):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        bits = self._bits
+        return all(
+            bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(key)
+        )
+
+
+class UsernameIndex(object):
+    """Every username in a Bloom filter, plus an LRU cache of looked up names.
+
+    Names the filter rules out are answered without a database query. The
+    filter picks up users registered by other processes by polling for ids above
+    the highest one it has seen, every USERNAMES.REFRESH_INTERVAL seconds."""
+
+    def __init__(self, capacity, max_id):
+        self._bloom = BloomFilter(
+            capacity, _config("FALSE_POSITIVE_RATE", DEFAULT_FALSE_POSITIVE_RATE)
+        )
+        self._count = 0
+        self._max_id = max_id
+        self._lock = threading.Lock()
+        self._refreshed_at = time.monotonic()
+        self._cache = OrderedDict()
+        self._cache_size = _config("CACHE_SIZE", DEFAULT_CACHE_SIZE)
+
+    def add(self, user_id, username):
+        key = _key(username)
+        if key is None:
+            return
+        with self._lock:
+            self._bloom.add(key)
+            self._count += 1
+            self._max_id = max(self._max_id, user_id)
+            # Forget a cached "no such user" for the name
+            self._cache.pop(key, None)
+            over_capacity = self._count == self._bloom.capacity + 1
+        if over_capacity:
+            _snapshot.invalidate()
+
+    def refresh_if_due(self):
+        now = time.monotonic()
+        interval = _config("REFRESH_INTERVAL", DEFAULT_REFRESH_INTERVAL)
+        if now - self._refreshed_at < interval:
+            return
+        self._refreshed_at = now
+        query = db.session.query(models.User.id, models.User.username).filter(
+            models.User.id > self._max_id
+        )
+        for user_id, username in query:
+            self.add(user_id, username)
+
+    def might_exist(self, username):
+        """Returns False if no user has the name, without a database query"""
+        key = _key(username)
+        return key is not None and key in self._bloom
+
+    def lookup(self, username):
+        """Returns the UserRef for a username (any case), or None"""
+        key = _key(username)
+        if key is None or key not in self._bloom:
+            return None
+
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        row = (
+            db.session.query(models.User.id, models.User.username)
+            .filter(models.User.username == username)
+            .first()
+        )
+        user_ref = UserRef(*row) if row else None
+        with self._lock:
+            self._cache[key] = user_ref
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        return user_ref
+
+
+def _load_index():
+    count, max_id = db.session.query(
+        func.count(models.User.id), func.max(models.User.id)
+    ).one()
+    index = UsernameIndex(max(count * CAPACITY_FACTOR, MIN_CAPACITY), max_id or 0)
+    query = db.session.query(models.User.id, models.User.username).yield_per(10000)
+    for user_id, username in query:
+        index.add(user_id, username)
+    return index
+
+
+_snapshot = VersionedSnapshot(
+    "usernames", _load_index, max_age=DEFAULT_REBUILD_INTERVAL
+)
+
+
+def get_index():
+    index = _snapshot.get()
+    index.refresh_if_due()
+    return index
+
+
+def might_exist(username):
+    return get_index().might_exist(username)
+
+
+def lookup(username):
+    return get_index().lookup(username)
+
+
+@sqlalchemy.event.listens_for(models.User, "after_insert")
+def _add_registered_user(mapper, connection, target):
+    user_id, username = target.id, target.username
+
+    def add_user():
+        # Not loaded yet means the next load reads the user anyway
+        index = _snapshot.peek()
+        if index is not None:
+            index.add(user_id, username)
+
+    call_after_commit(orm.object_session(target), ("usernames", user_id), add_user)
+
+
+@sqlalchemy.event.listens_for(models.User, "after_update")
+def _rebuild_on_rename(mapper, connection, target):
+    if sqlalchemy.inspect(target).attrs.username.history.has_changes():
+        call_after_commit(orm.object_session(target), _snapshot, _snapshot.invalidate)
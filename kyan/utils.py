@@ -1,10 +1,23 @@
 import hashlib
+import importlib
 import random
 import string
+import threading
+import time
 from collections import OrderedDict
-from functools import wraps
+from functools import partial, wraps
 
 import flask
+import sqlalchemy
+from sqlalchemy import orm
+
+from kyan.extensions import cache
+
+
+def lazy_module(name):
+    """Returns a function that imports the named module on first use and returns
+    it, for dependencies only some code paths need, so they do not slow startup"""
+    return partial(importlib.import_module, name)
 
 
 def sha1_hash(input_bytes):
@@ -32,16 +45,6 @@ def random_string(length, charset=None):
     return "".join(random.choice(charset) for _ in range(length))
 
 
-def cached_function(f):
-    @wraps(f)
-    def decorator(*args, **kwargs):
-        if not hasattr(f, "_cached_value"):
-            f._cached_value = f(*args, **kwargs)
-        return f._cached_value
-
-    return decorator
-
-
 def flatten_dict(d, result=None):
     if result is None:
         result = {}
@@ -87,3 +90,107 @@ def admin_only(f):
             flask.abort(401)
 
     return wrapper
+
+
+def call_after_commit(session, key, callback):
+    """Runs callback() once the session's current transaction commits.
+    Callbacks are deduplicated by key (the last one wins) and dropped if the
+    transaction rolls back, or if the savepoint they were added in does."""
+    if isinstance(session, orm.scoped_session):
+        session = session()
+    transaction = session.get_nested_transaction() or session.get_transaction()
+    session.info.setdefault("kyan_after_commit", {})[key] = (transaction, callback)
+
+
+# after_commit and after_rollback also fire when a savepoint is released or
+# rolled back, so both tell savepoints apart from the outermost transaction
+@sqlalchemy.event.listens_for(orm.Session, "after_commit")
+def _run_after_commit_callbacks(session):
+    if session.get_nested_transaction() is not None:
+        return
+    for _, callback in session.info.pop("kyan_after_commit", {}).values():
+        callback()
+
+
+@sqlalchemy.event.listens_for(orm.Session, "after_soft_rollback")
+def _drop_after_commit_callbacks(session, previous_transaction):
+    if previous_transaction.parent is None:
+        session.info.pop("kyan_after_commit", None)
+        return
+
+    callbacks = session.info.get("kyan_after_commit", {})
+    for key, (transaction, _) in list(callbacks.items()):
+        # Added in the rolled back savepoint, or in one inside it
+        while transaction is not None and transaction is not previous_transaction:
+            transaction = transaction.parent
+        if transaction is not None:
+            del callbacks[key]
+
+
+class VersionedSnapshot(object):
+    """An in-process copy of some database state, built by `loader` and rebuilt
+    when its version number in the shared cache changes.
+
+    Call invalidate() (or use invalidate_on_commit) after changing the underlying
+    rows; every process then reloads on its next check. The shared version is
+    checked at most once every `check_interval` seconds. If `max_age` is set, the
+    snapshot is also rebuilt that often, to pick up changes made outside the app."""
+
+    def __init__(self, name, loader, check_interval=5, max_age=None):
+        self.name = name
+        self._loader = loader
+        self._check_interval = check_interval
+        self._max_age = max_age
+        self._version_key = "snapshot_version:" + name
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._value = None
+        self._version = None
+        self._checked_at = 0
+        self._loaded_at = 0
+
+    def get(self):
+        now = time.monotonic()
+        if self._loaded and now - self._checked_at < self._check_interval:
+            return self._value
+
+        with self._lock:
+            # Read the version before loading, so the snapshot is never older
+            # than the version it is stored under
+            version = cache.get(self._version_key)
+            expired = (
+                self._max_age is not None and now - self._loaded_at >= self._max_age
+            )
+            if not self._loaded or expired or version != self._version:
+                self._value = self._loader()
+                self._version = version
+                self._loaded = True
+                self._loaded_at = now
+            self._checked_at = now
+            return self._value
+
+    def peek(self):
+        """Returns the snapshot as currently loaded, or None, without loading or
+        checking its version"""
+        return self._value if self._loaded else None
+
+    def invalidate(self):
+        """Sets a new shared version, so all processes reload the snapshot"""
+        cache.set(self._version_key, random_string(16), timeout=0)
+        self._loaded = False
+
+    def expire(self):
+        """Makes this process alone reload the snapshot on its next get()"""
+        self._loaded = False
+
+    def invalidate_on_commit(self, *model_classes):
+        """Invalidates the snapshot whenever a transaction that inserted, updated or
+        deleted rows of the given models commits"""
+
+        def mark_session(mapper, connection, target):
+            session = orm.object_session(target)
+            call_after_commit(session, self, self.invalidate)
+
+        for model_class in model_classes:
+            for event_name in ("after_insert", "after_update", "after_delete"):
+                sqlalchemy.event.listen(model_class, event_name, mark_session)
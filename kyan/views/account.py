@@ -6,7 +6,7 @@ from ipaddress import ip_address
 import flask
 from markupsafe import Markup
 
-from kyan import email, forms, models
+from kyan import bans, email, forms, models
 from kyan.extensions import db, limiter
 from kyan.utils import sha1_hash
 from kyan.views.users import (get_activation_link, get_password_reset_link,
@@ -154,7 +154,7 @@ def register():
                 "warning",
             )
 
-        elif models.RangeBan.is_rangebanned(user.registration_ip):
+        elif bans.is_rangebanned(user.registration_ip):
             flask.flash(
                 str(
                     Markup(
@@ -174,6 +174,7 @@ def register():
                 "USE_EMAIL_VERIFICATION"
             ]:  # force verification, enable email
                 send_verification_email(user)
+                db.session.commit()
                 return flask.render_template("waiting.html")
             else:  # disable verification, set user as active and auto log in
                 user.status = models.UserStatusType.ACTIVE
@@ -203,6 +204,7 @@ def password_reset(payload=None):
             user = models.User.by_email(form.email.data.strip())
             if user:
                 send_password_reset_request_email(user)
+                db.session.commit()
 
             flask.flash(
                 "A password reset request was sent to the provided email, if a matching account was found.",
@@ -237,9 +239,8 @@ def password_reset(payload=None):
             user.password_hash = form.password.data
 
             db.session.add(user)
-            db.session.commit()
-
             send_password_reset_email(user)
+            db.session.commit()
 
             flask.flash("Your password was reset. Log in now.", "info")
             return flask.redirect(flask.url_for("account.login"))
@@ -4,7 +4,7 @@ from ipaddress import ip_address
 import flask
 from markupsafe import Markup
 
-from kyan import email, forms, models
+from kyan import forms, jobs, models
 from kyan.extensions import db
 
 app = flask.current_app
@@ -84,47 +84,18 @@ def view_reports():
         if not torrent or not report or report.status != 0:
             flask.abort(404)
 
-        report_user = models.User.by_id(report.user_id)
-        log = "Report #{}: {} [#{}]({}), reported by [{}]({})"
-        if action == "delete":
-            torrent.deleted = True
-            report.status = 1
-            log = log.format(
-                report_id,
-                "Deleted",
-                torrent_id,
-                flask.url_for("torrents.view", torrent_id=torrent_id),
-                report_user.username,
-                flask.url_for("users.view_user", user_name=report_user.username),
-            )
-        elif action == "hide":
-            log = log.format(
-                report_id,
-                "Hid",
-                torrent_id,
-                flask.url_for("torrents.view", torrent_id=torrent_id),
-                report_user.username,
-                flask.url_for("users.view_user", user_name=report_user.username),
-            )
-            torrent.hidden = True
-            report.status = 1
-        else:
-            log = log.format(
-                report_id,
-                "Closed",
-                torrent_id,
-                flask.url_for("torrents.view", torrent_id=torrent_id),
-                report_user.username,
-                flask.url_for("users.view_user", user_name=report_user.username),
-            )
-            report.status = 2
-
-        adminlog = models.AdminLog(log=log, admin_id=flask.g.user.id)
-        db.session.add(adminlog)
-
-        models.Report.remove_reviewed(torrent_id)
+        job = jobs.enqueue(
+            "resolve_reports",
+            {
+                "admin_id": flask.g.user.id,
+                "reports": [{"report_id": report.id, "action": action}],
+            },
+            flask.g.user,
+        )
         db.session.commit()
-        flask.flash("Closed report #{}".format(report.id), "success")
+        flask.flash(
+            "Report #{} will be closed (job #{})".format(report.id, job.id), "success"
+        )
         return flask.redirect(flask.url_for("admin.reports"))
 
     return flask.render_template(
@@ -189,7 +160,14 @@ def view_trusted_application(app_id):
             elif decision_form.reject.data:
                 app.status = models.TrustedApplicationStatus.REJECTED
                 flask.flash("Application has been <b>rejected</b>.", "success")
-            _send_trusted_decision_email(app.submitter, bool(decision_form.accept.data))
+            jobs.enqueue(
+                "trusted_decision_email",
+                {
+                    "user_id": app.submitter.id,
+                    "is_accepted": bool(decision_form.accept.data),
+                },
+                flask.g.user,
+            )
             db.session.commit()
             return flask.redirect(
                 flask.url_for("admin.trusted_application", app_id=app_id)
@@ -219,15 +197,15 @@ def view_trusted_application(app_id):
     )
 
 
-def _send_trusted_decision_email(user, is_accepted):
-    email_msg = email.EmailHolder(
-        subject="Your {} Trusted Application was {}.".format(
-            app.config["GENERAL"]["GLOBAL_SITE_NAME"],
-            ("rejected", "accepted")[is_accepted],
-        ),
-        recipient=user,
-        text=flask.render_template("email/trusted.txt", is_accepted=is_accepted),
-        html=flask.render_template("email/trusted.html", is_accepted=is_accepted),
+@bp.route("/jobs", endpoint="jobs", methods=["GET"])
+def view_jobs():
+    if not flask.g.user or not flask.g.user.is_moderator:
+        flask.abort(403)
+
+    jobs.sweep_stale_jobs()
+    page = flask.request.args.get("p", flask.request.args.get("offset", 1, int), int)
+    job_list = models.Job.query.order_by(models.Job.id.desc()).paginate(
+        page=page, per_page=20
     )
 
-    email.send_email(email_msg)
+    return flask.render_template("admin_jobs.html", jobs=job_list)
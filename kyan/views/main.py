@@ -4,10 +4,10 @@ from datetime import datetime, timedelta, timezone
 from ipaddress import ip_address
 
 import flask
+import sqlalchemy
 from markupsafe import Markup
 
-from kyan import models
-from kyan.extensions import db
+from kyan import auth, bans, infohashes, listing, models, usernames
 from kyan.search import DEFAULT_PER_PAGE, _generate_query_string, search_db
 from kyan.utils import chain_get
 from kyan.views.account import logout
@@ -25,7 +25,7 @@ def not_found(error):
 def before_request():
     flask.g.user = None
     if "user_id" in flask.session:
-        user = models.User.by_id(flask.session["user_id"])
+        user = auth.get_session_user(flask.session["user_id"])
         if not user:
             return logout()
 
@@ -43,23 +43,26 @@ def before_request():
             flask.session.modified = True
 
         if not app.config["MAINTENANCE_MODE"]["ENABLED"]:
-            ip = ip_address(flask.request.remote_addr)
-            if user.last_login_ip != ip:
-                user.last_login_ip = ip.packed
-                db.session.add(user)
-                db.session.commit()
+            auth.update_login_ip(user, ip_address(flask.request.remote_addr).packed)
 
     # Check if user is banned on POST
     if flask.request.method == "POST":
         ip = ip_address(flask.request.remote_addr).packed
-        banned = models.Ban.banned(None, ip).first()
-        if banned:
+        if bans.is_ip_banned(ip):
             if flask.g.user:
                 return logout()
 
             return "You are banned.", 403
 
 
+@bp.teardown_app_request
+def teardown_request(exception):
+    try:
+        auth.flush_login_ips_if_due()
+    except sqlalchemy.exc.SQLAlchemyError:
+        app.logger.exception("Failed to write queued login IPs")
+
+
 @bp.route("/rss", defaults={"rss": True})
 @bp.route("/", defaults={"rss": False})
 def home(rss):
@@ -90,10 +93,10 @@ def home(rss):
 
     user_id = None
     if user_name:
-        user = models.User.by_username(user_name)
-        if not user:
+        user_ref = usernames.lookup(user_name)
+        if not user_ref:
             flask.abort(404)
-        user_id = user.id
+        user_id = user_ref.id
 
     special_results = {
         "first_word_user": None,
@@ -102,10 +105,11 @@ def home(rss):
     }
     # Add advanced features to searches (but not RSS or user searches)
     if search_term and not render_as_rss and not user_id:
-        # Check if the first word of the search is an existing user
+        # Check if the first word of the search is an existing user. Most first
+        # words are not, and the username index answers those without a query.
         user_word_match = re.match(r"^([a-zA-Z0-9_-]+) *(.*|$)", search_term)
         if user_word_match:
-            special_results["first_word_user"] = models.User.by_username(
+            special_results["first_word_user"] = usernames.lookup(
                 user_word_match.group(1)
             )
             special_results["query_sans_user"] = user_word_match.group(2)
@@ -114,14 +118,13 @@ def home(rss):
         infohash_match = re.match(r"(?i)^([a-f0-9]{40})$", search_term)
         base32_infohash_match = re.match(r"(?i)^([a-z0-9]{32})$", search_term)
         if infohash_match:
-            # Check for info hash in database
-            matched_torrent = models.Torrent.by_info_hash_hex(infohash_match.group(1))
-            special_results["infohash_torrent"] = matched_torrent
+            # Check for info hash in the index, which has the torrent id
+            info_hash = bytes.fromhex(infohash_match.group(1))
+            special_results["infohash_torrent"] = infohashes.lookup(info_hash)
         elif base32_infohash_match:
             # Convert base32 to info_hash
             info_hash = base64.b32decode(base32_infohash_match.group(1))
-            matched_torrent = models.Torrent.by_info_hash(info_hash)
-            special_results["infohash_torrent"] = matched_torrent
+            special_results["infohash_torrent"] = infohashes.lookup(info_hash)
 
     query_args = {
         "user": user_id,
@@ -153,7 +156,8 @@ def home(rss):
 
     query_args["term"] = search_term or ""
 
-    query = search_db(**query_args)
+    # Rows are fetched from the database as the response is written
+    query = search_db(**query_args, stream=True)
 
     if render_as_rss:
         return render_rss("Home", query, magnet_links=use_magnet_links)
@@ -161,24 +165,30 @@ def home(rss):
         rss_query_string = _generate_query_string(
             search_term, category, quality_filter, user_name
         )
-        return flask.render_template(
-            "home.html",
-            torrent_query=query,
-            search=query_args,
-            rss_filter=rss_query_string,
-            special_results=special_results,
+        # Take the flashes out of the session now, as the session cookie is
+        # sent before the streamed body
+        flask.get_flashed_messages(with_categories=True)
+        return flask.Response(
+            flask.stream_template(
+                "home.html",
+                torrent_query=query,
+                torrent_rows=listing.iter_torrent_rows(query.items),
+                search=query_args,
+                rss_filter=rss_query_string,
+                special_results=special_results,
+            )
         )
 
 
 def render_rss(label, query, magnet_links=False):
-    rss_xml = flask.render_template(
+    rss_xml = flask.stream_template(
         "rss.xml",
         magnet_links=magnet_links,
         term=label,
         site_url=flask.request.url_root,
         torrent_query=query,
     )
-    response = flask.make_response(rss_xml)
+    response = flask.Response(rss_xml)
     response.headers["Content-Type"] = "application/xml"
     # Cache for an hour
     response.headers["Cache-Control"] = "max-age={}".format(1 * 5 * 60)
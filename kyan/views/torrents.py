@@ -7,9 +7,8 @@ from markupsafe import Markup
 from sqlalchemy.orm import joinedload
 from werkzeug.datastructures import CombinedMultiDict
 
-from kyan import backend, forms, models, torrents
+from kyan import backend, categories, forms, models, torrents
 from kyan.extensions import db
-from kyan.utils import cached_function
 
 app = flask.current_app
 bp = flask.Blueprint("torrents", __name__)
@@ -95,7 +94,7 @@ def view_torrent(torrent_id):
 def edit_torrent(torrent_id):
     torrent = models.Torrent.by_id(torrent_id)
     form = forms.EditForm(flask.request.form)
-    form.category.choices = _create_upload_category_choices()
+    form.category.choices = categories.get_registry().choices
     delete_form = forms.DeleteForm()
     ban_form = None
 
@@ -489,20 +488,14 @@ def upload():
     upload_form = forms.UploadForm(
         CombinedMultiDict((flask.request.files, flask.request.form))
     )
-    upload_form.category.choices = _create_upload_category_choices()
+    upload_form.category.choices = categories.get_registry().choices
 
     show_ratelimit = False
     next_upload_time = None
     ratelimit_count = 0
 
     # Anonymous uploaders and non-trusted uploaders
-
-    no_or_new_account = not flask.g.user or (
-        flask.g.user.age < app.config["LIMITS"]["RATELIMIT_ACCOUNT_AGE"]
-        and not flask.g.user.is_trusted
-    )
-
-    if app.config["LIMITS"]["RATELIMIT_UPLOADS"] and no_or_new_account:
+    if backend.is_ratelimited_uploader(flask.g.user):
         now, ratelimit_count, next_upload_time = backend.check_uploader_ratelimit(
             flask.g.user
         )
@@ -531,22 +524,6 @@ def upload():
     )
 
 
-@cached_function
-def _create_upload_category_choices():
-    """Turns categories in the database into a list of (id, name)s"""
-    choices = [("", "[Select a category]")]
-    id_map = backend.get_category_id_map()
-
-    for key in sorted(id_map.keys()):
-        cat_names = id_map[key]
-        is_main_cat = key.endswith("_0")
-
-        # cat_name = is_main_cat and cat_names[0] or (' - ' + cat_names[1])
-        cat_name = " - ".join(cat_names)
-        choices.append((key, cat_name, is_main_cat))
-    return choices
-
-
 def _make_torrent_file(torrent):
     with open(torrent.info_dict_path, "rb") as in_file:
         bencoded_info = in_file.read()
@@ -1,13 +1,12 @@
 import binascii
 import time
 from ipaddress import ip_address
-from itertools import chain
 
 import flask
 from itsdangerous import BadSignature, URLSafeSerializer
 from markupsafe import Markup
 
-from kyan import forms, models
+from kyan import forms, jobs, listing, models, usernames
 from kyan.extensions import db
 from kyan.search import DEFAULT_PER_PAGE, _generate_query_string, search_db
 from kyan.utils import admin_only, chain_get, sha1_hash
@@ -18,7 +17,8 @@ bp = flask.Blueprint("users", __name__)
 
 @bp.route("/user/<user_name>", methods=["GET", "POST"])
 def view_user(user_name):
-    user = models.User.by_username(user_name)
+    user_ref = usernames.lookup(user_name)
+    user = models.User.by_id(user_ref.id) if user_ref else None
 
     if not user:
         flask.abort(404)
@@ -172,6 +172,7 @@ def view_user(user_name):
     return flask.render_template(
         "user.html",
         torrent_query=query,
+        torrent_rows=listing.iter_torrent_rows(query.items),
         search=query_args,
         user=user,
         user_page=True,
@@ -261,25 +262,14 @@ def nuke_user_torrents(user_name):
     if not nuke_form.validate():
         flask.abort(401)
     url = flask.url_for("users.view_user", user_name=user.username)
-    kyan_banned = 0
-    for t in chain(user.torrents):
-        t.deleted = True
-        t.banned = True
-        t.stats.seed_count = 0
-        t.stats.leech_count = 0
-        db.session.add(t)
-        if isinstance(t, models.Torrent):
-            db.session.add(models.TrackerApi(t.info_hash, "remove"))
-            kyan_banned += 1
-
-    for log_flavour, num in ((models.AdminLog, kyan_banned),):
-        if num > 0:
-            log = "Nuked {0} torrents of [{1}]({2})".format(num, user.username, url)
-            adminlog = log_flavour(log=log, admin_id=flask.g.user.id)
-            db.session.add(adminlog)
-
+    job = jobs.enqueue(
+        "nuke_torrents", {"user_id": user.id, "admin_id": flask.g.user.id}, flask.g.user
+    )
     db.session.commit()
-    flask.flash("Torrents of {0} have been nuked.".format(user.username), "success")
+    flask.flash(
+        "Torrents of {0} will be nuked (job #{1}).".format(user.username, job.id),
+        "success",
+    )
     return flask.redirect(url)
 
 
@@ -294,25 +284,14 @@ def nuke_user_comments(user_name):
     if not nuke_form.validate():
         flask.abort(401)
     url = flask.url_for("users.view_user", user_name=user.username)
-    kyan_deleted = 0
-    kyan_torrents = {}
-    for c in chain(user.comments):
-        kyan_torrents[c.torrent_id] = None
-        db.session.delete(c)
-        if isinstance(c, models.Comment):
-            kyan_deleted += 1
-
-    for tid in kyan_torrents.keys():
-        models.Torrent.update_comment_count_db(tid)
-
-    for log_flavour, num in ((models.AdminLog, kyan_deleted),):
-        if num > 0:
-            log = "Nuked {0} comments of [{1}]({2})".format(num, user.username, url)
-            adminlog = log_flavour(log=log, admin_id=flask.g.user.id)
-            db.session.add(adminlog)
-
+    job = jobs.enqueue(
+        "nuke_comments", {"user_id": user.id, "admin_id": flask.g.user.id}, flask.g.user
+    )
     db.session.commit()
-    flask.flash("Comments of {0} have been nuked.".format(user.username), "success")
+    flask.flash(
+        "Comments of {0} will be nuked (job #{1}).".format(user.username, job.id),
+        "success",
+    )
     return flask.redirect(url)
 
 
@@ -0,0 +1,114 @@
+import os
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import yaml
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# kyan reads config.yaml from the working directory when it is imported, so the
+# tests run from a directory with a copy of the example config
+_test_dir = tempfile.mkdtemp(prefix="kyan-tests-")
+with open(os.path.join(ROOT_DIR, "config.yaml.example")) as example_file:
+    _config = yaml.safe_load(example_file)
+_config["DEBUG"] = False
+_config["BACKUP_TORRENT_FOLDER"] = None
+_config["GENERAL"].update(
+    BASE_DIR=_test_dir,
+    SQLALCHEMY_DATABASE_URI="sqlite:///" + os.path.join(_test_dir, "kyan.db"),
+    EMAIL_BLACKLIST=[],
+    BOOTSTRAP_ON_START=False,
+)
+_config["TEMPLATES"].update(BYTECODE_CACHE_DIR="", PRECOMPILE=False)
+with open(os.path.join(_test_dir, "config.yaml"), "w") as config_file:
+    yaml.safe_dump(_config, config_file)
+os.chdir(_test_dir)
+
+
+@pytest.fixture(scope="session")
+def app():
+    from kyan import create_app
+
+    return create_app()
+
+
+@pytest.fixture
+def app_context(app):
+    with app.app_context():
+        yield app
+
+
+@pytest.fixture
+def create_tables(app_context):
+    """Creates the tables of the given models for one test. The models use MySQL
+    column types, so only the tables a test needs are created in SQLite."""
+    from kyan.extensions import db
+
+    created = []
+
+    def create(*model_classes):
+        for model_class in model_classes:
+            model_class.__table__.create(db.engine)
+            created.append(model_class.__table__)
+
+    yield create
+    db.session.remove()
+    for table in reversed(created):
+        table.drop(db.engine)
+
+
+class StubHTTPServer(object):
+    """An HTTP server on localhost for the tests to point clients at.
+    `respond(handler)` returns (status, headers, body) for each request;
+    handler.body holds the request body, and every handler is kept in requests."""
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _handle(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                self.body = self.rfile.read(length)
+                stub.requests.append(self)
+                status, headers, body = stub.respond(self)
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = do_POST = _handle
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self.url = "http://127.0.0.1:{}".format(self._server.server_port)
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+@pytest.fixture
+def http_stub():
+    """Starts StubHTTPServers, all stopped after the test"""
+    servers = []
+
+    def start(respond):
+        server = StubHTTPServer(respond)
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.close()
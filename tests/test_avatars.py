@@ -0,0 +1,165 @@
+import os
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from kyan import avatars, models
+
+IMAGE = b"\x89PNG fake avatar"
+
+
+@pytest.fixture
+def gravatar(app_context, http_stub, monkeypatch, tmp_path):
+    """A fake Gravatar answering /avatar/<name> with `images[name]`, a 404 for
+    unknown names, and slowly for names in `slow`"""
+    images = {"known": IMAGE}
+    slow = set()
+
+    def respond(handler):
+        name = handler.path.rsplit("/", 1)[-1]
+        if name in slow:
+            time.sleep(1)
+        if name not in images:
+            return 404, {}, b""
+        etag = '"{}"'.format(len(images[name]))
+        if handler.headers.get("If-None-Match") == etag:
+            return 304, {"ETag": etag}, b""
+        return 200, {"Content-Type": "image/png", "ETag": etag}, images[name]
+
+    stub = http_stub(respond)
+    stub.images = images
+    stub.slow = slow
+    monkeypatch.setitem(
+        app_context.config,
+        "AVATARS",
+        dict(
+            CACHE_DIR=str(tmp_path),
+            FRESH_FOR=3600,
+            MISSING_FRESH_FOR=3600,
+            TIMEOUT=[1, 0.2],
+        ),
+    )
+    monkeypatch.setattr(avatars, "_estimated_size", None)
+    return stub
+
+
+def _url(stub, name):
+    return stub.url + "/avatar/" + name
+
+
+def _read(avatar):
+    with open(avatar.path, "rb") as in_file:
+        return in_file.read()
+
+
+def _age_entries(monkeypatch, seconds):
+    now = time.time()
+    monkeypatch.setattr(avatars, "time", SimpleNamespace(time=lambda: now + seconds))
+
+
+def test_miss_fetches_and_stores_the_avatar(gravatar):
+    avatar = avatars.get_avatar(_url(gravatar, "known"))
+
+    assert _read(avatar) == IMAGE
+    assert avatar.content_type == "image/png"
+    assert len(gravatar.requests) == 1
+
+
+def test_hit_is_served_from_disk(gravatar):
+    first = avatars.get_avatar(_url(gravatar, "known"))
+    second = avatars.get_avatar(_url(gravatar, "known"))
+
+    assert second == first
+    assert len(gravatar.requests) == 1
+
+
+def test_stale_avatar_is_revalidated(gravatar, monkeypatch):
+    first = avatars.get_avatar(_url(gravatar, "known"))
+    _age_entries(monkeypatch, 7200)
+
+    assert avatars.get_avatar(_url(gravatar, "known")) == first
+    assert len(gravatar.requests) == 2
+    assert gravatar.requests[1].headers["If-None-Match"] == '"{}"'.format(len(IMAGE))
+
+
+def test_upstream_404_is_remembered(gravatar):
+    assert avatars.get_avatar(_url(gravatar, "unknown")) is None
+    assert avatars.get_avatar(_url(gravatar, "unknown")) is None
+
+    assert len(gravatar.requests) == 1
+
+
+def test_upstream_timeout_without_a_cached_copy(gravatar):
+    gravatar.slow.add("known")
+
+    assert avatars.get_avatar(_url(gravatar, "known")) is None
+
+
+def test_upstream_timeout_serves_the_stale_copy(gravatar, monkeypatch):
+    first = avatars.get_avatar(_url(gravatar, "known"))
+    gravatar.slow.add("known")
+    _age_entries(monkeypatch, 7200)
+
+    assert avatars.get_avatar(_url(gravatar, "known")) == first
+    assert _read(first) == IMAGE
+
+
+def test_identical_images_share_a_blob(gravatar):
+    gravatar.images["other"] = IMAGE
+
+    first = avatars.get_avatar(_url(gravatar, "known"))
+    second = avatars.get_avatar(_url(gravatar, "other"))
+
+    assert first.path == second.path
+
+
+def test_evicted_blob_is_fetched_again(gravatar):
+    first = avatars.get_avatar(_url(gravatar, "known"))
+    os.remove(first.path)
+
+    avatar, avatar_file = avatars.open_avatar(_url(gravatar, "known"))
+    with avatar_file:
+        assert avatar_file.read() == IMAGE
+    assert avatar == first
+    assert len(gravatar.requests) == 2
+
+
+def test_blob_evicted_between_lookup_and_open(gravatar, monkeypatch):
+    get_avatar = avatars.get_avatar
+    # Found in the cache, then evicted before it is opened
+    lookups = [get_avatar(_url(gravatar, "known"))]
+    os.remove(lookups[0].path)
+    monkeypatch.setattr(
+        avatars, "get_avatar", lambda url: lookups.pop() if lookups else get_avatar(url)
+    )
+
+    avatar, avatar_file = avatars.open_avatar(_url(gravatar, "known"))
+    with avatar_file:
+        assert avatar_file.read() == IMAGE
+
+
+def test_evicted_blob_gone_upstream(gravatar):
+    first = avatars.get_avatar(_url(gravatar, "known"))
+    os.remove(first.path)
+    del gravatar.images["known"]
+
+    assert avatars.open_avatar(_url(gravatar, "known")) is None
+
+
+def test_proxy_serves_an_evicted_avatar(gravatar, app_context, monkeypatch):
+    user = SimpleNamespace(gravatar_url=lambda: _url(gravatar, "known"))
+    monkeypatch.setattr(models.User, "by_username", lambda username: user)
+    monkeypatch.setitem(
+        app_context.config,
+        "GENERAL",
+        dict(app_context.config["GENERAL"], ENABLE_GRAVATAR=True),
+    )
+    client = app_context.test_client()
+    os.remove(avatars.get_avatar(_url(gravatar, "known")).path)
+
+    response = client.get("/api/avatar/someone")
+
+    assert response.status_code == 200
+    assert response.data == IMAGE
+    assert response.content_length == len(IMAGE)
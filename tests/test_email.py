@@ -0,0 +1,210 @@
+import smtplib
+import socketserver
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+from kyan import email, models
+from kyan.extensions import db
+
+
+class StubSMTPServer(socketserver.ThreadingTCPServer):
+    """Just enough of an SMTP server on localhost for smtplib. Delivered messages
+    go to `messages` as (sender, recipients, data); recipients in `refuse` get a
+    temporary failure instead."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StubSMTPHandler)
+        self.messages = []
+        self.refuse = set()
+
+
+class StubSMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode("ascii") + b"\r\n")
+
+    def handle(self):
+        self.reply("220 stub ESMTP")
+        sender, recipients = None, []
+        for raw_line in self.rfile:
+            command = raw_line.decode("ascii").rstrip("\r\n")
+            verb = command[:4].upper()
+            if verb in ("EHLO", "HELO"):
+                self.reply("250 stub")
+            elif verb == "MAIL":
+                sender, recipients = command.split(":", 1)[1].strip(" <>"), []
+                self.reply("250 OK")
+            elif verb == "RCPT":
+                recipient = command.split(":", 1)[1].strip(" <>")
+                if recipient in self.server.refuse:
+                    self.reply("450 Mailbox unavailable")
+                else:
+                    recipients.append(recipient)
+                    self.reply("250 OK")
+            elif verb == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                lines = []
+                for data_line in self.rfile:
+                    if data_line == b".\r\n":
+                        break
+                    lines.append(data_line)
+                self.server.messages.append((sender, recipients, b"".join(lines)))
+                self.reply("250 OK")
+            elif verb in ("RSET", "NOOP"):
+                self.reply("250 OK")
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Not implemented")
+
+
+@pytest.fixture
+def smtp_server(app_context, create_tables, monkeypatch):
+    """Sends the outbox over SMTP to a StubSMTPServer"""
+    create_tables(models.OutboxEmail)
+    server = StubSMTPServer()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    # The stub speaks neither STARTTLS nor AUTH
+    def connect(transport):
+        return smtplib.SMTP(*server.server_address, timeout=5)
+
+    monkeypatch.setattr(email.SMTPTransport, "_connect", connect)
+    monkeypatch.setitem(
+        app_context.config,
+        "EMAIL",
+        dict(
+            app_context.config["EMAIL"],
+            BACKEND="smtp",
+            QUEUE=True,
+            MAX_ATTEMPTS=2,
+            RETRY_BACKOFF=60,
+        ),
+    )
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _queue_email(recipient):
+    email.send_email(
+        email.EmailHolder(
+            subject="Hello", recipient=recipient, text="Plain text", html="<p>HTML</p>"
+        )
+    )
+    db.session.commit()
+
+
+def _outbox():
+    db.session.expire_all()
+    return {row.recipient: row for row in models.OutboxEmail.query}
+
+
+def _make_due():
+    models.OutboxEmail.query.update({"next_attempt_time": datetime.utcnow()})
+    db.session.commit()
+
+
+def test_sends_queued_emails_and_marks_them_sent(smtp_server):
+    _queue_email("first@example.com")
+    _queue_email("second@example.com")
+    assert not smtp_server.messages
+
+    assert email.run_worker(once=True) == (2, 0)
+
+    assert sorted(recipients for _, recipients, _ in smtp_server.messages) == [
+        ["first@example.com"],
+        ["second@example.com"],
+    ]
+    assert b"Subject: Hello" in smtp_server.messages[0][2]
+    for row in _outbox().values():
+        assert row.status == models.OutboxEmailStatus.SENT
+        assert row.attempts == 1
+        assert row.sent_time is not None
+
+    # Nothing is sent twice
+    assert email.run_worker(once=True) == (0, 0)
+    assert len(smtp_server.messages) == 2
+
+
+def test_retries_failed_emails_later(smtp_server):
+    smtp_server.refuse.add("later@example.com")
+    _queue_email("later@example.com")
+    _queue_email("now@example.com")
+
+    assert email.run_worker(once=True) == (1, 1)
+
+    row = _outbox()["later@example.com"]
+    assert row.status == models.OutboxEmailStatus.QUEUED
+    assert row.attempts == 1
+    assert "later@example.com" in row.last_error
+    assert row.next_attempt_time > datetime.utcnow() + timedelta(seconds=50)
+
+    # Not due yet
+    assert email.run_worker(once=True) == (0, 0)
+
+    smtp_server.refuse.clear()
+    _make_due()
+    assert email.run_worker(once=True) == (1, 0)
+
+    row = _outbox()["later@example.com"]
+    assert row.status == models.OutboxEmailStatus.SENT
+    assert row.attempts == 2
+    assert len(smtp_server.messages) == 2
+
+
+def test_gives_up_after_max_attempts(smtp_server):
+    smtp_server.refuse.add("never@example.com")
+    _queue_email("never@example.com")
+
+    for _ in range(2):
+        assert email.run_worker(once=True) == (0, 1)
+        _make_due()
+
+    row = _outbox()["never@example.com"]
+    assert row.status == models.OutboxEmailStatus.FAILED
+    assert row.attempts == 2
+    assert email.run_worker(once=True) == (0, 0)
+    assert not smtp_server.messages
+
+
+def test_reconnects_when_the_server_drops_the_connection(smtp_server):
+    _queue_email("first@example.com")
+    transport = email.SMTPTransport()
+    email.send_batch(transport)
+
+    # The server hanging up between emails
+    transport._server.sock.close()
+    _queue_email("second@example.com")
+    assert email.send_batch(transport) == (1, 0)
+    transport.close()
+
+    assert len(smtp_server.messages) == 2
+
+
+def test_claimed_emails_are_sent_again_after_the_lease(smtp_server):
+    _queue_email("first@example.com")
+    # A worker that claimed the email and died before sending it
+    models.OutboxEmail.query.update(
+        {
+            "status": models.OutboxEmailStatus.SENDING,
+            "attempts": 1,
+            "next_attempt_time": datetime.utcnow() + timedelta(seconds=300),
+        }
+    )
+    db.session.commit()
+
+    assert email.run_worker(once=True) == (0, 0)
+
+    _make_due()
+    assert email.run_worker(once=True) == (1, 0)
+    row = _outbox()["first@example.com"]
+    assert row.status == models.OutboxEmailStatus.SENT
+    assert row.attempts == 2
@@ -0,0 +1,116 @@
+import json
+from datetime import datetime, timedelta
+
+import pytest
+import requests
+
+from kyan import models, tracker_sync
+from kyan.extensions import db
+
+
+@pytest.fixture
+def tracker(app_context, create_tables, http_stub):
+    """Points the sync at a stub tracker API answering with the queued statuses
+    (200 once they run out), and empties the trackerapi table"""
+    create_tables(models.TrackerApi)
+    statuses = []
+
+    def respond(handler):
+        return (statuses.pop(0) if statuses else 200), {}, b"{}"
+
+    stub = http_stub(respond)
+    stub.statuses = statuses
+
+    config = app_context.config
+    old_url = config["GENERAL"]["TRACKER_API_URL"]
+    old_sync_config = dict(config["TRACKER_SYNC"])
+    config["GENERAL"]["TRACKER_API_URL"] = stub.url + "/api"
+    config["TRACKER_SYNC"].update(BATCH_SIZE=2, RETRIES=2, BACKOFF=0, TIMEOUT=5)
+    yield stub
+    config["GENERAL"]["TRACKER_API_URL"] = old_url
+    config["TRACKER_SYNC"] = old_sync_config
+
+
+def _queue(*rows):
+    for info_hash, method in rows:
+        db.session.add(models.TrackerApi(info_hash, method))
+    db.session.commit()
+
+
+def _pushed(stub):
+    return [json.loads(handler.body) for handler in stub.requests]
+
+
+def test_pushes_in_batches(tracker):
+    _queue(*[(bytes([i]) * 20, "insert") for i in range(5)])
+
+    assert tracker_sync.run(once=True) == 5
+
+    pushed = _pushed(tracker)
+    assert [len(body["insert"]) for body in pushed] == [2, 2, 1]
+    assert [h for body in pushed for h in body["insert"]] == [
+        (bytes([i]) * 20).hex() for i in range(5)
+    ]
+    assert all(h.headers["Authorization"] for h in tracker.requests)
+    assert models.TrackerApi.query.count() == 0
+
+
+def test_collapses_changes_to_the_same_hash(tracker):
+    _queue((b"a" * 20, "insert"), (b"a" * 20, "remove"))
+
+    tracker_sync.run(once=True)
+
+    assert _pushed(tracker) == [{"insert": [], "remove": [(b"a" * 20).hex()]}]
+
+
+def test_retries_failed_pushes(tracker):
+    tracker.statuses.extend([503, 502])
+    _queue((b"a" * 20, "insert"))
+
+    assert tracker_sync.run(once=True) == 1
+
+    assert len(tracker.requests) == 3
+    assert models.TrackerApi.query.count() == 0
+
+
+def test_keeps_rows_queued_when_the_tracker_fails(tracker):
+    tracker.statuses.extend([500] * 3)
+    _queue((b"a" * 20, "insert"), (b"b" * 20, "remove"))
+
+    with pytest.raises(requests.RequestException):
+        tracker_sync.run(once=True)
+
+    assert len(tracker.requests) == 3
+    assert models.TrackerApi.query.count() == 2
+
+    # The next run pushes them once the tracker is back
+    assert tracker_sync.run(once=True) == 2
+    assert models.TrackerApi.query.count() == 0
+
+
+def test_rejected_push_keeps_rows_queued(tracker):
+    tracker.statuses.append(403)
+    _queue((b"a" * 20, "insert"))
+
+    with pytest.raises(tracker_sync.TrackerSyncError):
+        tracker_sync.run(once=True)
+
+    assert models.TrackerApi.query.count() == 1
+
+
+def test_skips_rows_claimed_by_another_worker(tracker):
+    _queue((b"a" * 20, "insert"), (b"b" * 20, "insert"))
+    claimed = models.TrackerApi.query.order_by(models.TrackerApi.id).first()
+    claimed.claimed_time = datetime.utcnow()
+    db.session.commit()
+
+    assert tracker_sync.run(once=True) == 1
+    assert _pushed(tracker) == [{"insert": [(b"b" * 20).hex()], "remove": []}]
+    assert models.TrackerApi.query.count() == 1
+
+    # Until the claim times out, as when that worker died mid-push
+    claimed = models.TrackerApi.query.one()
+    claimed.claimed_time = datetime.utcnow() - timedelta(seconds=3600)
+    db.session.commit()
+    assert tracker_sync.run(once=True) == 1
+    assert models.TrackerApi.query.count() == 0